@@ -1,11 +1,37 @@
 # app.py - Полная версия с гибридным подходом AssemblyAI
-from flask import Flask, render_template, request, jsonify
+from flask import Flask, render_template, request, jsonify, Response, stream_with_context
+from werkzeug.exceptions import RequestEntityTooLarge
+from werkzeug.http import parse_options_header
+from werkzeug.sansio.multipart import MultipartDecoder, File, Field, Data, Epilogue, NeedData
 import os
+import sys
+import signal
+import shutil
 import tempfile
 import assemblyai as aai
+import httpx
 from openai import OpenAI
 import time
 import logging
+import threading
+import uuid
+import hashlib
+import hmac
+import json
+import subprocess
+import re
+import math
+import sqlite3
+import functools
+import random
+import weakref
+import zipfile
+import zlib
+from array import array
+from collections import Counter, deque
+from contextlib import contextmanager
+from sys import intern
+from concurrent.futures import ThreadPoolExecutor, as_completed
 
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
@@ -16,14 +42,362 @@ app.config['MAX_CONTENT_LENGTH'] = 500 * 1024 * 1024  # 500 MB
 # === API ключи ===
 ASSEMBLYAI_API_KEY = os.environ.get("ASSEMBLYAI_API_KEY", "fb277d535ab94838bc14cc2f687b30be")
 OPENROUTER_API_KEY = os.environ.get("OPENROUTER_API_KEY")
-TEMP_DIR = tempfile.mkdtemp(prefix="voicesum_hybrid_")
-
-logger.info(f"📁 Используется временная папка: {TEMP_DIR}")
+SUMMARY_MODEL = os.environ.get("SUMMARY_MODEL", "anthropic/claude-3-haiku")
+# Временные файлы: у каждого процесса своя папка worker_<pid> внутри TEMP_ROOT (см. init_worker_temp_dir),
+# а в SPOOL_DIR лежат файлы, доступные всем воркерам: части загрузок и задачи, сохранённые при остановке
+TEMP_ROOT = os.environ.get("TEMP_ROOT", os.path.join(tempfile.gettempdir(), "voicesum_hybrid"))
+SPOOL_DIR = os.path.join(TEMP_ROOT, "spool")
+TEMP_DIR = os.path.join(TEMP_ROOT, f"worker_{os.getpid()}")
 
 # === Настройка AssemblyAI ===
 aai.settings.api_key = ASSEMBLYAI_API_KEY
+# Позволяет направить SDK на локальную заглушку API (для тестов и отладки)
+ASSEMBLYAI_BASE_URL = os.environ.get("ASSEMBLYAI_BASE_URL")
+if ASSEMBLYAI_BASE_URL:
+    aai.settings.base_url = ASSEMBLYAI_BASE_URL
 logger.info("🔑 AssemblyAI API ключ настроен")
 
+# === Статистика загрузок ===
+upload_stats = {
+    "jobs": 0,
+    "bytes_uploaded_total": 0,
+    "bytes_uploaded_last_job": 0,
+    "uploads_total": 0,
+}
+upload_stats_lock = threading.Lock()
+
+def record_upload(bytes_uploaded, count_job=True):
+    """Учитывает загрузку файла в AssemblyAI (основная загрузка - одна на задачу)"""
+    with upload_stats_lock:
+        upload_stats["uploads_total"] += 1
+        upload_stats["bytes_uploaded_total"] += bytes_uploaded
+    if count_job:
+        record_job_upload(bytes_uploaded)
+
+def record_job_upload(job_bytes):
+    """Учитывает суммарный объём основных загрузок одной задачи"""
+    with upload_stats_lock:
+        upload_stats["jobs"] += 1
+        upload_stats["bytes_uploaded_last_job"] = job_bytes
+
+def get_upload_stats():
+    """Возвращает снимок статистики загрузок для /health"""
+    with upload_stats_lock:
+        stats = dict(upload_stats)
+    stats["bytes_uploaded_per_job"] = (
+        stats["bytes_uploaded_total"] // stats["jobs"] if stats["jobs"] else 0
+    )
+    return stats
+
+# === Метрики (формат Prometheus) ===
+METRIC_BUCKETS = (0.01, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600, 1800)
+
+class MetricsRegistry:
+    """Минимальный реестр гистограмм, счётчиков и датчиков для /metrics"""
+    
+    def __init__(self, buckets=METRIC_BUCKETS):
+        self.buckets = buckets
+        self.lock = threading.Lock()
+        self.descriptions = {}  # имя -> (тип, описание)
+        self.histograms = {}    # (имя, метки) -> [счётчики по корзинам, сумма, количество]
+        self.values = {}        # (имя, метки) -> значение счётчика или датчика
+    
+    def describe(self, name, kind, help_text):
+        self.descriptions[name] = (kind, help_text)
+    
+    def observe(self, name, value, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            histogram = self.histograms.get(key)
+            if histogram is None:
+                histogram = self.histograms[key] = [[0] * len(self.buckets), 0.0, 0]
+            for index, bound in enumerate(self.buckets):
+                if value <= bound:
+                    histogram[0][index] += 1
+            histogram[1] += value
+            histogram[2] += 1
+    
+    def inc(self, name, amount=1, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + amount
+    
+    def set(self, name, value, **labels):
+        with self.lock:
+            self.values[(name, tuple(sorted(labels.items())))] = value
+    
+    @contextmanager
+    def time(self, name, **labels):
+        started = time.time()
+        try:
+            yield
+        finally:
+            self.observe(name, time.time() - started, **labels)
+    
+    def snapshot(self, exclude=()):
+        """Значения процесса в виде, пригодном для JSON (для объединения метрик воркеров)"""
+        with self.lock:
+            return {
+                "values": [[name, labels, value] for (name, labels), value in self.values.items() if name not in exclude],
+                "histograms": [[name, labels, *value] for (name, labels), value in self.histograms.items() if name not in exclude],
+            }
+    
+    def render(self, snapshots=()):
+        """Текст в формате Prometheus exposition; snapshots - значения других воркеров, они суммируются"""
+        def format_labels(labels):
+            if not labels:
+                return ""
+            return "{" + ",".join(f'{key}="{_escape_label_value(value)}"' for key, value in labels) + "}"
+        
+        with self.lock:
+            histograms = {key: (list(value[0]), value[1], value[2]) for key, value in self.histograms.items()}
+            values = dict(self.values)
+        
+        for snapshot in snapshots:
+            for name, labels, value in snapshot["values"]:
+                key = (name, tuple(tuple(label) for label in labels))
+                values[key] = values.get(key, 0) + value
+            for name, labels, counts, total, count in snapshot["histograms"]:
+                key = (name, tuple(tuple(label) for label in labels))
+                own_counts, own_total, own_count = histograms.get(key, ([0] * len(self.buckets), 0.0, 0))
+                histograms[key] = ([a + b for a, b in zip(own_counts, counts)], own_total + total, own_count + count)
+        
+        lines = []
+        names = sorted({name for name, _ in histograms} | {name for name, _ in values})
+        for name in names:
+            kind, help_text = self.descriptions.get(name, ("untyped", ""))
+            lines.append(f"# HELP {name} {help_text}")
+            lines.append(f"# TYPE {name} {kind}")
+            for (metric, labels), (counts, total, count) in sorted(histograms.items()):
+                if metric != name:
+                    continue
+                for bound, bucket_count in zip(self.buckets, counts):
+                    lines.append(f"{name}_bucket{format_labels(labels + (('le', bound),))} {bucket_count}")
+                lines.append(f"{name}_bucket{format_labels(labels + (('le', '+Inf'),))} {count}")
+                lines.append(f"{name}_sum{format_labels(labels)} {total:.6f}")
+                lines.append(f"{name}_count{format_labels(labels)} {count}")
+            for (metric, labels), value in sorted(values.items()):
+                if metric == name:
+                    lines.append(f"{name}{format_labels(labels)} {value}")
+        return "\n".join(lines) + "\n"
+
+def _escape_label_value(value):
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+metrics = MetricsRegistry()
+metrics.describe("voicesum_stage_seconds", "histogram", "Длительность этапов обработки")
+metrics.describe("voicesum_strategy_seconds", "histogram", "Длительность попыток стратегий транскрипции")
+metrics.describe("voicesum_strategy_attempts_total", "counter", "Попытки стратегий транскрипции по исходу")
+metrics.describe("voicesum_jobs_in_flight", "gauge", "Задачи, обрабатываемые прямо сейчас")
+metrics.describe("voicesum_jobs", "gauge", "Фоновые задачи по статусам")
+metrics.describe("voicesum_upload_bytes_total", "counter", "Байт загружено в AssemblyAI")
+metrics.describe("voicesum_uploads_total", "counter", "Загрузок в AssemblyAI")
+metrics.describe("voicesum_result_cache_events_total", "counter", "События кэша результатов")
+
+def timed_stage(stage):
+    """Декоратор: длительность вызова попадает в voicesum_stage_seconds{stage=...}"""
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            with metrics.time("voicesum_stage_seconds", stage=stage):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+# === HTTP-клиенты: общий пул соединений, повторы и предохранитель ===
+HTTP_POOL_MAX_CONNECTIONS = int(os.environ.get("HTTP_POOL_MAX_CONNECTIONS", 50))
+HTTP_POOL_MAX_KEEPALIVE = int(os.environ.get("HTTP_POOL_MAX_KEEPALIVE", 20))
+HTTP_KEEPALIVE_EXPIRY = float(os.environ.get("HTTP_KEEPALIVE_EXPIRY", 60))
+HTTP_MAX_RETRIES = int(os.environ.get("HTTP_MAX_RETRIES", 3))
+HTTP_BACKOFF_BASE = float(os.environ.get("HTTP_BACKOFF_BASE", 0.5))
+HTTP_BACKOFF_MAX = float(os.environ.get("HTTP_BACKOFF_MAX", 20))
+CIRCUIT_FAILURE_THRESHOLD = int(os.environ.get("CIRCUIT_FAILURE_THRESHOLD", 5))
+CIRCUIT_RESET_SECONDS = float(os.environ.get("CIRCUIT_RESET_SECONDS", 30))
+RETRYABLE_STATUS_CODES = {429, 500, 502, 503, 504}
+
+metrics.describe("voicesum_upstream_requests_total", "counter", "Запросы к внешним API по исходу")
+metrics.describe("voicesum_upstream_connections", "gauge", "Соединения в пуле по состоянию")
+
+class UpstreamUnavailableError(httpx.TransportError):
+    """Предохранитель разомкнут: запросы к upstream временно не отправляются"""
+
+class CircuitBreaker:
+    """Предохранитель: после серии сбоев upstream отключается на CIRCUIT_RESET_SECONDS,
+    затем пропускается один пробный запрос."""
+    
+    def __init__(self, name, failure_threshold, reset_seconds):
+        self.name = name
+        self.failure_threshold = failure_threshold
+        self.reset_seconds = reset_seconds
+        self.lock = threading.Lock()
+        self.state = "closed"
+        self.consecutive_failures = 0
+        self.opened_at = None
+        self.trial_in_flight = False
+        self.times_opened = 0
+    
+    def allow_request(self):
+        with self.lock:
+            if self.state == "open":
+                if time.time() - self.opened_at < self.reset_seconds:
+                    return False
+                self.state = "half_open"
+                self.trial_in_flight = False
+            if self.state == "half_open":
+                if self.trial_in_flight:
+                    return False
+                self.trial_in_flight = True
+            return True
+    
+    def record_success(self):
+        with self.lock:
+            self.state = "closed"
+            self.consecutive_failures = 0
+            self.trial_in_flight = False
+    
+    def record_failure(self):
+        with self.lock:
+            self.consecutive_failures += 1
+            if self.state == "half_open" or self.consecutive_failures >= self.failure_threshold:
+                if self.state != "open":
+                    self.times_opened += 1
+                    logger.warning(f"🔌 Предохранитель {self.name} разомкнут на {self.reset_seconds:.0f}с")
+                self.state = "open"
+                self.opened_at = time.time()
+            self.trial_in_flight = False
+    
+    def get_stats(self):
+        with self.lock:
+            return {
+                "state": self.state,
+                "consecutive_failures": self.consecutive_failures,
+                "times_opened": self.times_opened,
+            }
+
+class ResilientTransport(httpx.HTTPTransport):
+    """Транспорт с пулом keep-alive соединений, повторами 429/5xx и предохранителем.
+    
+    Повторяются только запросы с телом в памяти: потоковое тело (загрузка файла)
+    нельзя отправить второй раз.
+    """
+    
+    def __init__(self, upstream, breaker, **kwargs):
+        super().__init__(**kwargs)
+        self.upstream = upstream
+        self.breaker = breaker
+        self.stats_lock = threading.Lock()
+        self.stats = {"requests": 0, "retries": 0, "failures": 0, "rejected": 0, "connections_opened": 0}
+        self._seen_connections = weakref.WeakSet()
+    
+    def _count(self, field, outcome=None):
+        with self.stats_lock:
+            self.stats[field] += 1
+        if outcome:
+            metrics.inc("voicesum_upstream_requests_total", upstream=self.upstream, outcome=outcome)
+    
+    def _backoff_delay(self, attempt, response=None):
+        """Экспоненциальная задержка с полным джиттером; Retry-After имеет приоритет"""
+        retry_after = response.headers.get("Retry-After") if response is not None else None
+        if retry_after and retry_after.isdigit():
+            return min(float(retry_after), HTTP_BACKOFF_MAX)
+        return random.uniform(0, min(HTTP_BACKOFF_MAX, HTTP_BACKOFF_BASE * 2 ** attempt))
+    
+    def handle_request(self, request):
+        if not self.breaker.allow_request():
+            self._count("rejected", "rejected")
+            raise UpstreamUnavailableError(f"{self.upstream} временно недоступен (предохранитель)", request=request)
+        
+        replayable = isinstance(request.stream, httpx.ByteStream)
+        attempt = 0
+        while True:
+            self._count("requests")
+            try:
+                response = super().handle_request(request)
+            except httpx.TransportError:
+                if replayable and attempt < HTTP_MAX_RETRIES:
+                    self._count("retries", "retry")
+                    time.sleep(self._backoff_delay(attempt))
+                    attempt += 1
+                    continue
+                self._count("failures", "error")
+                self.breaker.record_failure()
+                raise
+            
+            self._track_connections()
+            if response.status_code not in RETRYABLE_STATUS_CODES:
+                self.breaker.record_success()
+                metrics.inc("voicesum_upstream_requests_total", upstream=self.upstream, outcome="ok")
+                return response
+            
+            if replayable and attempt < HTTP_MAX_RETRIES:
+                delay = self._backoff_delay(attempt, response)
+                response.close()
+                self._count("retries", "retry")
+                logger.warning(f"🔁 {self.upstream}: HTTP {response.status_code}, повтор через {delay:.1f}с")
+                time.sleep(delay)
+                attempt += 1
+                continue
+            
+            self._count("failures", "error")
+            self.breaker.record_failure()
+            return response
+    
+    def _track_connections(self):
+        """Считает новые соединения (каждое - это TCP/TLS рукопожатие)"""
+        for connection in self._pool.connections:
+            if connection not in self._seen_connections:
+                self._seen_connections.add(connection)
+                self._count("connections_opened")
+    
+    def get_stats(self):
+        connections = self._pool.connections
+        with self.stats_lock:
+            stats = dict(self.stats)
+        stats["connections"] = len(connections)
+        stats["idle_connections"] = sum(1 for connection in connections if connection.is_idle())
+        stats["circuit"] = self.breaker.get_stats()
+        return stats
+
+http_transports = {}
+circuit_breakers = {}
+
+def get_circuit_breaker(upstream):
+    """Один предохранитель на upstream для всех его клиентов (синхронных и асинхронных)"""
+    if upstream not in circuit_breakers:
+        circuit_breakers[upstream] = CircuitBreaker(upstream, CIRCUIT_FAILURE_THRESHOLD, CIRCUIT_RESET_SECONDS)
+    return circuit_breakers[upstream]
+
+def create_pooled_http_client(upstream, **client_kwargs):
+    """Общий httpx-клиент для upstream с настроенным пулом и повторами"""
+    transport = ResilientTransport(
+        upstream,
+        get_circuit_breaker(upstream),
+        limits=httpx.Limits(
+            max_connections=HTTP_POOL_MAX_CONNECTIONS,
+            max_keepalive_connections=HTTP_POOL_MAX_KEEPALIVE,
+            keepalive_expiry=HTTP_KEEPALIVE_EXPIRY,
+        ),
+    )
+    http_transports[upstream] = transport
+    return httpx.Client(transport=transport, **client_kwargs)
+
+def get_http_pool_stats():
+    """Статистика пулов соединений и предохранителей по upstream"""
+    return {upstream: transport.get_stats() for upstream, transport in http_transports.items()}
+
+# Общий клиент AssemblyAI. SDK не принимает свой httpx-клиент, поэтому подменяем
+# созданный им по умолчанию и делаем наш клиент клиентом SDK по умолчанию.
+assemblyai_client = aai.Client(settings=aai.settings)
+_sdk_http_client = assemblyai_client.http_client
+assemblyai_client._http_client = create_pooled_http_client(
+    "assemblyai",
+    base_url=_sdk_http_client.base_url,
+    headers=_sdk_http_client.headers,
+    timeout=_sdk_http_client.timeout,
+)
+_sdk_http_client.close()
+aai.Client._default = assemblyai_client
+
 # === Конфигурации транскрипции ===
 def get_transcription_config_auto():
     """Конфигурация с автообнаружением языка для максимальных возможностей"""
@@ -114,336 +488,4528 @@ def get_transcription_config_russian():
         redact_pii=False,        # Не скрываем персональные данные
     )
 
-def transcribe_with_fallback(file_path):
-    """Улучшенная транскрипция с множественным fallback"""
+# === Кэш результатов ===
+RESULT_CACHE_ENABLED = os.environ.get("RESULT_CACHE_ENABLED", "1") == "1"
+RESULT_CACHE_DIR = os.environ.get("RESULT_CACHE_DIR", os.path.join(tempfile.gettempdir(), "voicesum_result_cache"))
+RESULT_CACHE_MAX_BYTES = int(os.environ.get("RESULT_CACHE_MAX_MB", 1024)) * 1024 * 1024
+RESULT_CACHE_TTL = int(os.environ.get("RESULT_CACHE_TTL", 7 * 24 * 3600))  # секунды
+
+def get_pipeline_fingerprint():
+    """Отпечаток конфигураций транскрипции и модели резюме для ключа кэша"""
+    configs = [
+        get_transcription_config_russian(),
+        get_transcription_config_auto(),
+        get_transcription_config_auto_chapters(),
+    ]
+    payload = {
+        "configs": [config.raw.dict(exclude_none=True) for config in configs],
+        "summary_model": SUMMARY_MODEL if OPENROUTER_API_KEY else "basic",
+    }
+    return hashlib.sha256(json.dumps(payload, sort_keys=True, default=str).encode()).hexdigest()
+
+class ResultCache:
+    """Персистентный кэш готовых ответов на диске с вытеснением по TTL и размеру"""
     
-    # Стратегия 1: СНАЧАЛА пробуем русский язык (лучше для русского контента)
-    try:
-        logger.info("🇷🇺 Пробую русский язык (рекомендуется для русского контента)...")
-        config_ru = get_transcription_config_russian()
-        transcriber = aai.Transcriber(config=config_ru)
-        transcript = transcriber.transcribe(file_path)
-        
-        if transcript.status == aai.TranscriptStatus.error:
-            raise RuntimeError(f"Ошибка русского: {transcript.error}")
-        
-        # Проверяем качество транскрипции
-        if transcript.text and len(transcript.text.strip()) > 10:
-            logger.info("✅ Транскрипция на русском успешна!")
-            return transcript, "russian_limited_features"
-        else:
-            raise RuntimeError("Пустая транскрипция")
-        
-    except Exception as e:
-        logger.warning(f"⚠️ Русский язык не сработал: {e}")
-        
-        # Стратегия 2: Автообнаружение с резюме
-        try:
-            logger.info("🌍 Пробую автообнаружение языка с резюме...")
-            config_auto = get_transcription_config_auto()
-            transcriber = aai.Transcriber(config=config_auto)
-            transcript = transcriber.transcribe(file_path)
-            
-            if transcript.status == aai.TranscriptStatus.error:
-                raise RuntimeError(f"Ошибка автообнаружения: {transcript.error}")
-            
-            logger.info("✅ Транскрипция с автообнаружением (резюме) успешна!")
-            return transcript, "auto_detection_summary"
+    def __init__(self, cache_dir, max_bytes, ttl_seconds):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self.ttl_seconds = ttl_seconds
+        self.lock = threading.Lock()
+        self.stats = {"hits": 0, "misses": 0, "stores": 0, "evictions": 0}
+        os.makedirs(cache_dir, exist_ok=True)
+    
+    def make_key(self, audio_hash):
+        return hashlib.sha256(f"{audio_hash}:{get_pipeline_fingerprint()}".encode()).hexdigest()
+    
+    def _path(self, key):
+        return os.path.join(self.cache_dir, f"{key}.json")
+    
+    def get(self, key):
+        """Возвращает сохранённый ответ или None"""
+        path = self._path(key)
+        with self.lock:
+            try:
+                with open(path, encoding="utf-8") as f:
+                    entry = json.load(f)
+            except (OSError, ValueError):
+                self.stats["misses"] += 1
+                return None
             
-        except Exception as e2:
-            logger.warning(f"⚠️ Автообнаружение с резюме не сработало: {e2}")
+            if time.time() - entry.get("created_at", 0) > self.ttl_seconds:
+                self._remove(path)
+                self.stats["evictions"] += 1
+                self.stats["misses"] += 1
+                return None
             
-            # Стратегия 3: Автообнаружение с главами
+            # Обновляем mtime - вытеснение идёт по давности использования
+            os.utime(path, None)
+            self.stats["hits"] += 1
+            return entry["response"]
+    
+    def put(self, key, response_data):
+        """Сохраняет ответ атомарно и вытесняет старые записи при переполнении"""
+        path = self._path(key)
+        tmp_path = f"{path}.{uuid.uuid4().hex[:8]}.tmp"
+        entry = {"created_at": time.time(), "response": response_data}
+        with self.lock:
             try:
-                logger.info("🌍 Пробую автообнаружение языка с главами...")
-                config_chapters = get_transcription_config_auto_chapters()
-                transcriber = aai.Transcriber(config=config_chapters)
-                transcript = transcriber.transcribe(file_path)
-                
-                if transcript.status == aai.TranscriptStatus.error:
-                    raise RuntimeError(f"Ошибка автообнаружения с главами: {transcript.error}")
-                
-                logger.info("✅ Транскрипция с автообнаружением (главы) успешна!")
-                return transcript, "auto_detection_chapters"
-                
-            except Exception as e3:
-                logger.error(f"❌ Все методы не сработали: русский({e}), авто-резюме({e2}), авто-главы({e3})")
-                raise RuntimeError(f"Не удалось транскрибировать файл всеми доступными методами")
-
-# === Умный генератор резюме ===
-class AdvancedSummarizer:
-    def __init__(self, openrouter_key):
-        self.client = OpenAI(
-            base_url="https://openrouter.ai/api/v1",
-            api_key=openrouter_key
-        ) if openrouter_key else None
+                with open(tmp_path, "w", encoding="utf-8") as f:
+                    json.dump(entry, f, ensure_ascii=False)
+                os.replace(tmp_path, path)
+                self.stats["stores"] += 1
+            except OSError as e:
+                logger.warning(f"⚠️ Не удалось записать кэш: {e}")
+                self._remove(tmp_path)
+                return
+            self._evict()
     
-    def create_smart_summary(self, transcript_result, transcription_method):
-        """Создает умное резюме на основе всех данных AssemblyAI"""
-        if not self.client:
-            return self._create_basic_summary(transcript_result, transcription_method)
+    def _evict(self):
+        """Удаляет просроченные записи, затем самые давние до лимита размера"""
+        now = time.time()
+        entries = []
+        for name in os.listdir(self.cache_dir):
+            if not name.endswith(".json"):
+                continue
+            path = os.path.join(self.cache_dir, name)
+            try:
+                stat = os.stat(path)
+            except OSError:
+                continue
+            if now - stat.st_mtime > self.ttl_seconds:
+                self._remove(path)
+                self.stats["evictions"] += 1
+            else:
+                entries.append((stat.st_mtime, stat.st_size, path))
         
+        total_size = sum(size for _, size, _ in entries)
+        for _, size, path in sorted(entries):
+            if total_size <= self.max_bytes:
+                break
+            self._remove(path)
+            total_size -= size
+            self.stats["evictions"] += 1
+    
+    def _remove(self, path):
         try:
-            # Таймаут для генерации резюме
-            timeout_seconds = 60
-            
-            # Собираем все данные
-            transcript = transcript_result.text
-            chapters = getattr(transcript_result, 'chapters', None) or []
-            highlights = getattr(transcript_result, 'auto_highlights', None)
-            sentiment = getattr(transcript_result, 'sentiment_analysis_results', None) or []
-            entities = getattr(transcript_result, 'entities', None) or []
-            builtin_summary = getattr(transcript_result, 'summary', None)
-            detected_language = getattr(transcript_result, 'language_code', 'unknown')
-            
-            # Формируем богатый контекст (ограничиваем размер)
-            context = f"ПОЛНЫЙ ТРАНСКРИПТ:\n{transcript[:20000]}\n\n"
-            context += f"МЕТОД ТРАНСКРИПЦИИ: {transcription_method}\n"
-            context += f"ОПРЕДЕЛЕННЫЙ ЯЗЫК: {detected_language}\n\n"
-            
-            if chapters:
-                context += "📚 АВТОМАТИЧЕСКИЕ ГЛАВЫ:\n"
-                for i, chapter in enumerate(chapters[:8], 1):
-                    headline = getattr(chapter, 'headline', f'Глава {i}')
-                    start_time = getattr(chapter, 'start', 0) / 1000 / 60  # в минутах
-                    context += f"{i}. {headline} ({start_time:.1f}мин)\n"
-                context += "\n"
-            
-            if highlights and hasattr(highlights, 'results'):
-                context += "💡 КЛЮЧЕВЫЕ МОМЕНТЫ:\n"
-                for highlight in highlights.results[:10]:
-                    text = getattr(highlight, 'text', '')
-                    if text:
-                        context += f"• {text}\n"
-                context += "\n"
-            
-            if entities:
-                context += "🏷️ УПОМЯНУТЫЕ СУЩНОСТИ:\n"
-                entity_groups = {}
-                for entity in entities[:20]:
-                    entity_type = getattr(entity, 'entity_type', 'other')
-                    entity_text = getattr(entity, 'text', '')
-                    if entity_type not in entity_groups:
-                        entity_groups[entity_type] = []
-                    if entity_text not in entity_groups[entity_type]:
-                        entity_groups[entity_type].append(entity_text)
-                
-                for entity_type, texts in entity_groups.items():
-                    context += f"  {entity_type}: {', '.join(texts[:3])}\n"
-                context += "\n"
-            
-            if builtin_summary:
-                context += f"🤖 БАЗОВОЕ РЕЗЮМЕ ASSEMBLYAI:\n{builtin_summary}\n\n"
-            
-            # Определяем язык контента для адаптации промпта
-            content_language = detected_language if detected_language != 'unknown' else 'неизвестный'
-            
-            system_prompt = f"""Ты - профессиональный аналитик аудиоконтента. 
-Транскрипт выполнен на языке: {content_language}. Метод: {transcription_method}.
+            os.remove(path)
+        except OSError:
+            pass
+    
+    def get_stats(self):
+        """Счётчики попаданий/промахов/вытеснений для мониторинга"""
+        with self.lock:
+            stats = dict(self.stats)
+        lookups = stats["hits"] + stats["misses"]
+        stats["hit_rate"] = round(stats["hits"] / lookups, 3) if lookups else 0.0
+        stats["enabled"] = True
+        return stats
 
-ВАЖНО: Создай подробное структурированное резюме  НА РУССКОМ И АНГЛИЙСКОМ (ниже) ЯЗЫКЕ.
+result_cache = ResultCache(RESULT_CACHE_DIR, RESULT_CACHE_MAX_BYTES, RESULT_CACHE_TTL) if RESULT_CACHE_ENABLED else None
 
-СТРУКТУРА РЕЗЮМЕ:
-📋 КРАТКОЕ РЕЗЮМЕ (2-3 предложения)
-🌍 ЯЗЫК КОНТЕНТА: {content_language}
-🎯 ОСНОВНЫЕ ТЕМЫ (с временными метками если есть)
-👥 УЧАСТНИКИ (если определены спикеры)
-💡 КЛЮЧЕВЫЕ ИНСАЙТЫ
-📊 ВАЖНЫЕ ФАКТЫ И ЦИФРЫ
-🎭 ЭМОЦИОНАЛЬНАЯ ТОНАЛЬНОСТЬ
-✅ РЕШЕНИЯ И ДЕЙСТВИЯ
-🏷️ КЛЮЧЕВЫЕ ПЕРСОНЫ
+# === Хранилище транскриптов и полнотекстовый поиск ===
+TRANSCRIPT_STORE_ENABLED = os.environ.get("TRANSCRIPT_STORE_ENABLED", "1") == "1"
+TRANSCRIPT_STORE_PATH = os.environ.get("TRANSCRIPT_STORE_PATH", os.path.join(tempfile.gettempdir(), "voicesum_transcripts.sqlite3"))
+SEARCH_DEFAULT_LIMIT = 20
+SEARCH_MAX_LIMIT = 100
+TRANSCRIPT_PREVIEW_CHARS = 50000  # символов транскрипта в первом ответе, остальное - страницами
+TRANSCRIPT_PAGE_MAX_CHARS = 100000
+TRANSCRIPT_PAGE_MAX_UTTERANCES = 1000
+UTTERANCE_FIELDS = ["start", "end", "speaker", "text"]
 
-Используй эмодзи, будь конкретным, переводи на русский язык."""
-            
-            # Генерируем умное резюме с таймаутом
-            response = self.client.chat.completions.create(
-                model="anthropic/claude-3-haiku",
-                messages=[
-                    {"role": "system", "content": system_prompt},
-                    {"role": "user", "content": context}
-                ],
-                max_tokens=1200,
-                temperature=0.3,
-                timeout=timeout_seconds
-            )
-            
-            return response.choices[0].message.content.strip()
-            
-        except Exception as e:
-            logger.error(f"❌ Ошибка умного резюме: {e}")
-            return self._create_basic_summary(transcript_result, transcription_method)
+class SQLiteStore:
+    """Основа хранилищ в SQLite: отдельное соединение на операцию, WAL для параллельного чтения"""
     
-    def _create_basic_summary(self, transcript_result, transcription_method):
-        """Создает базовое резюме из данных AssemblyAI НА РУССКОМ ЯЗЫКЕ"""
-        summary_parts = []
-        detected_language = getattr(transcript_result, 'language_code', 'unknown')
-        
-        language_names = {
-            'en': 'английский', 'ru': 'русский', 'es': 'испанский',
-            'fr': 'французский', 'de': 'немецкий', 'it': 'итальянский',
-            'pt': 'португальский', 'zh': 'китайский', 'ja': 'японский',
-            'ko': 'корейский', 'unknown': 'не определен'
-        }
-        
-        language_display = language_names.get(detected_language, detected_language)
-        
-        summary_parts.append(f"🔧 МЕТОД ОБРАБОТКИ: {transcription_method}")
-        summary_parts.append(f"🌍 ЯЗЫК КОНТЕНТА: {language_display}")
-        
-        # Встроенное резюме
-        builtin_summary = getattr(transcript_result, 'summary', None)
-        if builtin_summary:
-            summary_parts.append(f"\n📋 БАЗОВОЕ РЕЗЮМЕ:\n{builtin_summary}")
-        
-        # Главы
-        chapters = getattr(transcript_result, 'chapters', None)
-        if chapters:
-            summary_parts.append("\n🎯 ОСНОВНЫЕ РАЗДЕЛЫ:")
-            for i, chapter in enumerate(chapters[:6], 1):
-                headline = getattr(chapter, 'headline', f'Раздел {i}')
-                start_time = getattr(chapter, 'start', 0) / 1000 / 60
-                summary_parts.append(f"{i}. {headline} ({start_time:.1f}мин)")
-        
-        # Ключевые моменты
-        highlights = getattr(transcript_result, 'auto_highlights', None)
-        if highlights and hasattr(highlights, 'results'):
-            summary_parts.append(f"\n💡 КЛЮЧЕВЫЕ МОМЕНТЫ:")
-            for highlight in highlights.results[:8]:
-                text = getattr(highlight, 'text', '').strip()
-                if text:
-                    summary_parts.append(f"• {text}")
+    SCHEMA = ()
+    
+    def __init__(self, path):
+        self.path = path
+        with self._connect() as conn:
+            conn.execute("PRAGMA journal_mode=WAL")
+            for statement in self.SCHEMA:
+                conn.execute(statement)
+    
+    @contextmanager
+    def _connect(self):
+        conn = sqlite3.connect(self.path, timeout=30)
+        try:
+            with conn:
+                yield conn
+        finally:
+            conn.close()
+
+def _fts_query(text):
+    """Запрос пользователя в безопасный запрос FTS5: слова в кавычках, * в конце - префикс"""
+    terms = []
+    for token in text.split():
+        is_prefix = token.endswith("*")
+        token = token.rstrip("*").replace('"', '""')
+        if token:
+            terms.append(f'"{token}"' + ("*" if is_prefix else ""))
+    return " ".join(terms)
+
+class TranscriptStore(SQLiteStore):
+    """Готовые транскрипты с репликами, сущностями и резюме.
+    
+    Реплики и резюме индексируются в FTS5 (внешний контент - таблица segments),
+    сущности ищутся по индексу нормализованного текста, поэтому поиск не зависит
+    от числа сохранённых записей.
+    """
+    
+    SCHEMA = (
+        "CREATE TABLE IF NOT EXISTS transcripts ("
+        "id TEXT PRIMARY KEY, created_at REAL NOT NULL, filename TEXT, audio_hash TEXT, "
+        "transcription_method TEXT, detected_language TEXT, audio_duration REAL, "
+        "transcript TEXT NOT NULL, summary TEXT, assemblyai_summary TEXT, chapters TEXT)",
+        "CREATE INDEX IF NOT EXISTS transcripts_created_at ON transcripts (created_at)",
+        "CREATE TABLE IF NOT EXISTS segments ("
+        "id INTEGER PRIMARY KEY, transcript_id TEXT NOT NULL, kind TEXT NOT NULL, "
+        "start_ms INTEGER, end_ms INTEGER, speaker TEXT, text TEXT NOT NULL)",
+        "CREATE INDEX IF NOT EXISTS segments_transcript_start ON segments (transcript_id, start_ms)",
+        # Слова реплики для субтитров: начало, конец (мс) и позиция в тексте сегмента - массивы int32
+        "CREATE TABLE IF NOT EXISTS segment_words ("
+        "segment_id INTEGER PRIMARY KEY, starts BLOB NOT NULL, ends BLOB NOT NULL, offsets BLOB NOT NULL)",
+        "CREATE VIRTUAL TABLE IF NOT EXISTS segments_fts USING fts5("
+        "text, content='segments', content_rowid='id', tokenize='unicode61 remove_diacritics 2')",
+        "CREATE TABLE IF NOT EXISTS entities ("
+        "transcript_id TEXT NOT NULL, entity_type TEXT NOT NULL, text TEXT NOT NULL, text_key TEXT NOT NULL)",
+        "CREATE INDEX IF NOT EXISTS entities_text_key ON entities (text_key)",
+        "CREATE INDEX IF NOT EXISTS entities_transcript_id ON entities (transcript_id)",
+    )
+    
+    def save(self, transcript, response_data, filename=None, audio_hash=None):
+        """Сохраняет транскрипт и возвращает его ID"""
+        transcript_id = uuid.uuid4().hex
         
-        # Сущности
-        entities = getattr(transcript_result, 'entities', None)
-        if entities:
-            summary_parts.append("\n🏷️ УПОМЯНУТЫЕ СУЩНОСТИ:")
-            entity_groups = {}
-            
-            entity_type_translation = {
-                'person': 'Люди', 'organization': 'Организации', 
-                'location': 'Места', 'date': 'Даты', 'money': 'Деньги',
-                'phone_number': 'Телефоны', 'email': 'Email',
-                'product': 'Продукты', 'event': 'События', 'other': 'Прочее'
-            }
-            
-            for entity in entities[:12]:
-                entity_type = getattr(entity, 'entity_type', 'other')
-                entity_text = getattr(entity, 'text', '')
-                translated_type = entity_type_translation.get(entity_type, entity_type)
-                
-                if translated_type not in entity_groups:
-                    entity_groups[translated_type] = []
-                if entity_text not in entity_groups[translated_type]:
-                    entity_groups[translated_type].append(entity_text)
-            
-            for entity_type, texts in entity_groups.items():
-                if texts:
-                    summary_parts.append(f"  {entity_type}: {', '.join(texts[:3])}")
+        segments, word_index = [], 0
+        for utterance in transcript.utterances:
+            if utterance.text:
+                words, word_index = self._utterance_words(transcript, utterance, word_index)
+                segments.append(("utterance", utterance.start, utterance.end, utterance.speaker, utterance.text, words))
+        if not segments:
+            segments.append(("transcript", None, None, None, transcript.text, None))
+        for summary_key in ("summary", "assemblyai_summary"):
+            if response_data.get(summary_key):
+                segments.append((summary_key, None, None, None, response_data[summary_key], None))
         
-        if not summary_parts:
-            summary_parts.append("📋 Базовое резюме недоступно")
+        entities = [
+            (transcript_id, entity_type, text, text.casefold())
+            for entity_type, texts in format_entities_by_type(transcript.entities).items()
+            for text in texts
+        ]
         
-        return "\n".join(summary_parts)
-
-# === Инициализация ===
-summarizer = AdvancedSummarizer(OPENROUTER_API_KEY)
-
-# === Вспомогательные функции ===
-def analyze_sentiment_overall(sentiment_results):
-    """Анализирует общую тональность"""
-    if not sentiment_results:
-        return "not_analyzed", 0, 0, 0
+        with self._connect() as conn:
+            conn.execute(
+                "INSERT INTO transcripts VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                (
+                    transcript_id, time.time(), filename, audio_hash,
+                    response_data["transcription_method"], response_data["detected_language"],
+                    transcript.audio_duration, transcript.text,
+                    response_data.get("summary"), response_data.get("assemblyai_summary"),
+                    json.dumps(response_data.get("chapters", []), ensure_ascii=False),
+                )
+            )
+            for kind, start, end, speaker, text, words in segments:
+                segment_id = conn.execute(
+                    "INSERT INTO segments (transcript_id, kind, start_ms, end_ms, speaker, text) VALUES (?, ?, ?, ?, ?, ?)",
+                    (transcript_id, kind, start, end, speaker, text)
+                ).lastrowid
+                conn.execute("INSERT INTO segments_fts (rowid, text) VALUES (?, ?)", (segment_id, text))
+                if words:
+                    conn.execute(
+                        "INSERT INTO segment_words VALUES (?, ?, ?, ?)",
+                        (segment_id, *(column.tobytes() for column in words))
+                    )
+            conn.executemany("INSERT INTO entities VALUES (?, ?, ?, ?)", entities)
+        return transcript_id
     
-    positive_count = sum(1 for s in sentiment_results if getattr(s, 'sentiment', '') == 'POSITIVE')
-    negative_count = sum(1 for s in sentiment_results if getattr(s, 'sentiment', '') == 'NEGATIVE')
-    neutral_count = len(sentiment_results) - positive_count - negative_count
+    def _utterance_words(self, transcript, utterance, word_index):
+        """Слова CompactTranscript внутри реплики: (starts, ends, offsets) или None и индекс следующего слова"""
+        starts, ends, offsets = array("i"), array("i"), array("i")
+        position = 0
+        while word_index < transcript.words_count and transcript.word_starts[word_index] < utterance.end:
+            word = transcript.word_text(word_index)
+            offset = utterance.text.find(word, position) if word and transcript.word_starts[word_index] >= utterance.start else -1
+            if offset >= 0:
+                starts.append(transcript.word_starts[word_index])
+                ends.append(transcript.word_ends[word_index])
+                offsets.append(offset)
+                position = offset + len(word)
+            word_index += 1
+        return (starts, ends, offsets) if starts else None, word_index
     
-    if positive_count > negative_count and positive_count > neutral_count:
-        return "positive", positive_count, negative_count, neutral_count
-    elif negative_count > positive_count and negative_count > neutral_count:
-        return "negative", positive_count, negative_count, neutral_count
-    else:
-        return "neutral", positive_count, negative_count, neutral_count
-
-def format_entities_by_type(entities):
-    """Группирует сущности по типам"""
-    if not entities:
-        return {}
+    def get(self, transcript_id):
+        """Метаданные, резюме, сущности и главы транскрипта (без текста) или None"""
+        with self._connect() as conn:
+            conn.row_factory = sqlite3.Row
+            row = conn.execute(
+                "SELECT id, created_at, filename, audio_hash, transcription_method, detected_language, "
+                "audio_duration, summary, assemblyai_summary, chapters, length(transcript) AS total_chars "
+                "FROM transcripts WHERE id = ?", (transcript_id,)
+            ).fetchone()
+            if row is None:
+                return None
+            utterances_count = conn.execute(
+                "SELECT COUNT(*) FROM segments WHERE transcript_id = ? AND kind = 'utterance'", (transcript_id,)
+            ).fetchone()[0]
+            entities = conn.execute(
+                "SELECT entity_type, text FROM entities WHERE transcript_id = ? ORDER BY rowid", (transcript_id,)
+            ).fetchall()
+        
+        record = dict(row)
+        record["chapters"] = json.loads(record["chapters"] or "[]")
+        record["utterances_count"] = utterances_count
+        record["entities_by_type"] = {}
+        for entity in entities:
+            record["entities_by_type"].setdefault(entity["entity_type"], []).append(entity["text"])
+        return record
     
-    entity_groups = {}
-    for entity in entities:
-        entity_type = getattr(entity, 'entity_type', 'other')
-        entity_text = getattr(entity, 'text', '')
+    def get_text(self, transcript_id, offset, limit):
+        """Фрагмент текста [offset, offset + limit) в символах и полная длина, или None"""
+        with self._connect() as conn:
+            row = conn.execute(
+                "SELECT substr(transcript, ?, ?), length(transcript) FROM transcripts WHERE id = ?",
+                (offset + 1, limit, transcript_id)
+            ).fetchone()
+        return row
+    
+    def get_utterances(self, transcript_id, start_ms, end_ms, limit, after=None):
+        """Реплики, пересекающие [start_ms, end_ms), по порядку начала.
         
-        if entity_type not in entity_groups:
-            entity_groups[entity_type] = []
+        after - курсор (start_ms, id) последней полученной реплики. Возвращает
+        списки в порядке UTTERANCE_FIELDS и курсор следующей страницы (или None).
+        """
+        query = (
+            "SELECT start_ms, end_ms, speaker, text, id FROM segments "
+            "WHERE transcript_id = ? AND kind = 'utterance' AND end_ms > ?"
+        )
+        params = [transcript_id, start_ms]
+        if end_ms is not None:
+            query += " AND start_ms < ?"
+            params.append(end_ms)
+        if after is not None:
+            query += " AND (start_ms > ? OR (start_ms = ? AND id > ?))"
+            params.extend([after[0], after[0], after[1]])
+        with self._connect() as conn:
+            rows = conn.execute(query + " ORDER BY start_ms, id LIMIT ?", (*params, limit)).fetchall()
+        next_cursor = (rows[-1][0], rows[-1][4]) if len(rows) == limit else None
+        return [list(row[:4]) for row in rows], next_cursor
+    
+    def iter_timeline(self, transcript_id, page_size=TRANSCRIPT_PAGE_MAX_UTTERANCES):
+        """Реплики транскрипта по порядку: (start, end, speaker, text, words), words - массивы или None.
         
-        if entity_text and entity_text not in entity_groups[entity_type]:
-            entity_groups[entity_type].append(entity_text)
+        Читается страницами по page_size с курсором, поэтому память не зависит от длины записи.
+        Транскрипт без реплик отдаётся одним сегментом без временных меток.
+        """
+        after = None
+        while True:
+            query = (
+                "SELECT s.start_ms, s.end_ms, s.speaker, s.text, w.starts, w.ends, w.offsets, s.id "
+                "FROM segments s LEFT JOIN segment_words w ON w.segment_id = s.id "
+                "WHERE s.transcript_id = ? AND s.kind = 'utterance'"
+            )
+            params = [transcript_id]
+            if after is not None:
+                query += " AND (s.start_ms > ? OR (s.start_ms = ? AND s.id > ?))"
+                params.extend([after[0], after[0], after[1]])
+            with self._connect() as conn:
+                rows = conn.execute(query + " ORDER BY s.start_ms, s.id LIMIT ?", (*params, page_size)).fetchall()
+                if after is None and not rows:
+                    rows = conn.execute(
+                        "SELECT NULL, NULL, NULL, text, NULL, NULL, NULL, id FROM segments "
+                        "WHERE transcript_id = ? AND kind = 'transcript'", (transcript_id,)
+                    ).fetchall()
+            for start, end, speaker, text, starts, ends, offsets, _ in rows:
+                words = None
+                if starts is not None:
+                    words = tuple(array("i", column) for column in (starts, ends, offsets))
+                yield start, end, speaker, text, words
+            if len(rows) < page_size or rows[-1][0] is None:
+                return
+            after = (rows[-1][0], rows[-1][7])
     
-    return entity_groups
-
-def get_transcription_features(transcription_method):
-    """Возвращает список доступных функций в зависимости от метода"""
-    if transcription_method == "auto_detection_summary":
-        return [
-            "🎙️ Лучшая модель транскрипции",
-            "🌍 Автообнаружение языка",
-            "👥 Определение спикеров", 
-            "💡 Ключевые моменты",
-            "🎭 Анализ тональности",
-            "🏷️ Определение сущностей",
-            "🤖 Встроенное резюме",
-            "🧠 Умное резюме Claude",
-            "🛡️ Модерация контента",
-            "📊 Категоризация тем"
-        ]
-    elif transcription_method == "auto_detection_chapters":
+    def exists(self, transcript_id):
+        with self._connect() as conn:
+            return conn.execute("SELECT 1 FROM transcripts WHERE id = ?", (transcript_id,)).fetchone() is not None
+    
+    def search_text(self, query, limit=SEARCH_DEFAULT_LIMIT):
+        """Реплики и резюме, подходящие под запрос, по релевантности (bm25)"""
+        fts_query = _fts_query(query)
+        if not fts_query:
+            return []
+        with self._connect() as conn:
+            rows = conn.execute(
+                "SELECT s.transcript_id, t.filename, t.created_at, s.kind, s.start_ms, s.speaker, "
+                "snippet(segments_fts, 0, '<mark>', '</mark>', '…', 16) "
+                "FROM segments_fts JOIN segments s ON s.id = segments_fts.rowid "
+                "JOIN transcripts t ON t.id = s.transcript_id "
+                "WHERE segments_fts MATCH ? ORDER BY bm25(segments_fts) LIMIT ?",
+                (fts_query, limit)
+            ).fetchall()
         return [
-            "🎙️ Лучшая модель транскрипции",
-            "🌍 Автообнаружение языка",
-            "👥 Определение спикеров", 
-            "📚 Автоматические главы",
-            "💡 Ключевые моменты",
-            "🎭 Анализ тональности",
-            "🏷️ Определение сущностей",
-            "🧠 Умное резюме Claude",
-            "🛡️ Модерация контента",
-            "📊 Категоризация тем"
+            {
+                "transcript_id": transcript_id,
+                "filename": filename,
+                "created_at": created_at,
+                "kind": kind,
+                "start_time": f"{start_ms / 1000 / 60:.1f}min" if start_ms is not None else None,
+                "speaker": speaker,
+                "snippet": snippet,
+            }
+            for transcript_id, filename, created_at, kind, start_ms, speaker, snippet in rows
         ]
-    else:
+    
+    def search_entities(self, text, entity_type=None, limit=SEARCH_DEFAULT_LIMIT):
+        """Транскрипты, где упоминается сущность (по началу названия, без учёта регистра)"""
+        key = text.strip().casefold()
+        if not key:
+            return []
+        query = (
+            "SELECT e.transcript_id, t.filename, t.created_at, e.entity_type, e.text "
+            "FROM entities e JOIN transcripts t ON t.id = e.transcript_id "
+            "WHERE e.text_key >= ? AND e.text_key < ?"
+        )
+        params = [key, key + "\U0010ffff"]
+        if entity_type:
+            query += " AND e.entity_type = ?"
+            params.append(entity_type)
+        with self._connect() as conn:
+            rows = conn.execute(query + " ORDER BY t.created_at DESC LIMIT ?", (*params, limit)).fetchall()
         return [
-            "🎙️ Лучшая модель транскрипции",
-            "🇷🇺 Русский язык",
-            "👥 Определение спикеров",
-            "🏷️ Определение сущностей",
-            "🧠 Умное резюме Claude"
+            {"transcript_id": transcript_id, "filename": filename, "created_at": created_at, "entity_type": found_type, "entity": found_text}
+            for transcript_id, filename, created_at, found_type, found_text in rows
         ]
+    
+    def count(self):
+        with self._connect() as conn:
+            return conn.execute("SELECT COUNT(*) FROM transcripts").fetchone()[0]
 
-# === Обработчик сигналов ===
-def signal_handler(signum, frame):
-    logger.info("🛑 Получен сигнал завершения, очищаем ресурсы...")
-    # Очистка временных файлов
-    import shutil
-    try:
-        if os.path.exists(TEMP_DIR):
-            shutil.rmtree(TEMP_DIR)
-    except:
-        pass
-    sys.exit(0)
+transcript_store = TranscriptStore(TRANSCRIPT_STORE_PATH) if TRANSCRIPT_STORE_ENABLED else None
 
-signal.signal(signal.SIGTERM, signal_handler)
-signal.signal(signal.SIGINT, signal_handler)
+@timed_stage("upload")
+def upload_audio(file_path, count_job=True):
+    """Загружает файл в AssemblyAI один раз и возвращает URL загрузки"""
+    file_size = os.path.getsize(file_path)
+    upload_start = time.time()
+    audio_url = aai.Transcriber(client=assemblyai_client).upload_file(file_path)
+    record_upload(file_size, count_job)
+    logger.info(f"📤 Файл загружен в AssemblyAI за {time.time() - upload_start:.1f}с ({file_size / 1024 / 1024:.1f} MB)")
+    return audio_url
 
-# === Маршруты ===
+# Транскрипции в AssemblyAI одновременно во всех воркерах (гонка стратегий и сегменты тоже считаются)
+UPSTREAM_MAX_TRANSCRIPTIONS = int(os.environ.get("UPSTREAM_MAX_TRANSCRIPTIONS", 32))
+SHARED_SLOT_POLL_SECONDS = 0.5  # как часто ждущий слот проверяет, не освободили ли его другие воркеры
 
-@app.route("/")
-def index():
-    return render_template("index.html")
+class SharedSlots:
+    """Семафор с лимитом на все воркеры: занятые слоты каждого процесса хранятся
+    в общем хранилище (state_store.worker_usage), освобождённые в своём процессе
+    будят ожидающих сразу, в чужих - замечаются через SHARED_SLOT_POLL_SECONDS."""
+    
+    def __init__(self, resource, limit):
+        self.resource = resource
+        self.limit = limit
+        self.in_use = 0
+        self.condition = threading.Condition()
+    
+    def _try_acquire(self):
+        with state_store.worker_usage() as (others, own):
+            if self.in_use + others[self.resource] >= self.limit:
+                return False
+            self.in_use += 1
+            own[self.resource] = self.in_use
+        return True
+    
+    def acquire(self, blocking=True, timeout=None):
+        deadline = None if timeout is None else time.monotonic() + timeout
+        with self.condition:
+            while not self._try_acquire():
+                wait = SHARED_SLOT_POLL_SECONDS if deadline is None else min(deadline - time.monotonic(), SHARED_SLOT_POLL_SECONDS)
+                if not blocking or wait <= 0:
+                    return False
+                self.condition.wait(wait)
+        return True
+    
+    def release(self):
+        with self.condition:
+            with state_store.worker_usage() as (others, own):
+                self.in_use -= 1
+                own[self.resource] = self.in_use
+            self.condition.notify()
 
-@app.route("/health")
-def health():
+upstream_transcriptions = SharedSlots("upstream_transcriptions", UPSTREAM_MAX_TRANSCRIPTIONS)
+
+class TranscriptionCancelled(RuntimeError):
+    """Транскрипция остановлена, потому что победила более приоритетная стратегия"""
+
+@contextmanager
+def upstream_transcription_slot(cancel_event=None):
+    """Ограничивает число транскрипций, одновременно идущих в AssemblyAI, по всему процессу"""
+    while not upstream_transcriptions.acquire(timeout=aai.settings.polling_interval):
+        if cancel_event is not None and cancel_event.is_set():
+            raise TranscriptionCancelled("Транскрипция больше не нужна")
+    try:
+        yield
+    finally:
+        upstream_transcriptions.release()
+
+def run_transcription(audio_url, config, cancel_event=None):
+    """Запускает транскрипцию уже загруженного аудио с заданной конфигурацией.
+    
+    С cancel_event опрос статуса идёт вручную и прекращается, как только событие установлено.
+    """
+    with upstream_transcription_slot(cancel_event):
+        transcriber = aai.Transcriber(client=assemblyai_client, config=config)
+        if cancel_event is None:
+            return transcriber.transcribe(audio_url)
+        
+        transcript = transcriber.submit(audio_url)
+        while transcript.status not in (aai.TranscriptStatus.completed, aai.TranscriptStatus.error):
+            if cancel_event.wait(aai.settings.polling_interval):
+                raise TranscriptionCancelled(f"Транскрипция {transcript.id} больше не нужна")
+            transcript = fetch_transcript(transcript.id)
+        return transcript
+
+def fetch_transcript(transcript_id):
+    """Один запрос статуса транскрипции (Transcript.get_by_id ждёт завершения)"""
+    response = aai.api.get_transcript(assemblyai_client.http_client, transcript_id)
+    return aai.Transcript.from_response(client=assemblyai_client, response=response)
+
+# === Стратегии транскрипции (в порядке приоритета) ===
+TRANSCRIPTION_STRATEGIES = [
+    {
+        "method": "russian_limited_features",
+        "config": get_transcription_config_russian,
+        "title": "русский язык",
+        "start_message": "🇷🇺 Пробую русский язык (рекомендуется для русского контента)...",
+        "success_message": "✅ Транскрипция на русском успешна!",
+        "min_text_length": 10,
+    },
+    {
+        "method": "auto_detection_summary",
+        "config": get_transcription_config_auto,
+        "title": "авто-резюме",
+        "start_message": "🌍 Пробую автообнаружение языка с резюме...",
+        "success_message": "✅ Транскрипция с автообнаружением (резюме) успешна!",
+        "min_text_length": 0,
+    },
+    {
+        "method": "auto_detection_chapters",
+        "config": get_transcription_config_auto_chapters,
+        "title": "авто-главы",
+        "start_message": "🌍 Пробую автообнаружение языка с главами...",
+        "success_message": "✅ Транскрипция с автообнаружением (главы) успешна!",
+        "min_text_length": 0,
+    },
+]
+
+# sequential - стратегии по очереди; race - все сразу, победитель по приоритету
+TRANSCRIPTION_MODE = os.environ.get("TRANSCRIPTION_MODE", "sequential")
+
+STRATEGIES_BY_METHOD = {strategy["method"]: strategy for strategy in TRANSCRIPTION_STRATEGIES}
+
+def check_strategy_result(strategy, transcript):
+    """Проверяет завершённую транскрипцию стратегии; при неудаче - RuntimeError"""
+    if transcript.status == aai.TranscriptStatus.error:
+        raise RuntimeError(f"Ошибка ({strategy['title']}): {transcript.error}")
+    
+    # Проверяем качество транскрипции
+    min_length = strategy["min_text_length"]
+    if min_length and not (transcript.text and len(transcript.text.strip()) > min_length):
+        raise RuntimeError("Пустая транскрипция")
+
+def record_strategy_outcome(strategy, seconds, outcome, features=None):
+    """Метрики попытки; с признаками входа исход попадает и в статистику планировщика"""
+    metrics.observe("voicesum_strategy_seconds", seconds, strategy=strategy["method"], outcome=outcome)
+    metrics.inc("voicesum_strategy_attempts_total", strategy=strategy["method"], outcome=outcome)
+    if strategy_scheduler and features and outcome != "cancelled":
+        strategy_scheduler.record(features, strategy["method"], outcome == "success", seconds)
+
+def run_strategy(strategy, audio_url, cancel_event=None, features=None):
+    """Выполняет одну стратегию и проверяет качество результата"""
+    started = time.time()
+    outcome = "failure"
+    try:
+        transcript = run_transcription(audio_url, strategy["config"](), cancel_event)
+        check_strategy_result(strategy, transcript)
+        outcome = "success"
+        return transcript
+    except TranscriptionCancelled:
+        outcome = "cancelled"
+        raise
+    finally:
+        record_strategy_outcome(strategy, time.time() - started, outcome, features)
+
+def _transcribe_sequential(audio_url, strategies, features=None):
+    """Пробует стратегии по очереди до первой успешной"""
+    errors = []
+    for strategy in strategies:
+        try:
+            logger.info(strategy["start_message"])
+            transcript = run_strategy(strategy, audio_url, features=features)
+            logger.info(strategy["success_message"])
+            return transcript, strategy["method"]
+        except Exception as e:
+            logger.warning(f"⚠️ Стратегия '{strategy['title']}' не сработала: {e}")
+            errors.append(f"{strategy['title']}({e})")
+    
+    logger.error(f"❌ Все методы не сработали: {', '.join(errors)}")
+    raise RuntimeError("Не удалось транскрибировать файл всеми доступными методами")
+
+def _transcribe_race(audio_url, strategies, features=None):
+    """Запускает все стратегии одновременно и выбирает победителя по приоритету.
+    
+    Результат стратегии принимается, как только все более приоритетные стратегии
+    завершились неудачей; оставшиеся стратегии отменяются.
+    """
+    cancel_event = threading.Event()
+    executor = ThreadPoolExecutor(max_workers=len(strategies), thread_name_prefix="voicesum-race")
+    logger.info(f"🏁 Запускаю {len(strategies)} стратегии параллельно...")
+    futures = [executor.submit(run_strategy, strategy, audio_url, cancel_event, features) for strategy in strategies]
+    
+    errors = []
+    try:
+        for strategy, future in zip(strategies, futures):
+            try:
+                transcript = future.result()
+                logger.info(f"{strategy['success_message']} (параллельный режим)")
+                return transcript, strategy["method"]
+            except Exception as e:
+                logger.warning(f"⚠️ Стратегия '{strategy['title']}' не сработала: {e}")
+                errors.append(f"{strategy['title']}({e})")
+    finally:
+        # Проигравшие стратегии больше не опрашиваем
+        cancel_event.set()
+        executor.shutdown(wait=False, cancel_futures=True)
+    
+    logger.error(f"❌ Все методы не сработали: {', '.join(errors)}")
+    raise RuntimeError("Не удалось транскрибировать файл всеми доступными методами")
+
+# === Адаптивный выбор стратегии ===
+# Исходы стратегий копятся по признакам входа (заявленный язык, тип файла, длительность,
+# отправитель), и для нового файла первой пробуется стратегия, которая на похожих
+# файлах чаще и быстрее всего завершалась успешно.
+ADAPTIVE_STRATEGIES_ENABLED = os.environ.get("ADAPTIVE_STRATEGIES_ENABLED", "1") == "1"
+STRATEGY_STATS_PATH = os.environ.get("STRATEGY_STATS_PATH", os.path.join(tempfile.gettempdir(), "voicesum_strategies.sqlite3"))
+STRATEGY_MIN_SAMPLES = int(os.environ.get("STRATEGY_MIN_SAMPLES", 5))  # попыток, после которых статистике верим
+STRATEGY_SKIP_BELOW = float(os.environ.get("STRATEGY_SKIP_BELOW", 0.05))  # доля успехов, ниже которой стратегию не пробуем
+STRATEGY_EXPLORE_RATE = float(os.environ.get("STRATEGY_EXPLORE_RATE", 0.05))  # доля файлов в исходном порядке
+STRATEGY_STATS_DEFAULT_LIMIT = 50
+STRATEGY_STATS_MAX_LIMIT = 1000
+UPLOADER_HEADER = "X-Uploader-ID"
+
+# Уровни признаков от общего к частному: оценка стратегии берётся с самого точного
+# уровня, где набралось STRATEGY_MIN_SAMPLES попыток
+STRATEGY_FEATURE_LEVELS = (
+    (),
+    ("language",),
+    ("language", "file_type"),
+    ("language", "file_type", "duration"),
+    ("language", "file_type", "duration", "uploader"),
+)
+DURATION_BUCKETS = ((300, "<5m"), (1800, "5-30m"), (5400, "30-90m"))
+
+metrics.describe("voicesum_strategy_decisions_total", "counter", "Выбор порядка стратегий по типу решения")
+
+def duration_bucket(seconds):
+    for limit, label in DURATION_BUCKETS:
+        if seconds < limit:
+            return label
+    return ">90m"
+
+def get_client_hints(form, uploader=None):
+    """Подсказки клиента для выбора стратегии: заявленный язык и отправитель"""
+    return {
+        "language": form.get("language"),
+        "uploader": form.get("uploader") or uploader,
+    }
+
+def describe_input(file_path, file_size, hints=None):
+    """Признаки входного файла, по которым копится статистика стратегий"""
+    hints = hints or {}
+    try:
+        duration = get_audio_duration(file_path)
+    except (OSError, subprocess.SubprocessError):
+        duration = None
+    if duration is None:
+        duration = file_size / 1024 / 1024 * 60  # грубо: ~1 MB на минуту
+    
+    return {
+        "language": (hints.get("language") or "").strip().lower()[:8] or "any",
+        "file_type": os.path.splitext(file_path)[1].lstrip(".").lower()[:8] or "unknown",
+        "duration": duration_bucket(duration),
+        "uploader": (hints.get("uploader") or "").strip()[:64] or "anonymous",
+    }
+
+class StrategyStatsStore(SQLiteStore):
+    """Счётчики исходов стратегий по уровням признаков (scope) в SQLite"""
+    
+    SCHEMA = (
+        "CREATE TABLE IF NOT EXISTS strategy_outcomes ("
+        "scope TEXT NOT NULL, method TEXT NOT NULL, successes INTEGER NOT NULL, "
+        "failures INTEGER NOT NULL, seconds REAL NOT NULL, updated_at REAL NOT NULL, "
+        "PRIMARY KEY (scope, method))",
+    )
+    
+    def record(self, scopes, method, success, seconds):
+        now = time.time()
+        with self._connect() as conn:
+            conn.executemany(
+                "INSERT INTO strategy_outcomes VALUES (?, ?, ?, ?, ?, ?) "
+                "ON CONFLICT (scope, method) DO UPDATE SET "
+                "successes = successes + excluded.successes, failures = failures + excluded.failures, "
+                "seconds = seconds + excluded.seconds, updated_at = excluded.updated_at",
+                [(scope, method, int(success), int(not success), seconds, now) for scope in scopes]
+            )
+    
+    def load(self, scopes):
+        """{(scope, method): (успехи, неудачи, секунды)} для перечисленных scope"""
+        placeholders = ", ".join("?" * len(scopes))
+        with self._connect() as conn:
+            rows = conn.execute(
+                "SELECT scope, method, successes, failures, seconds FROM strategy_outcomes "
+                f"WHERE scope IN ({placeholders})", scopes
+            ).fetchall()
+        return {(scope, method): (successes, failures, seconds) for scope, method, successes, failures, seconds in rows}
+    
+    def top(self, limit):
+        """Самые наблюдаемые пары (scope, стратегия)"""
+        with self._connect() as conn:
+            return conn.execute(
+                "SELECT scope, method, successes, failures, seconds FROM strategy_outcomes "
+                "ORDER BY successes + failures DESC, scope LIMIT ?", (limit,)
+            ).fetchall()
+
+class StrategyScheduler:
+    """Порядок стратегий по накопленной статистике.
+    
+    Стратегии сортируются по отношению доли успехов к среднему времени попытки -
+    такой порядок минимизирует ожидаемое время до первого успеха. Стратегии, которые
+    на похожих файлах почти никогда не срабатывают, пропускаются. Небольшая доля
+    файлов обрабатывается в исходном порядке, чтобы статистика не застывала.
+    """
+    
+    def __init__(self, store):
+        self.store = store
+        self.lock = threading.Lock()
+        self.decisions = Counter()
+        self.attempts = 0
+    
+    @staticmethod
+    def scopes(features):
+        """Ключи уровней признаков, от общего к частному"""
+        return [
+            "|".join(f"{name}={features[name]}" for name in level) or "*"
+            for level in STRATEGY_FEATURE_LEVELS
+        ]
+    
+    @staticmethod
+    def _estimate(rows, scopes, method):
+        """Оценка стратегии с самого точного уровня, где хватает попыток, или None"""
+        for scope in reversed(scopes):
+            successes, failures, seconds = rows.get((scope, method), (0, 0, 0.0))
+            attempts = successes + failures
+            if attempts >= STRATEGY_MIN_SAMPLES:
+                return {"scope": scope, "attempts": attempts, "successes": successes, "avg_seconds": seconds / attempts}
+        return None
+    
+    def order(self, features, pipeline_info):
+        """Стратегии в порядке попыток для файла с этими признаками"""
+        strategies = list(TRANSCRIPTION_STRATEGIES)
+        estimates = {}
+        skipped = []
+        
+        if random.random() < STRATEGY_EXPLORE_RATE:
+            decision = "explore"
+        else:
+            scopes = self.scopes(features)
+            rows = self.store.load(scopes)
+            estimates = {strategy["method"]: self._estimate(rows, scopes, strategy["method"]) for strategy in strategies}
+            known = [estimate for estimate in estimates.values() if estimate]
+            decision = "adaptive" if known else "default"
+        
+        if decision == "adaptive":
+            default_seconds = sum(estimate["avg_seconds"] for estimate in known) / len(known)
+            
+            def score(strategy):
+                estimate = estimates[strategy["method"]]
+                if estimate is None:
+                    return 0.5 / max(default_seconds, 1.0)
+                success_rate = (estimate["successes"] + 1) / (estimate["attempts"] + 2)
+                return success_rate / max(estimate["avg_seconds"], 1.0)
+            
+            # sorted устойчив: при равных оценках сохраняется исходный приоритет
+            strategies = sorted(strategies, key=score, reverse=True)
+            skipped = [
+                strategy for strategy in strategies[1:]
+                if estimates[strategy["method"]]
+                and estimates[strategy["method"]]["successes"] / estimates[strategy["method"]]["attempts"] < STRATEGY_SKIP_BELOW
+            ]
+            strategies = [strategy for strategy in strategies if strategy not in skipped]
+        
+        with self.lock:
+            self.decisions[decision] += 1
+        metrics.inc("voicesum_strategy_decisions_total", decision=decision)
+        pipeline_info["strategy_selection"] = {
+            "decision": decision,
+            "features": features,
+            "order": [strategy["method"] for strategy in strategies],
+            "skipped": [strategy["method"] for strategy in skipped],
+            "estimates": {method: estimate for method, estimate in estimates.items() if estimate},
+        }
+        logger.info(f"🧭 Порядок стратегий ({decision}): {', '.join(pipeline_info['strategy_selection']['order'])}")
+        return strategies
+    
+    def record(self, features, method, success, seconds):
+        with self.lock:
+            self.attempts += 1
+        try:
+            self.store.record(self.scopes(features), method, success, seconds)
+        except sqlite3.Error as e:
+            logger.warning(f"⚠️ Не удалось сохранить исход стратегии: {e}")
+    
+    def get_stats(self, limit=STRATEGY_STATS_DEFAULT_LIMIT):
+        with self.lock:
+            decisions = dict(self.decisions)
+            attempts = self.attempts
+        total_decisions = sum(decisions.values())
+        return {
+            "enabled": True,
+            "min_samples": STRATEGY_MIN_SAMPLES,
+            "skip_below": STRATEGY_SKIP_BELOW,
+            "explore_rate": STRATEGY_EXPLORE_RATE,
+            "decisions": decisions,
+            "attempts": attempts,
+            "attempts_per_job": round(attempts / total_decisions, 3) if total_decisions else None,
+            "scopes": [
+                {
+                    "scope": scope,
+                    "method": method,
+                    "attempts": successes + failures,
+                    "success_rate": round(successes / (successes + failures), 3),
+                    "avg_seconds": round(seconds / (successes + failures), 2),
+                }
+                for scope, method, successes, failures, seconds in self.store.top(limit)
+            ],
+        }
+
+strategy_scheduler = StrategyScheduler(StrategyStatsStore(STRATEGY_STATS_PATH)) if ADAPTIVE_STRATEGIES_ENABLED else None
+
+def plan_strategies(audio_path, features, pipeline_info):
+    """Порядок стратегий для файла: по статистике, затем с учётом определения языка"""
+    strategies = TRANSCRIPTION_STRATEGIES
+    if strategy_scheduler and features:
+        strategies = strategy_scheduler.order(features, pipeline_info)
+    if LANGUAGE_DETECTION_ENABLED:
+        strategies = detect_strategy_order(audio_path, pipeline_info, strategies)
+    return strategies
+
+# === Предобработка аудио (ffmpeg) ===
+FFMPEG_BINARY = os.environ.get("FFMPEG_BINARY", "ffmpeg")
+AUDIO_NORMALIZATION_ENABLED = os.environ.get("AUDIO_NORMALIZATION_ENABLED", "0") == "1"
+AUDIO_NORMALIZATION_FORMAT = os.environ.get("AUDIO_NORMALIZATION_FORMAT", "opus")
+
+# Формат -> (расширение, параметры кодека); речь: моно 16 кГц
+AUDIO_NORMALIZATION_CODECS = {
+    "opus": ("ogg", ["-c:a", "libopus", "-b:a", "32k", "-application", "voip"]),
+    "flac": ("flac", ["-c:a", "flac"]),
+}
+
+@timed_stage("normalize")
+def normalize_audio(file_path, pipeline_info):
+    """Перекодирует загрузку в компактный речевой формат и убирает видеодорожки.
+    
+    Возвращает путь к новому файлу или исходный путь, если перекодирование
+    не удалось или не уменьшило размер.
+    """
+    extension, codec_args = AUDIO_NORMALIZATION_CODECS[AUDIO_NORMALIZATION_FORMAT]
+    output_path = f"{os.path.splitext(file_path)[0]}_normalized.{extension}"
+    size_before = os.path.getsize(file_path)
+    transcode_start = time.time()
+    
+    try:
+        subprocess.run(
+            [
+                FFMPEG_BINARY, "-hide_banner", "-loglevel", "error", "-y",
+                "-i", file_path,
+                "-vn", "-sn", "-dn", "-ac", "1", "-ar", "16000",
+                *codec_args,
+                output_path,
+            ],
+            check=True, capture_output=True, timeout=1800,
+        )
+    except Exception as e:
+        logger.warning(f"⚠️ Не удалось перекодировать аудио, загружаем исходный файл: {e}")
+        if os.path.exists(output_path):
+            os.remove(output_path)
+        pipeline_info["normalization"] = {"error": str(e)[:200]}
+        return file_path
+    
+    size_after = os.path.getsize(output_path)
+    transcode_time = time.time() - transcode_start
+    used = size_after < size_before
+    logger.info(
+        f"🎚️ Перекодирование в {AUDIO_NORMALIZATION_FORMAT}: {size_before / 1024 / 1024:.1f} MB → "
+        f"{size_after / 1024 / 1024:.1f} MB за {transcode_time:.1f}с"
+    )
+    pipeline_info["normalization"] = {
+        "format": AUDIO_NORMALIZATION_FORMAT,
+        "size_before": f"{size_before / 1024 / 1024:.1f}MB",
+        "size_after": f"{size_after / 1024 / 1024:.1f}MB",
+        "compression_ratio": round(size_before / size_after, 1) if size_after else None,
+        "transcode_time": f"{transcode_time:.1f}s",
+        "used": used,
+    }
+    
+    if not used:
+        os.remove(output_path)
+        return file_path
+    return output_path
+
+# === Предварительное определение языка ===
+LANGUAGE_DETECTION_ENABLED = os.environ.get("LANGUAGE_DETECTION_ENABLED", "0") == "1"
+LANGUAGE_DETECTOR = os.environ.get("LANGUAGE_DETECTOR", "assemblyai")
+LANGUAGE_PROBE_SECONDS = int(os.environ.get("LANGUAGE_PROBE_SECONDS", 30))
+
+# Язык -> стратегия, которую пробуем первой; для остальных языков - автообнаружение
+LANGUAGE_STRATEGY_MAP = {
+    "ru": "russian_limited_features",
+}
+DEFAULT_DETECTED_STRATEGY = "auto_detection_summary"
+
+def extract_audio_probe(file_path, seconds):
+    """Вырезает первые N секунд в моно 16 кГц FLAC через ffmpeg"""
+    probe_path = f"{os.path.splitext(file_path)[0]}_probe.flac"
+    subprocess.run(
+        [
+            FFMPEG_BINARY, "-hide_banner", "-loglevel", "error", "-y",
+            "-i", file_path, "-t", str(seconds),
+            "-vn", "-ac", "1", "-ar", "16000", "-c:a", "flac",
+            probe_path,
+        ],
+        check=True, capture_output=True, timeout=120,
+    )
+    return probe_path
+
+class AssemblyAILanguageDetector:
+    """Дешёвая проба: модель nano с автоопределением языка на коротком фрагменте"""
+    
+    name = "assemblyai"
+    
+    def detect(self, probe_path):
+        """Возвращает (код языка, уверенность) или (None, 0.0)"""
+        audio_url = aai.Transcriber(client=assemblyai_client).upload_file(probe_path)
+        record_upload(os.path.getsize(probe_path), count_job=False)
+        
+        config = aai.TranscriptionConfig(speech_model=aai.SpeechModel.nano, language_detection=True)
+        transcript = run_transcription(audio_url, config)
+        if transcript.status == aai.TranscriptStatus.error:
+            raise RuntimeError(f"Ошибка пробы: {transcript.error}")
+        
+        response = transcript.json_response or {}
+        return response.get("language_code"), response.get("language_confidence") or 0.0
+
+LANGUAGE_DETECTORS = {
+    AssemblyAILanguageDetector.name: AssemblyAILanguageDetector,
+}
+
+def register_language_detector(detector_class):
+    """Регистрирует дополнительный детектор языка (выбирается через LANGUAGE_DETECTOR)"""
+    LANGUAGE_DETECTORS[detector_class.name] = detector_class
+
+@timed_stage("language_detection")
+def detect_strategy_order(file_path, pipeline_info, strategies=TRANSCRIPTION_STRATEGIES):
+    """Определяет язык по началу записи и ставит подходящую стратегию первой"""
+    detection_start = time.time()
+    probe_path = None
+    try:
+        probe_path = extract_audio_probe(file_path, LANGUAGE_PROBE_SECONDS)
+        detector = LANGUAGE_DETECTORS[LANGUAGE_DETECTOR]()
+        language, confidence = detector.detect(probe_path)
+    except Exception as e:
+        logger.warning(f"⚠️ Не удалось определить язык заранее: {e}")
+        pipeline_info["language_detection"] = {
+            "detector": LANGUAGE_DETECTOR,
+            "error": str(e)[:200],
+            "detection_time": f"{time.time() - detection_start:.2f}s",
+        }
+        return strategies
+    finally:
+        if probe_path and os.path.exists(probe_path):
+            os.remove(probe_path)
+    
+    chosen = LANGUAGE_STRATEGY_MAP.get(language, DEFAULT_DETECTED_STRATEGY)
+    detection_time = time.time() - detection_start
+    logger.info(f"🔎 Язык пробы: {language} ({confidence:.2f}), выбрана стратегия {chosen} за {detection_time:.1f}с")
+    
+    pipeline_info["language_detection"] = {
+        "detector": LANGUAGE_DETECTOR,
+        "language": language,
+        "confidence": confidence,
+        "chosen_strategy": chosen,
+        "detection_time": f"{detection_time:.2f}s",
+    }
+    # Выбранная стратегия первой, остальные остаются запасными в прежнем порядке
+    return sorted(strategies, key=lambda strategy: strategy["method"] != chosen)
+
+def _ignore_event(event, data):
+    """Обработчик событий конвейера по умолчанию"""
+
+# === Длинные записи: параллельная транскрипция сегментов ===
+CHUNKED_TRANSCRIPTION_ENABLED = os.environ.get("CHUNKED_TRANSCRIPTION_ENABLED", "0") == "1"
+CHUNK_MIN_DURATION = int(os.environ.get("CHUNK_MIN_DURATION", 3600))  # секунды
+CHUNK_SEGMENT_SECONDS = int(os.environ.get("CHUNK_SEGMENT_SECONDS", 900))
+CHUNK_OVERLAP_SECONDS = float(os.environ.get("CHUNK_OVERLAP_SECONDS", 5))
+CHUNK_SILENCE_SEARCH_SECONDS = int(os.environ.get("CHUNK_SILENCE_SEARCH_SECONDS", 60))
+CHUNK_PARALLELISM = int(os.environ.get("CHUNK_PARALLELISM", 4))
+
+def get_audio_duration(file_path):
+    """Длительность из заголовка контейнера (ffmpeg -i), в секундах или None"""
+    result = subprocess.run(
+        [FFMPEG_BINARY, "-hide_banner", "-i", file_path],
+        capture_output=True, text=True, timeout=60,
+    )
+    match = re.search(r"Duration: (\d+):(\d+):(\d+(?:\.\d+)?)", result.stderr)
+    if not match:
+        return None
+    hours, minutes, seconds = match.groups()
+    return int(hours) * 3600 + int(minutes) * 60 + float(seconds)
+
+def detect_silences(file_path):
+    """Список пауз (начало, конец) в секундах по фильтру silencedetect"""
+    result = subprocess.run(
+        [
+            FFMPEG_BINARY, "-hide_banner", "-nostats", "-i", file_path,
+            "-vn", "-af", "silencedetect=noise=-35dB:d=0.4", "-f", "null", "-",
+        ],
+        capture_output=True, text=True, timeout=1800,
+    )
+    starts = [float(value) for value in re.findall(r"silence_start: (-?[\d.]+)", result.stderr)]
+    ends = [float(value) for value in re.findall(r"silence_end: ([\d.]+)", result.stderr)]
+    return list(zip(starts, ends))
+
+def plan_segments(duration, silences):
+    """Выбирает точки разреза в паузах рядом с границами сегментов.
+    
+    Каждый сегмент "владеет" интервалом [own_start, own_end) и захватывает
+    CHUNK_OVERLAP_SECONDS с обеих сторон, чтобы не резать слова на границе.
+    """
+    cuts = []
+    target = CHUNK_SEGMENT_SECONDS
+    # Не оставляем слишком короткий последний сегмент
+    while duration - target > CHUNK_SEGMENT_SECONDS * 0.25:
+        candidates = [
+            (start + end) / 2 for start, end in silences
+            if abs((start + end) / 2 - target) <= CHUNK_SILENCE_SEARCH_SECONDS
+        ]
+        cut = min(candidates, key=lambda point: abs(point - target)) if candidates else target
+        cuts.append((cut, bool(candidates)))
+        target = cut + CHUNK_SEGMENT_SECONDS
+    
+    bounds = [0.0] + [cut for cut, _ in cuts] + [duration]
+    segments = []
+    for index in range(len(bounds) - 1):
+        start = max(0.0, bounds[index] - CHUNK_OVERLAP_SECONDS)
+        end = min(duration, bounds[index + 1] + CHUNK_OVERLAP_SECONDS)
+        segments.append({
+            "index": index,
+            "start": start,
+            "end": end,
+            "own_start": bounds[index],
+            "own_end": bounds[index + 1],
+        })
+    return segments, sum(1 for _, aligned in cuts if aligned)
+
+def extract_segment(file_path, segment):
+    """Вырезает сегмент в компактный речевой формат"""
+    extension, codec_args = AUDIO_NORMALIZATION_CODECS[AUDIO_NORMALIZATION_FORMAT]
+    segment_path = f"{os.path.splitext(file_path)[0]}_segment{segment['index']}.{extension}"
+    subprocess.run(
+        [
+            FFMPEG_BINARY, "-hide_banner", "-loglevel", "error", "-y",
+            "-ss", f"{segment['start']:.3f}", "-t", f"{segment['end'] - segment['start']:.3f}",
+            "-i", file_path,
+            "-vn", "-ac", "1", "-ar", "16000", *codec_args,
+            segment_path,
+        ],
+        check=True, capture_output=True, timeout=1800,
+    )
+    return segment_path
+
+def _transcribe_segment(file_path, segment, strategies):
+    """Вырезает, загружает и транскрибирует один сегмент"""
+    segment_path = extract_segment(file_path, segment)
+    try:
+        segment_bytes = os.path.getsize(segment_path)
+        audio_url = upload_audio(segment_path, count_job=False)
+        if TRANSCRIPTION_MODE == "race":
+            transcript, method = _transcribe_race(audio_url, strategies)
+        else:
+            transcript, method = _transcribe_sequential(audio_url, strategies)
+        logger.info(f"🧩 Сегмент {segment['index'] + 1} готов ({method})")
+        return transcript, method, segment_bytes
+    finally:
+        if os.path.exists(segment_path):
+            os.remove(segment_path)
+
+def _next_speaker_label(used_labels):
+    """Первая свободная метка спикера: A..Z, затем S27, S28..."""
+    for code in range(ord("A"), ord("Z") + 1):
+        if chr(code) not in used_labels:
+            return chr(code)
+    index = 27
+    while f"S{index}" in used_labels:
+        index += 1
+    return f"S{index}"
+
+def _match_speakers(segment_words, offset_ms, overlap_end_ms, previous_words, used_labels):
+    """Сопоставляет метки спикеров сегмента с глобальными по словам в зоне перекрытия.
+    
+    previous_words - текст слова -> [(начало в мс, глобальная метка)] из хвоста
+    предыдущего сегмента; слово считается тем же при расхождении не более 0.5с.
+    """
+    votes = Counter()
+    for word in segment_words:
+        start = word.start + offset_ms
+        if start >= overlap_end_ms:
+            break
+        if not word.speaker:
+            continue
+        for previous_start, label in previous_words.get(word.text.lower(), ()):
+            if label and abs(previous_start - start) <= 500:
+                votes[(word.speaker, label)] += 1
+                break
+    
+    speaker_map = {}
+    taken = set()
+    for (local_label, global_label), _ in votes.most_common():
+        if local_label not in speaker_map and global_label not in taken:
+            speaker_map[local_label] = global_label
+            taken.add(global_label)
+    
+    for word in segment_words:
+        if word.speaker and word.speaker not in speaker_map:
+            label = _next_speaker_label(used_labels | taken)
+            speaker_map[word.speaker] = label
+            taken.add(label)
+    return speaker_map
+
+class MergedTranscript:
+    """Транскрипт, собранный из сегментов; повторяет интерфейс aai.Transcript"""
+    
+    def __init__(self, words, utterances, entities, sentiment_analysis, chapters,
+                 auto_highlights, summary, audio_duration, language_code):
+        self.id = None
+        self.status = aai.TranscriptStatus.completed
+        self.error = None
+        self.words = words
+        self.utterances = utterances
+        self.entities = entities
+        self.sentiment_analysis = sentiment_analysis
+        self.chapters = chapters
+        self.auto_highlights = auto_highlights
+        self.summary = summary
+        self.audio_duration = audio_duration
+        self.language_code = language_code
+        self.text = " ".join(word.text for word in words)
+        self.confidence = sum(word.confidence for word in words) / len(words) if words else 0
+        self.json_response = {"language_code": language_code, "audio_duration": audio_duration}
+
+def merge_segment_transcripts(segments, results, duration):
+    """Склеивает сегменты в один транскрипт со сквозными таймкодами и спикерами"""
+    words, utterances, entities, sentiments, chapters, summaries = [], [], [], [], [], []
+    highlights = {}
+    used_labels = set()
+    previous_words = {}
+    languages = Counter()
+    
+    def shift(item, offset_ms, **update):
+        return item.copy(update={"start": item.start + offset_ms, "end": item.end + offset_ms, **update})
+    
+    for segment, (transcript, _, _) in zip(segments, results):
+        offset_ms = int(segment["start"] * 1000)
+        own_start_ms = int(segment["own_start"] * 1000)
+        own_end_ms = int(segment["own_end"] * 1000)
+        
+        def owned(item):
+            middle = (item.start + item.end) // 2 + offset_ms
+            return own_start_ms <= middle < own_end_ms
+        
+        overlap_ms = int(CHUNK_OVERLAP_SECONDS * 1000)
+        segment_words = transcript.words or []
+        speaker_map = _match_speakers(segment_words, offset_ms, own_start_ms + overlap_ms, previous_words, used_labels)
+        used_labels.update(speaker_map.values())
+        
+        # Хвост сегмента (зона перекрытия со следующим) - для сопоставления спикеров
+        previous_words = {}
+        for word in segment_words:
+            label = speaker_map.get(word.speaker)
+            if word.start + offset_ms >= own_end_ms - overlap_ms:
+                previous_words.setdefault(word.text.lower(), []).append((word.start + offset_ms, label))
+            if owned(word):
+                words.append(shift(word, offset_ms, speaker=label))
+        
+        for utterance in transcript.utterances or []:
+            kept = [shift(word, offset_ms, speaker=speaker_map.get(word.speaker)) for word in utterance.words if owned(word)]
+            if kept:
+                utterances.append(utterance.copy(update={
+                    "start": kept[0].start,
+                    "end": kept[-1].end,
+                    "text": " ".join(word.text for word in kept),
+                    "speaker": speaker_map.get(utterance.speaker),
+                    "words": kept,
+                }))
+        
+        entities.extend(shift(entity, offset_ms) for entity in transcript.entities or [] if owned(entity))
+        sentiments.extend(
+            shift(item, offset_ms, speaker=speaker_map.get(item.speaker))
+            for item in transcript.sentiment_analysis or [] if owned(item)
+        )
+        chapters.extend(shift(chapter, offset_ms) for chapter in transcript.chapters or [] if owned(chapter))
+        
+        segment_highlights = transcript.auto_highlights
+        for result in (segment_highlights.results or []) if segment_highlights else []:
+            timestamps = [
+                timestamp.copy(update={"start": timestamp.start + offset_ms, "end": timestamp.end + offset_ms})
+                for timestamp in result.timestamps if owned(timestamp)
+            ]
+            if not timestamps:
+                continue
+            key = result.text.lower()
+            if key in highlights:
+                merged = highlights[key]
+                highlights[key] = merged.copy(update={
+                    "count": merged.count + len(timestamps),
+                    "rank": max(merged.rank, result.rank),
+                    "timestamps": merged.timestamps + timestamps,
+                })
+            else:
+                highlights[key] = result.copy(update={"count": len(timestamps), "timestamps": timestamps})
+        
+        if transcript.summary:
+            summaries.append(transcript.summary.strip())
+        language = (transcript.json_response or {}).get("language_code")
+        if language:
+            languages[language] += 1
+    
+    auto_highlights = None
+    if highlights:
+        auto_highlights = aai.types.AutohighlightResponse(
+            status=aai.types.StatusResult.success,
+            results=sorted(highlights.values(), key=lambda result: result.rank, reverse=True),
+        )
+    
+    return MergedTranscript(
+        words=words,
+        utterances=utterances,
+        entities=entities,
+        sentiment_analysis=sentiments,
+        chapters=chapters,
+        auto_highlights=auto_highlights,
+        summary="\n".join(summaries) or None,
+        audio_duration=int(round(duration)),
+        language_code=languages.most_common(1)[0][0] if languages else None,
+    )
+
+def transcribe_chunked(file_path, duration, strategies, pipeline_info, on_event=_ignore_event):
+    """Режет длинную запись по паузам и транскрибирует сегменты параллельно"""
+    chunking_start = time.time()
+    segments, aligned_cuts = plan_segments(duration, detect_silences(file_path))
+    logger.info(
+        f"✂️ Запись {duration / 60:.0f} мин разбита на {len(segments)} сегментов "
+        f"({aligned_cuts} разрезов по паузам), параллельно {CHUNK_PARALLELISM}"
+    )
+    
+    with ThreadPoolExecutor(max_workers=CHUNK_PARALLELISM, thread_name_prefix="voicesum-segment") as executor:
+        futures = [executor.submit(_transcribe_segment, file_path, segment, strategies) for segment in segments]
+        for done_count, _ in enumerate(as_completed(futures), 1):
+            on_event("segment_done", {"done": done_count, "total": len(segments)})
+        results = [future.result() for future in futures]
+    
+    record_job_upload(sum(segment_bytes for _, _, segment_bytes in results))
+    transcript = merge_segment_transcripts(segments, results, duration)
+    
+    # Метод - самый частый среди сегментов
+    methods = [method for _, method, _ in results]
+    transcription_method = Counter(methods).most_common(1)[0][0]
+    
+    pipeline_info["chunking"] = {
+        "segments": len(segments),
+        "silence_aligned_cuts": aligned_cuts,
+        "cut_points": [f"{segment['own_start'] / 60:.1f}min" for segment in segments[1:]],
+        "parallelism": CHUNK_PARALLELISM,
+        "segment_methods": methods,
+        "transcription_time": f"{time.time() - chunking_start:.1f}s",
+    }
+    return transcript, transcription_method
+
+@timed_stage("transcription")
+def transcribe_with_fallback(file_path, pipeline_info=None, on_event=None, features=None):
+    """Улучшенная транскрипция с множественным fallback.
+    
+    В pipeline_info (если передан) записываются сведения об этапах обработки,
+    on_event(event, data) получает события этапов по мере выполнения,
+    features - признаки входа для адаптивного порядка стратегий (describe_input).
+    """
+    if pipeline_info is None:
+        pipeline_info = {}
+    on_event = on_event or _ignore_event
+    
+    strategies = plan_strategies(file_path, features, pipeline_info)
+    
+    # Длинные записи режем на сегменты и транскрибируем параллельно
+    duration = get_chunked_duration(file_path)
+    if duration:
+        transcript, transcription_method = transcribe_chunked(file_path, duration, strategies, pipeline_info, on_event)
+        on_event("strategy_chosen", {"method": transcription_method})
+        return transcript, transcription_method
+    
+    # Загружаем файл один раз - все стратегии используют один и тот же URL
+    audio_url = upload_audio(file_path)
+    on_event("upload_done", {"bytes": os.path.getsize(file_path)})
+    
+    transcript, transcription_method = transcribe_uploaded(audio_url, strategies, features)
+    on_event("strategy_chosen", {"method": transcription_method})
+    return transcript, transcription_method
+
+def get_chunked_duration(file_path):
+    """Длительность записи, если её нужно транскрибировать по сегментам, иначе None"""
+    if not CHUNKED_TRANSCRIPTION_ENABLED:
+        return None
+    duration = get_audio_duration(file_path)
+    return duration if duration and duration >= CHUNK_MIN_DURATION else None
+
+def transcribe_uploaded(audio_url, strategies, features=None):
+    """Транскрипция уже загруженного аудио стратегиями по порядку или гонкой (TRANSCRIPTION_MODE)"""
+    if TRANSCRIPTION_MODE == "race":
+        return _transcribe_race(audio_url, strategies, features)
+    return _transcribe_sequential(audio_url, strategies, features)
+
+# === Компактная модель транскрипта ===
+# Ответ AssemblyAI переводится в неё один раз сразу после транскрипции: слова хранятся
+# столбцами в array, реплики, главы и сущности - записями со __slots__, повторяющиеся
+# метки (спикеры, типы сущностей, язык) интернируются. Граф объектов SDK после этого
+# не держится до конца обработки, а анализ проходит по каждому полю один раз.
+class Utterance:
+    __slots__ = ("start", "end", "speaker", "text")
+    
+    def __init__(self, start, end, speaker, text):
+        self.start = start
+        self.end = end
+        self.speaker = speaker
+        self.text = text
+
+class Chapter:
+    __slots__ = ("start", "end", "headline", "summary")
+    
+    def __init__(self, start, end, headline, summary):
+        self.start = start
+        self.end = end
+        self.headline = headline
+        self.summary = summary
+
+class Entity:
+    __slots__ = ("entity_type", "text", "start", "end")
+    
+    def __init__(self, entity_type, text, start, end):
+        self.entity_type = entity_type
+        self.text = text
+        self.start = start
+        self.end = end
+
+class Highlight:
+    __slots__ = ("text", "rank", "count", "start")
+    
+    def __init__(self, text, rank, count, start):
+        self.text = text
+        self.rank = rank
+        self.count = count
+        self.start = start
+
+def _intern_label(label):
+    """Метка (спикер, тип, язык) как интернированная строка или None"""
+    if label is None:
+        return None
+    return intern(str(getattr(label, "value", label)))
+
+class CompactTranscript:
+    """Транскрипт для анализа, резюме и хранения.
+    
+    Слова - параллельные массивы: начало и конец (мс), уверенность, индекс спикера
+    в speaker_labels и позиция слова в text (слово = text[offset:offset + length]).
+    """
+    
+    __slots__ = (
+        "text", "language_code", "audio_duration", "confidence", "summary",
+        "word_starts", "word_ends", "word_confidences", "word_speakers", "word_offsets", "word_lengths",
+        "speaker_labels", "utterances", "chapters", "entities", "highlights", "sentiment_counts",
+    )
+    
+    @classmethod
+    def from_transcript(cls, transcript):
+        """Переводит aai.Transcript (или MergedTranscript) в компактную модель"""
+        compact = cls()
+        text = transcript.text or ""
+        compact.text = text
+        if isinstance(transcript, aai.Transcript):
+            # json_response копирует весь ответ через .dict(), поэтому язык берём из разобранного ответа
+            language = transcript._impl.transcript.language_code
+        else:
+            language = transcript.language_code
+        compact.language_code = _intern_label(language) or "unknown"
+        compact.audio_duration = transcript.audio_duration
+        compact.confidence = transcript.confidence or 0
+        compact.summary = transcript.summary
+        
+        speaker_index = {None: 0}
+        compact.speaker_labels = [None]
+        
+        def speaker_id(label):
+            index = speaker_index.get(label)
+            if index is None:
+                index = speaker_index[label] = len(compact.speaker_labels)
+                compact.speaker_labels.append(_intern_label(label))
+            return index
+        
+        compact.word_starts = array("i")
+        compact.word_ends = array("i")
+        compact.word_confidences = array("f")
+        compact.word_speakers = array("H")
+        compact.word_offsets = array("i")
+        compact.word_lengths = array("H")
+        position = 0
+        for word in transcript.words or []:
+            compact.word_starts.append(word.start)
+            compact.word_ends.append(word.end)
+            compact.word_confidences.append(word.confidence or 0.0)
+            compact.word_speakers.append(speaker_id(word.speaker))
+            offset = text.find(word.text, position)
+            if offset >= 0:
+                position = offset + len(word.text)
+            compact.word_offsets.append(offset)
+            compact.word_lengths.append(min(len(word.text), 0xFFFF))
+        
+        compact.utterances = [
+            Utterance(utterance.start, utterance.end, compact.speaker_labels[speaker_id(utterance.speaker)], utterance.text)
+            for utterance in transcript.utterances or []
+        ]
+        compact.chapters = [
+            Chapter(chapter.start, chapter.end, chapter.headline or "", chapter.summary or "")
+            for chapter in transcript.chapters or []
+        ]
+        compact.entities = [
+            Entity(_intern_label(entity.entity_type) or "other", entity.text or "", entity.start, entity.end)
+            for entity in transcript.entities or []
+        ]
+        highlights = transcript.auto_highlights
+        compact.highlights = [
+            Highlight(result.text or "", result.rank or 0, result.count or 0, result.timestamps[0].start if result.timestamps else 0)
+            for result in (highlights.results if highlights else None) or []
+        ]
+        compact.sentiment_counts = Counter(_intern_label(item.sentiment) for item in transcript.sentiment_analysis or [])
+        return compact
+    
+    @property
+    def words_count(self):
+        return len(self.word_starts)
+    
+    @property
+    def speakers_count(self):
+        return len(self.speaker_labels) - 1
+    
+    def word_text(self, index):
+        offset = self.word_offsets[index]
+        return self.text[offset:offset + self.word_lengths[index]] if offset >= 0 else ""
+
+# === Локальное экстрактивное резюме ===
+# Ключевые фразы выбираются из самого транскрипта без внешних вызовов: предложения
+# взвешиваются по TF-IDF и ранжируются по близости к центроиду всего текста (линейно
+# по числу слов, в отличие от попарного графа TextRank). Результат сразу уходит
+# подписчикам задачи, сжимает вход LLM на длинных записях и заменяет умное резюме,
+# если LLM недоступна или не ответила вовремя.
+EXTRACTIVE_SUMMARY_SENTENCES = int(os.environ.get("EXTRACTIVE_SUMMARY_SENTENCES", 8))
+EXTRACTIVE_MAX_SENTENCE_CHARS = 300  # длинные «предложения» без пунктуации режутся по словам
+EXTRACTIVE_STEM_CHARS = 6  # грубая основа слова: русские словоформы совпадают по началу
+EXTRACTIVE_REDUNDANCY = 0.6  # доля общих слов, при которой фраза считается повтором уже выбранной
+EXTRACTIVE_MIN_SCORE_RATIO = 0.2  # фразы слабее этой доли лучшей не выбираются («Да.», «Понятно.»)
+EXTRACTIVE_LINE_OVERHEAD = 20  # символов на таймкод и спикера в строке format_key_sentences
+EXTRACTIVE_STOPWORDS = frozenset("""
+это что как так вот они она оно его её ему ними если или для все всё уже еще ещё там тут был была были
+быть есть нет когда чтобы тоже только который которая которые очень можно нужно просто потому этот эта
+эти того тогда даже тоже себя себе свой где кто чем при про над под без них нас вас вам нам мне меня
+the and that this with for you are was were have has not but they what there just like yeah know think
+about from will would can could our your their its then than them these those been being also
+""".split())
+
+SENTENCE_PATTERN = re.compile(r'[^.!?…]+[.!?…]*')
+TERM_PATTERN = re.compile(r'\w+')
+
+class KeySentence:
+    __slots__ = ("start", "speaker", "text", "score", "terms")
+    
+    def __init__(self, start, speaker, text, score, terms):
+        self.start = start
+        self.speaker = speaker
+        self.text = text
+        self.score = score
+        self.terms = terms
+
+def _split_sentences(text):
+    """(позиция в тексте, предложение) с ограничением длины EXTRACTIVE_MAX_SENTENCE_CHARS"""
+    for match in SENTENCE_PATTERN.finditer(text):
+        raw = match.group()
+        sentence = raw.strip()
+        offset = match.start() + len(raw) - len(raw.lstrip())
+        while len(sentence) > EXTRACTIVE_MAX_SENTENCE_CHARS:
+            cut = sentence.rfind(" ", 0, EXTRACTIVE_MAX_SENTENCE_CHARS)
+            cut = cut if cut > 0 else EXTRACTIVE_MAX_SENTENCE_CHARS
+            yield offset, sentence[:cut]
+            rest = sentence[cut:].lstrip()
+            offset += len(sentence) - len(rest)
+            sentence = rest
+        if sentence:
+            yield offset, sentence
+
+def rank_sentences(transcript):
+    """Предложения CompactTranscript по порядку с весом score (косинус с центроидом TF-IDF).
+    
+    Время и спикер предложения берутся из первого слова, попавшего в него.
+    """
+    sentences, term_counts = [], []
+    document_frequency = Counter()
+    word_index, words_count = 0, transcript.words_count
+    for offset, text in _split_sentences(transcript.text):
+        while word_index < words_count and transcript.word_offsets[word_index] < offset:
+            word_index += 1
+        if word_index < words_count:
+            start = transcript.word_starts[word_index]
+            speaker = transcript.speaker_labels[transcript.word_speakers[word_index]]
+        else:
+            start, speaker = None, None
+        
+        counts = Counter(
+            term[:EXTRACTIVE_STEM_CHARS] for term in TERM_PATTERN.findall(text.lower())
+            if len(term) > 2 and term not in EXTRACTIVE_STOPWORDS
+        )
+        document_frequency.update(counts.keys())
+        sentences.append(KeySentence(start, speaker, text, 0.0, frozenset(counts)))
+        term_counts.append(counts)
+    
+    # Нормированные векторы TF-IDF; центроид - их сумма
+    total = len(sentences)
+    idf = {term: math.log(total / frequency) + 1 for term, frequency in document_frequency.items()}
+    vectors = []
+    centroid = Counter()
+    for counts in term_counts:
+        vector = {term: count * idf[term] for term, count in counts.items()}
+        norm = math.sqrt(sum(weight * weight for weight in vector.values())) or 1.0
+        vector = {term: weight / norm for term, weight in vector.items()}
+        centroid.update(vector)
+        vectors.append(vector)
+    centroid_norm = math.sqrt(sum(weight * weight for weight in centroid.values())) or 1.0
+    
+    for sentence, vector in zip(sentences, vectors):
+        score = sum(weight * centroid[term] for term, weight in vector.items()) / centroid_norm
+        # Короткие реплики («Да.», «Понятно.») почти ничего не сообщают
+        sentence.score = score * min(1.0, len(vector) / 5)
+    return sentences
+
+def select_key_sentences(ranked, max_sentences=None, max_chars=None):
+    """Лучшие предложения из rank_sentences в исходном порядке.
+    
+    Половина бюджета распределяется по равным отрезкам записи, чтобы выборка покрывала
+    её целиком, остальное - по весу; почти повторяющие выбранные фразы пропускаются.
+    """
+    if not ranked:
+        return []
+    if max_sentences is None:
+        # По средней длине предложения, чтобы уложиться в max_chars
+        average_length = sum(len(sentence.text) for sentence in ranked) / len(ranked)
+        max_sentences = max(1, int(max_chars / (average_length + EXTRACTIVE_LINE_OVERHEAD)))
+    max_sentences = min(max_sentences, len(ranked))
+    
+    windows = max(1, max_sentences // 2)
+    window_size = math.ceil(len(ranked) / windows)
+    candidates = [
+        max(range(start, min(start + window_size, len(ranked))), key=lambda index: ranked[index].score)
+        for start in range(0, len(ranked), window_size)
+    ]
+    candidates += sorted(range(len(ranked)), key=lambda index: ranked[index].score, reverse=True)
+    
+    min_score = EXTRACTIVE_MIN_SCORE_RATIO * max(sentence.score for sentence in ranked)
+    selected, used_chars = set(), 0
+    for index in candidates:
+        if len(selected) >= max_sentences:
+            break
+        sentence = ranked[index]
+        if index in selected or not sentence.terms or sentence.score < min_score:
+            continue
+        if max_chars is not None and used_chars + len(sentence.text) + EXTRACTIVE_LINE_OVERHEAD > max_chars:
+            continue
+        if any(
+            len(sentence.terms & ranked[other].terms) > EXTRACTIVE_REDUNDANCY * min(len(sentence.terms), len(ranked[other].terms))
+            for other in selected
+        ):
+            continue
+        selected.add(index)
+        used_chars += len(sentence.text) + EXTRACTIVE_LINE_OVERHEAD
+    return [ranked[index] for index in sorted(selected)]
+
+def extract_key_sentences(transcript):
+    """Ранжирование предложений и черновик резюме по нему: (ranked, key_sentences)"""
+    with metrics.time("voicesum_stage_seconds", stage="summary_extractive"):
+        ranked = rank_sentences(transcript)
+        return ranked, select_key_sentences(ranked, EXTRACTIVE_SUMMARY_SENTENCES)
+
+def format_key_sentences(sentences):
+    """Строки «[1.5мин] спикер: фраза» - для черновика резюме и входа LLM"""
+    lines = []
+    for sentence in sentences:
+        prefix = f"[{sentence.start / 1000 / 60:.1f}мин] " if sentence.start is not None else ""
+        if sentence.speaker:
+            prefix += f"{sentence.speaker}: "
+        lines.append(f"• {prefix}{sentence.text}")
+    return "\n".join(lines)
+
+# === Умный генератор резюме ===
+OPENROUTER_BASE_URL = os.environ.get("OPENROUTER_BASE_URL", "https://openrouter.ai/api/v1")
+SUMMARY_TIMEOUT_SECONDS = 60
+SUMMARY_CHUNK_CHARS = int(os.environ.get("SUMMARY_CHUNK_CHARS", 20000))  # символов транскрипта на один запрос
+SUMMARY_MAP_PARALLELISM = int(os.environ.get("SUMMARY_MAP_PARALLELISM", 4))
+# Транскрипт до SUMMARY_CHUNK_CHARS всегда уходит в LLM целиком. Более длинный при
+# extractive передаётся ключевыми фразами одним запросом, при full - конспектами фрагментов (map-reduce)
+SUMMARY_INPUT_MODE = os.environ.get("SUMMARY_INPUT_MODE", "extractive")
+SUMMARY_EXTRACTIVE_INPUT_CHARS = int(os.environ.get("SUMMARY_EXTRACTIVE_INPUT_CHARS", SUMMARY_CHUNK_CHARS))  # объём ключевых фраз
+
+MAP_SYSTEM_PROMPT = """Ты - профессиональный аналитик аудиоконтента.
+Тебе дан фрагмент {index} из {total} длинного транскрипта (с временными метками и спикерами, если есть).
+
+Составь плотный конспект фрагмента НА РУССКОМ ЯЗЫКЕ: темы с временными метками, участники,
+ключевые инсайты, факты и цифры, эмоциональная тональность, решения и действия, ключевые персоны.
+Не добавляй вступлений и ничего не выдумывай."""
+
+COMBINE_SYSTEM_PROMPT = """Ты - профессиональный аналитик аудиоконтента.
+Объедини конспекты последовательных фрагментов одного транскрипта в один плотный конспект НА РУССКОМ ЯЗЫКЕ.
+Сохрани временные метки, имена, цифры, решения и действия; убери повторы."""
+
+class AdvancedSummarizer:
+    def __init__(self, openrouter_key):
+        # Повторы делает общий транспорт, поэтому встроенные повторы SDK отключены
+        self.client = OpenAI(
+            base_url=OPENROUTER_BASE_URL,
+            api_key=openrouter_key,
+            http_client=create_pooled_http_client(
+                "openrouter", timeout=httpx.Timeout(SUMMARY_TIMEOUT_SECONDS, connect=10)
+            ),
+            max_retries=0
+        ) if openrouter_key else None
+        self._usage_lock = threading.Lock()
+    
+    @timed_stage("summary_smart")
+    def create_smart_summary(self, transcript_result, transcription_method, usage=None, on_token=None, ranked=None):
+        """Создает умное резюме на основе всех данных AssemblyAI.
+        
+        Длинные транскрипты передаются ключевыми фразами (SUMMARY_INPUT_MODE=extractive)
+        или суммируются целиком по схеме map-reduce. В usage (если передан) записываются
+        токены и задержки по этапам, on_token получает фрагменты итогового резюме по мере
+        генерации. ranked - готовый результат rank_sentences, если он уже посчитан.
+        """
+        if not self.client:
+            return self._create_basic_summary(transcript_result, transcription_method, ranked)
+        
+        if usage is None:
+            usage = {}
+        
+        try:
+            # Короткий транскрипт - целиком, длинный - ключевыми фразами или через конспекты фрагментов
+            partial_summaries = None
+            key_sentences = self._extractive_input(transcript_result, ranked, usage)
+            if key_sentences is None and len(transcript_result.text) > SUMMARY_CHUNK_CHARS:
+                partial_summaries = self._map_reduce_transcript(transcript_result, usage)
+            system_prompt, context = self._build_summary_request(
+                transcript_result, transcription_method, partial_summaries, key_sentences
+            )
+            
+            # Генерируем умное резюме с таймаутом
+            return self._complete("reduce", system_prompt, context, 1200, usage, on_token)
+            
+        except Exception as e:
+            logger.error(f"❌ Ошибка умного резюме: {e}")
+            return self._create_basic_summary(transcript_result, transcription_method, ranked)
+    
+    def _extractive_input(self, transcript_result, ranked, usage):
+        """Ключевые фразы до SUMMARY_EXTRACTIVE_INPUT_CHARS вместо map-reduce по транскрипту длиннее
+        SUMMARY_CHUNK_CHARS или None"""
+        text_length = len(transcript_result.text)
+        if SUMMARY_INPUT_MODE != "extractive" or text_length <= SUMMARY_CHUNK_CHARS:
+            return None
+        if ranked is None:
+            ranked = rank_sentences(transcript_result)
+        key_sentences = format_key_sentences(select_key_sentences(ranked, max_chars=SUMMARY_EXTRACTIVE_INPUT_CHARS))
+        if not key_sentences:
+            return None
+        usage["input"] = {"mode": "extractive", "transcript_chars": text_length, "input_chars": len(key_sentences)}
+        return key_sentences
+    
+    def _build_summary_request(self, transcript_result, transcription_method, partial_summaries=None, key_sentences=None):
+        """Системный промпт и контекст итогового запроса резюме"""
+        # Собираем все данные
+        detected_language = transcript_result.language_code
+        
+        if partial_summaries is not None:
+            context = f"КОНСПЕКТЫ ФРАГМЕНТОВ (весь транскрипт по порядку):\n{partial_summaries}\n\n"
+        elif key_sentences is not None:
+            context = f"КЛЮЧЕВЫЕ ФРАЗЫ ТРАНСКРИПТА (отобраны автоматически по всей записи, по порядку):\n{key_sentences}\n\n"
+        else:
+            context = f"ПОЛНЫЙ ТРАНСКРИПТ:\n{transcript_result.text}\n\n"
+        
+        context += f"МЕТОД ТРАНСКРИПЦИИ: {transcription_method}\n"
+        context += f"ОПРЕДЕЛЕННЫЙ ЯЗЫК: {detected_language}\n\n"
+        context += self._build_context_extras(transcript_result)
+        
+        # Определяем язык контента для адаптации промпта
+        content_language = detected_language if detected_language != 'unknown' else 'неизвестный'
+        return self._build_system_prompt(content_language, transcription_method), context
+    
+    def _build_context_extras(self, transcript_result):
+        """Главы, ключевые моменты, сущности и встроенное резюме AssemblyAI"""
+        chapters = transcript_result.chapters
+        highlights = transcript_result.highlights
+        entities = transcript_result.entities
+        builtin_summary = transcript_result.summary
+        context = ""
+        
+        if chapters:
+            context += "📚 АВТОМАТИЧЕСКИЕ ГЛАВЫ:\n"
+            for i, chapter in enumerate(chapters[:8], 1):
+                headline = chapter.headline or f'Глава {i}'
+                start_time = chapter.start / 1000 / 60  # в минутах
+                context += f"{i}. {headline} ({start_time:.1f}мин)\n"
+            context += "\n"
+        
+        if highlights:
+            context += "💡 КЛЮЧЕВЫЕ МОМЕНТЫ:\n"
+            for highlight in highlights[:10]:
+                text = highlight.text
+                if text:
+                    context += f"• {text}\n"
+            context += "\n"
+        
+        if entities:
+            context += "🏷️ УПОМЯНУТЫЕ СУЩНОСТИ:\n"
+            entity_groups = {}
+            for entity in entities[:20]:
+                entity_type = entity.entity_type
+                entity_text = entity.text
+                if entity_type not in entity_groups:
+                    entity_groups[entity_type] = []
+                if entity_text not in entity_groups[entity_type]:
+                    entity_groups[entity_type].append(entity_text)
+            
+            for entity_type, texts in entity_groups.items():
+                context += f"  {entity_type}: {', '.join(texts[:3])}\n"
+            context += "\n"
+        
+        if builtin_summary:
+            context += f"🤖 БАЗОВОЕ РЕЗЮМЕ ASSEMBLYAI:\n{builtin_summary}\n\n"
+        
+        return context
+    
+    def _build_system_prompt(self, content_language, transcription_method):
+        return f"""Ты - профессиональный аналитик аудиоконтента. 
+Транскрипт выполнен на языке: {content_language}. Метод: {transcription_method}.
+
+ВАЖНО: Создай подробное структурированное резюме  НА РУССКОМ И АНГЛИЙСКОМ (ниже) ЯЗЫКЕ.
+
+СТРУКТУРА РЕЗЮМЕ:
+📋 КРАТКОЕ РЕЗЮМЕ (2-3 предложения)
+🌍 ЯЗЫК КОНТЕНТА: {content_language}
+🎯 ОСНОВНЫЕ ТЕМЫ (с временными метками если есть)
+👥 УЧАСТНИКИ (если определены спикеры)
+💡 КЛЮЧЕВЫЕ ИНСАЙТЫ
+📊 ВАЖНЫЕ ФАКТЫ И ЦИФРЫ
+🎭 ЭМОЦИОНАЛЬНАЯ ТОНАЛЬНОСТЬ
+✅ РЕШЕНИЯ И ДЕЙСТВИЯ
+🏷️ КЛЮЧЕВЫЕ ПЕРСОНЫ
+
+Используй эмодзи, будь конкретным, переводи на русский язык."""
+    
+    def _complete(self, stage, system_prompt, user_content, max_tokens, usage, on_token=None):
+        """Один запрос к LLM с учётом токенов и задержки по этапу.
+        
+        С on_token ответ запрашивается потоком и передаётся по фрагментам.
+        """
+        call_start = time.time()
+        first_token_latency = None
+        response = self.client.chat.completions.create(
+            model=SUMMARY_MODEL,
+            messages=[
+                {"role": "system", "content": system_prompt},
+                {"role": "user", "content": user_content}
+            ],
+            max_tokens=max_tokens,
+            temperature=0.3,
+            timeout=SUMMARY_TIMEOUT_SECONDS,
+            stream=on_token is not None
+        )
+        
+        if on_token is None:
+            content = response.choices[0].message.content
+            tokens = getattr(response, 'usage', None)
+        else:
+            parts = []
+            tokens = None
+            for chunk in response:
+                delta = chunk.choices[0].delta.content if chunk.choices else None
+                if delta:
+                    if first_token_latency is None:
+                        first_token_latency = time.time() - call_start
+                    parts.append(delta)
+                    on_token(delta)
+                tokens = getattr(chunk, 'usage', None) or tokens
+            content = "".join(parts)
+        self._record_usage(usage, stage, tokens, time.time() - call_start, first_token_latency)
+        return content.strip()
+    
+    def _record_usage(self, usage, stage, tokens, latency, first_token_latency=None):
+        """Токены и задержка одного запроса в сводку по этапу"""
+        with self._usage_lock:
+            stage_usage = usage.setdefault(stage, {
+                "calls": 0, "prompt_tokens": 0, "completion_tokens": 0, "latency_total": 0.0, "latency_max": 0.0
+            })
+            stage_usage["calls"] += 1
+            stage_usage["prompt_tokens"] += getattr(tokens, 'prompt_tokens', 0) or 0
+            stage_usage["completion_tokens"] += getattr(tokens, 'completion_tokens', 0) or 0
+            stage_usage["latency_total"] = round(stage_usage["latency_total"] + latency, 2)
+            stage_usage["latency_max"] = round(max(stage_usage["latency_max"], latency), 2)
+            if first_token_latency is not None:
+                stage_usage["first_token_latency"] = round(first_token_latency, 2)
+    
+    def _split_transcript(self, transcript_result):
+        """Делит весь транскрипт на фрагменты до SUMMARY_CHUNK_CHARS.
+        
+        Границы идут по репликам (с таймкодом и спикером), новый фрагмент
+        предпочтительно начинается с главы. Без реплик режем текст по предложениям.
+        """
+        utterances = transcript_result.utterances
+        if utterances:
+            chapter_starts = deque(sorted(chapter.start for chapter in transcript_result.chapters))
+            lines = []
+            for utterance in utterances:
+                start = utterance.start
+                speaker = utterance.speaker
+                prefix = f"[{start / 1000 / 60:.1f}мин] " + (f"{speaker}: " if speaker else "")
+                at_chapter = bool(chapter_starts) and chapter_starts[0] <= start
+                while chapter_starts and chapter_starts[0] <= start:
+                    chapter_starts.popleft()
+                lines.append((prefix + (utterance.text or ''), at_chapter))
+        else:
+            sentences = re.split(r'(?<=[.!?…])\s+', transcript_result.text)
+            lines = [(sentence, False) for sentence in sentences if sentence]
+        
+        chunks, current, current_length = [], [], 0
+        for line, at_chapter in lines:
+            # Длинная реплика режется по жёсткой границе
+            while len(line) > SUMMARY_CHUNK_CHARS:
+                if current:
+                    chunks.append("\n".join(current))
+                    current, current_length = [], 0
+                chunks.append(line[:SUMMARY_CHUNK_CHARS])
+                line = line[SUMMARY_CHUNK_CHARS:]
+            
+            chapter_break = at_chapter and current_length > SUMMARY_CHUNK_CHARS // 2
+            if current and (current_length + len(line) > SUMMARY_CHUNK_CHARS or chapter_break):
+                chunks.append("\n".join(current))
+                current, current_length = [], 0
+            current.append(line)
+            current_length += len(line) + 1
+        if current:
+            chunks.append("\n".join(current))
+        return chunks
+    
+    def _map_reduce_transcript(self, transcript_result, usage):
+        """Конспектирует фрагменты параллельно и сводит конспекты до лимита контекста"""
+        chunks = self._split_transcript(transcript_result)
+        logger.info(f"🧠 Длинный транскрипт: {len(chunks)} фрагментов, параллельно {SUMMARY_MAP_PARALLELISM}")
+        
+        with ThreadPoolExecutor(max_workers=SUMMARY_MAP_PARALLELISM, thread_name_prefix="voicesum-summary") as executor:
+            partials = list(executor.map(
+                lambda item: self._complete(
+                    "map", MAP_SYSTEM_PROMPT.format(index=item[0], total=len(chunks)), item[1], 600, usage
+                ),
+                enumerate(chunks, 1),
+            ))
+            
+            # Иерархическое сведение, пока конспекты не помещаются в один запрос
+            groups = self._group_partials(partials)
+            while groups:
+                partials = list(executor.map(
+                    lambda group: self._complete("combine", COMBINE_SYSTEM_PROMPT, "\n\n---\n\n".join(group), 800, usage),
+                    groups,
+                ))
+                groups = self._group_partials(partials)
+        
+        usage["chunks"] = len(chunks)
+        return self._join_partials(partials)
+    
+    def _group_partials(self, partials):
+        """Группы конспектов для следующего раунда сведения или None, если сводить не нужно"""
+        if len(partials) <= 1 or sum(len(partial) for partial in partials) <= SUMMARY_CHUNK_CHARS:
+            return None
+        groups, current, current_length = [], [], 0
+        for partial in partials:
+            if current and current_length + len(partial) > SUMMARY_CHUNK_CHARS:
+                groups.append(current)
+                current, current_length = [], 0
+            current.append(partial)
+            current_length += len(partial)
+        groups.append(current)
+        if len(groups) == len(partials):
+            return None  # каждый конспект сам по себе слишком велик - дальше не сжимаем
+        return groups
+    
+    def _join_partials(self, partials):
+        return "\n\n".join(f"Фрагмент {i}:\n{partial}" for i, partial in enumerate(partials, 1))
+    
+    @timed_stage("summary_basic")
+    def _create_basic_summary(self, transcript_result, transcription_method, ranked=None):
+        """Создает базовое резюме из данных AssemblyAI и ключевых фраз транскрипта НА РУССКОМ ЯЗЫКЕ"""
+        summary_parts = []
+        detected_language = transcript_result.language_code
+        
+        language_names = {
+            'en': 'английский', 'ru': 'русский', 'es': 'испанский',
+            'fr': 'французский', 'de': 'немецкий', 'it': 'итальянский',
+            'pt': 'португальский', 'zh': 'китайский', 'ja': 'японский',
+            'ko': 'корейский', 'unknown': 'не определен'
+        }
+        
+        language_display = language_names.get(detected_language, detected_language)
+        
+        summary_parts.append(f"🔧 МЕТОД ОБРАБОТКИ: {transcription_method}")
+        summary_parts.append(f"🌍 ЯЗЫК КОНТЕНТА: {language_display}")
+        
+        # Встроенное резюме
+        builtin_summary = transcript_result.summary
+        if builtin_summary:
+            summary_parts.append(f"\n📋 БАЗОВОЕ РЕЗЮМЕ:\n{builtin_summary}")
+        
+        # Главы
+        chapters = transcript_result.chapters
+        if chapters:
+            summary_parts.append("\n🎯 ОСНОВНЫЕ РАЗДЕЛЫ:")
+            for i, chapter in enumerate(chapters[:6], 1):
+                headline = chapter.headline or f'Раздел {i}'
+                start_time = chapter.start / 1000 / 60
+                summary_parts.append(f"{i}. {headline} ({start_time:.1f}мин)")
+        
+        # Ключевые моменты
+        highlights = transcript_result.highlights
+        if highlights:
+            summary_parts.append(f"\n💡 КЛЮЧЕВЫЕ МОМЕНТЫ:")
+            for highlight in highlights[:8]:
+                text = highlight.text.strip()
+                if text:
+                    summary_parts.append(f"• {text}")
+        
+        # Ключевые фразы самого транскрипта - есть и без резюме и глав AssemblyAI
+        if ranked is None:
+            ranked = rank_sentences(transcript_result)
+        key_sentences = select_key_sentences(ranked, EXTRACTIVE_SUMMARY_SENTENCES)
+        if key_sentences:
+            summary_parts.append("\n📝 КЛЮЧЕВЫЕ ФРАЗЫ:")
+            summary_parts.append(format_key_sentences(key_sentences))
+        
+        # Сущности
+        entities = transcript_result.entities
+        if entities:
+            summary_parts.append("\n🏷️ УПОМЯНУТЫЕ СУЩНОСТИ:")
+            entity_groups = {}
+            
+            entity_type_translation = {
+                'person': 'Люди', 'organization': 'Организации', 
+                'location': 'Места', 'date': 'Даты', 'money': 'Деньги',
+                'phone_number': 'Телефоны', 'email': 'Email',
+                'product': 'Продукты', 'event': 'События', 'other': 'Прочее'
+            }
+            
+            for entity in entities[:12]:
+                entity_type = entity.entity_type
+                entity_text = entity.text
+                translated_type = entity_type_translation.get(entity_type, entity_type)
+                
+                if translated_type not in entity_groups:
+                    entity_groups[translated_type] = []
+                if entity_text not in entity_groups[translated_type]:
+                    entity_groups[translated_type].append(entity_text)
+            
+            for entity_type, texts in entity_groups.items():
+                if texts:
+                    summary_parts.append(f"  {entity_type}: {', '.join(texts[:3])}")
+        
+        if not summary_parts:
+            summary_parts.append("📋 Базовое резюме недоступно")
+        
+        return "\n".join(summary_parts)
+
+# === Инициализация ===
+summarizer = AdvancedSummarizer(OPENROUTER_API_KEY)
+
+# === Вспомогательные функции ===
+def analyze_sentiment_overall(sentiment_counts):
+    """Анализирует общую тональность по счётчику меток CompactTranscript.sentiment_counts"""
+    total = sum(sentiment_counts.values())
+    if not total:
+        return "not_analyzed", 0, 0, 0
+    
+    positive_count = sentiment_counts['POSITIVE']
+    negative_count = sentiment_counts['NEGATIVE']
+    neutral_count = total - positive_count - negative_count
+    
+    if positive_count > negative_count and positive_count > neutral_count:
+        return "positive", positive_count, negative_count, neutral_count
+    elif negative_count > positive_count and negative_count > neutral_count:
+        return "negative", positive_count, negative_count, neutral_count
+    else:
+        return "neutral", positive_count, negative_count, neutral_count
+
+def count_words(transcript):
+    """Число слов: по словам AssemblyAI, а без них - без разбиения всего текста в список"""
+    if transcript.words_count:
+        return transcript.words_count
+    return sum(1 for _ in re.finditer(r"\S+", transcript.text or ""))
+
+def format_entities_by_type(entities):
+    """Группирует сущности по типам"""
+    if not entities:
+        return {}
+    
+    entity_groups = {}
+    for entity in entities:
+        entity_type = entity.entity_type
+        entity_text = entity.text
+        
+        if entity_type not in entity_groups:
+            entity_groups[entity_type] = []
+        
+        if entity_text and entity_text not in entity_groups[entity_type]:
+            entity_groups[entity_type].append(entity_text)
+    
+    return entity_groups
+
+def get_transcription_features(transcription_method):
+    """Возвращает список доступных функций в зависимости от метода"""
+    if transcription_method == "auto_detection_summary":
+        return [
+            "🎙️ Лучшая модель транскрипции",
+            "🌍 Автообнаружение языка",
+            "👥 Определение спикеров", 
+            "💡 Ключевые моменты",
+            "🎭 Анализ тональности",
+            "🏷️ Определение сущностей",
+            "🤖 Встроенное резюме",
+            "🧠 Умное резюме Claude",
+            "🛡️ Модерация контента",
+            "📊 Категоризация тем"
+        ]
+    elif transcription_method == "auto_detection_chapters":
+        return [
+            "🎙️ Лучшая модель транскрипции",
+            "🌍 Автообнаружение языка",
+            "👥 Определение спикеров", 
+            "📚 Автоматические главы",
+            "💡 Ключевые моменты",
+            "🎭 Анализ тональности",
+            "🏷️ Определение сущностей",
+            "🧠 Умное резюме Claude",
+            "🛡️ Модерация контента",
+            "📊 Категоризация тем"
+        ]
+    else:
+        return [
+            "🎙️ Лучшая модель транскрипции",
+            "🇷🇺 Русский язык",
+            "👥 Определение спикеров",
+            "🏷️ Определение сущностей",
+            "🧠 Умное резюме Claude"
+        ]
+
+# === Обработчик сигналов ===
+def signal_handler(signum, frame):
+    """Плавная остановка при запуске без gunicorn/uvicorn (у них свои обработчики, см. gunicorn.conf.py)"""
+    logger.info("🛑 Получен сигнал завершения, дожидаемся задач...")
+    begin_shutdown()
+    shutdown_worker()
+    sys.exit(0)
+
+# === Обработка файла ===
+class ProcessingError(Exception):
+    """Ошибка обработки, которую нужно вернуть клиенту с указанным HTTP-кодом"""
+    def __init__(self, message, status_code=500):
+        super().__init__(message)
+        self.status_code = status_code
+
+UPLOAD_CHUNK_SIZE = 1024 * 1024  # 1 MB
+UPLOAD_FIELD_MAX_BYTES = 64 * 1024  # лимит для обычных (не файловых) полей формы
+
+def make_upload_path(prefix, filename, directory=None):
+    """Уникальный путь во временной папке процесса (или в directory) с расширением исходного файла"""
+    extension = filename.split('.')[-1]
+    return os.path.join(directory or TEMP_DIR, f"{prefix}_{int(time.time() * 1000)}_{uuid.uuid4().hex[:8]}.{extension}")
+
+class MultipartUploadParser:
+    """Разбор multipart-тела по мере поступления блоков.
+    
+    Данные файла из поля field_name возвращаются из feed() для записи на диск,
+    хэш и размер считаются в том же проходе; остальные текстовые поля
+    собираются в upload["form"].
+    
+    reserved_bytes - место, уже зарезервированное в temp_disk под файлы (по Content-Length).
+    Если файлы больше (тело без Content-Length), недостающее резервируется по мере
+    записи, и reserved_bytes растёт; AdmissionRejected прерывает загрузку.
+    """
+    
+    def __init__(self, boundary, prefix="hybrid", field_name="audio", reserved_bytes=0):
+        self.decoder = MultipartDecoder(boundary.encode())
+        self.hasher = hashlib.sha256()
+        self.prefix = prefix
+        self.field_name = field_name
+        self.reserved_bytes = reserved_bytes
+        self.file_bytes = 0
+        self.upload = {"path": None, "size": 0, "hash": None, "filename": None, "form": {}}
+        self.complete = False
+        self._current = None  # "file", имя текстового поля или None (часть пропускается)
+        self._field_buffer = bytearray()
+    
+    def feed(self, chunk):
+        """Разбирает очередной блок тела (пустой блок - конец) и возвращает данные файла из него"""
+        self.decoder.receive_data(chunk or None)
+        file_data = bytearray()
+        
+        event = self.decoder.next_event()
+        while not isinstance(event, (NeedData, Epilogue)):
+            if isinstance(event, File) and event.name == self.field_name and self._accepts_file():
+                if not event.filename:
+                    raise ProcessingError("Файл не выбран", 400)
+                self._open_file(event.filename)
+                self._current = "file"
+            elif isinstance(event, Field):
+                self._current = event.name
+                self._field_buffer = bytearray()
+            elif isinstance(event, File):
+                self._current = None
+            elif isinstance(event, Data):
+                if self._current == "file":
+                    file_data.extend(self._file_data(event.data))
+                elif self._current is not None:
+                    if len(self._field_buffer) + len(event.data) > UPLOAD_FIELD_MAX_BYTES:
+                        raise ProcessingError(f"Поле формы '{self._current}' слишком большое", 400)
+                    self._field_buffer.extend(event.data)
+                    if not event.more_data:
+                        self.upload["form"][self._current] = self._field_buffer.decode("utf-8", "replace")
+            event = self.decoder.next_event()
+        
+        if isinstance(event, Epilogue) or not chunk:
+            self.complete = True
+        return bytes(file_data)
+    
+    def _accepts_file(self):
+        """Принимается только первый файл поля, остальные пропускаются"""
+        return self.upload["path"] is None
+    
+    def _open_file(self, filename):
+        self.upload["filename"] = filename
+        self.upload["path"] = make_upload_path(self.prefix, filename)
+    
+    def _file_data(self, data):
+        """Учитывает блок файла в хэше и размере; возвращает то, что вернёт feed()"""
+        self._reserve_disk(len(data))
+        self.hasher.update(data)
+        self.upload["size"] += len(data)
+        return data
+    
+    def _reserve_disk(self, nbytes):
+        """Докупает место в temp_disk блоками UPLOAD_CHUNK_SIZE, когда файлы превышают резерв"""
+        self.file_bytes += nbytes
+        shortfall = self.file_bytes - self.reserved_bytes
+        if shortfall > 0:
+            self.reserved_bytes += temp_disk.reserve(max(shortfall, UPLOAD_CHUNK_SIZE))
+    
+    def finish(self):
+        """Итог загрузки: path, size, hash, filename и form"""
+        if self.upload["path"] is None:
+            raise ProcessingError("Файл не загружен", 400)
+        self.upload["hash"] = self.hasher.hexdigest()
+        logger.info(f"📥 Файл сохранён: {self.upload['size'] / 1024 / 1024:.1f} MB")
+        return self.upload
+
+def get_multipart_boundary(content_type_header):
+    """Граница multipart/form-data из заголовка Content-Type (иначе ProcessingError)"""
+    content_type, options = parse_options_header(content_type_header)
+    boundary = options.get("boundary")
+    if content_type != "multipart/form-data" or not boundary:
+        raise ProcessingError("Файл не загружен", 400)
+    return boundary
+
+@timed_stage("save")
+def receive_upload(prefix="hybrid", field_name="audio", reserved_bytes=0):
+    """Потоково разбирает multipart-запрос и пишет файл сразу во временную папку.
+    
+    Тело читается блоками UPLOAD_CHUNK_SIZE, хэш и размер считаются в том же проходе,
+    поэтому память на загрузку не зависит от размера файла. Возвращает словарь
+    с path, size, hash, filename и form (остальные текстовые поля), а также
+    reserved_bytes - весь резерв temp_disk под файл вместе с переданным (см. MultipartUploadParser).
+    """
+    parser = MultipartUploadParser(
+        get_multipart_boundary(request.headers.get("Content-Type")), prefix, field_name, reserved_bytes
+    )
+    out = None
+    
+    try:
+        while not parser.complete:
+            file_data = parser.feed(request.stream.read(UPLOAD_CHUNK_SIZE))
+            if out is None and parser.upload["path"]:
+                out = open(parser.upload["path"], "wb")
+            if file_data:
+                out.write(file_data)
+    except RequestEntityTooLarge:
+        discard_partial_upload(out, parser.upload["path"])
+        temp_disk.release(parser.reserved_bytes - reserved_bytes)
+        raise ProcessingError("Файл слишком большой", 413)
+    except ValueError as e:
+        discard_partial_upload(out, parser.upload["path"])
+        temp_disk.release(parser.reserved_bytes - reserved_bytes)
+        raise ProcessingError(f"Некорректные данные формы: {e}", 400)
+    except Exception:
+        discard_partial_upload(out, parser.upload["path"])
+        temp_disk.release(parser.reserved_bytes - reserved_bytes)
+        raise
+    
+    if out is not None:
+        out.close()
+    upload = parser.finish()
+    upload["reserved_bytes"] = parser.reserved_bytes
+    return upload
+
+def discard_partial_upload(out, path):
+    """Закрывает и удаляет недописанный файл"""
+    if out is not None:
+        out.close()
+    if path and os.path.exists(path):
+        os.remove(path)
+
+jobs_in_flight = 0
+jobs_in_flight_lock = threading.Lock()
+
+def change_jobs_in_flight(delta):
+    global jobs_in_flight
+    with jobs_in_flight_lock:
+        jobs_in_flight += delta
+        metrics.set("voicesum_jobs_in_flight", jobs_in_flight)
+
+def process_audio_file(input_path, file_size, start_time, audio_hash=None, on_event=None, filename=None, hints=None):
+    """Полный цикл обработки сохранённого файла: транскрипция, резюме и анализ.
+    
+    on_event(event, data) получает события этапов (для потоковой выдачи клиенту),
+    hints - подсказки клиента для выбора стратегии (get_client_hints).
+    """
+    change_jobs_in_flight(1)
+    try:
+        with metrics.time("voicesum_stage_seconds", stage="total"):
+            return _process_audio_file(input_path, file_size, start_time, audio_hash, on_event, filename, hints)
+    finally:
+        change_jobs_in_flight(-1)
+
+def get_cached_result(audio_hash, start_time):
+    """Готовый результат из кэша для файла с этим хэшем или None"""
+    if not (result_cache and audio_hash):
+        return None
+    cached = result_cache.get(result_cache.make_key(audio_hash))
+    if cached is not None:
+        total_time = time.time() - start_time
+        logger.info(f"⚡ Результат найден в кэше за {total_time * 1000:.0f}мс")
+        cached["statistics"]["processing_time"] = f"{total_time:.1f}s"
+        cached["cache_hit"] = True
+    return cached
+
+def _process_audio_file(input_path, file_size, start_time, audio_hash, on_event, filename, hints):
+    on_event = on_event or _ignore_event
+    # Проверяем кэш готовых результатов
+    cached = get_cached_result(audio_hash, start_time)
+    if cached is not None:
+        return cached
+    
+    # Примерная оценка длительности
+    logger.info(f"📊 Примерная длительность: ~{file_size / 1024 / 1024:.1f} минут")
+    
+    pipeline_info = {}
+    features = describe_input(input_path, file_size, hints) if strategy_scheduler else None
+    audio_path = input_path
+    try:
+        # Перекодирование в компактный речевой формат перед загрузкой
+        if AUDIO_NORMALIZATION_ENABLED:
+            audio_path = normalize_audio(input_path, pipeline_info)
+        
+        # Улучшенная гибридная транскрипция с множественным fallback
+        transcript, transcription_method = transcribe_with_fallback(audio_path, pipeline_info, on_event, features)
+        transcript = CompactTranscript.from_transcript(transcript)
+    finally:
+        if audio_path != input_path and os.path.exists(audio_path):
+            os.remove(audio_path)
+    
+    return build_result(transcript, transcription_method, file_size, start_time, pipeline_info, audio_hash, on_event, filename)
+
+def build_result(transcript, transcription_method, file_size, start_time, pipeline_info, audio_hash=None, on_event=None, filename=None):
+    """Резюме, анализ и итоговый ответ по готовой транскрипции (CompactTranscript; результат кладётся в кэш)"""
+    on_event = on_event or _ignore_event
+    if not transcript.text:
+        raise ProcessingError("Не удалось получить транскрипцию", 400)
+    
+    logger.info(f"✅ Транскрипция завершена методом: {transcription_method}")
+    on_event("transcript_ready", {
+        "transcript": transcript.text[:TRANSCRIPT_PREVIEW_CHARS],
+        "transcription_method": transcription_method,
+        "words_count": count_words(transcript),
+    })
+    # Черновик из ключевых фраз виден сразу, пока LLM готовит умное резюме
+    ranked, key_sentences = extract_key_sentences(transcript)
+    on_event("summary_draft", {"text": format_key_sentences(key_sentences)})
+    
+    # Создаем умное резюме с обработкой ошибок
+    try:
+        logger.info("🧠 Генерирую умное резюме...")
+        summary_usage = {}
+        summary = summarizer.create_smart_summary(
+            transcript, transcription_method, summary_usage,
+            on_token=lambda delta: on_event("summary_delta", {"text": delta}), ranked=ranked
+        )
+        if summary_usage:
+            pipeline_info["summary"] = summary_usage
+    except Exception as e:
+        logger.warning(f"⚠️ Ошибка генерации умного резюме: {e}")
+        summary = summarizer._create_basic_summary(transcript, transcription_method, ranked)
+    
+    return assemble_result(
+        transcript, transcription_method, summary, file_size, start_time, pipeline_info, audio_hash, filename, key_sentences
+    )
+
+def assemble_result(transcript, transcription_method, summary, file_size, start_time, pipeline_info, audio_hash=None, filename=None, key_sentences=None):
+    """Анализ транскрипции и итоговый ответ с готовым резюме и ключевыми фразами.
+    
+    Результат сохраняется в хранилище транскриптов и кладётся в кэш.
+    """
+    # Получаем точную длительность из результата AssemblyAI
+    estimated_duration = file_size / 1024 / 1024  # грубая оценка в минутах
+    audio_duration_ms = transcript.audio_duration
+    actual_duration = audio_duration_ms / 1000 / 60 if audio_duration_ms else estimated_duration
+    detected_language = transcript.language_code
+    
+    # Анализируем результаты в зависимости от метода
+    overall_sentiment, pos_count, neg_count, neu_count = analyze_sentiment_overall(transcript.sentiment_counts)
+    
+    entities = transcript.entities
+    entities_by_type = format_entities_by_type(entities)
+    
+    chapters = transcript.chapters
+    highlights = transcript.highlights
+    
+    # Подсчет использованных кредитов
+    credits_used = actual_duration / 60 * 0.37  # примерно $0.37 за час
+    
+    total_time = time.time() - start_time
+    logger.info(f"✅ Полная обработка завершена за {total_time:.1f}с")
+
+    # Формируем оптимизированный ответ (ограничиваем размер)
+    transcript_text = transcript.text
+    
+    # Ограничиваем размер транскрипта для JSON ответа (полный текст - в хранилище, страницами)
+    max_transcript_length = TRANSCRIPT_PREVIEW_CHARS
+    if len(transcript_text) > max_transcript_length:
+        transcript_text = transcript_text[:max_transcript_length] + "\n\n... [ТРАНСКРИПТ ОБРЕЗАН ДЛЯ ОПТИМИЗАЦИИ] ..."
+        logger.info(f"📝 Транскрипт обрезан с {len(transcript.text)} до {len(transcript_text)} символов")
+    
+    response_data = {
+        "transcript": transcript_text,
+        "summary": summary,
+        "service_used": "AssemblyAI Hybrid Approach (Fixed)",
+        "transcription_method": transcription_method,
+        "detected_language": detected_language,
+        
+        # Статистика
+        "statistics": {
+            "processing_time": f"{total_time:.1f}s",
+            "audio_duration": f"{actual_duration:.1f}min", 
+            "file_size": f"{file_size / 1024 / 1024:.1f}MB",
+            "confidence": transcript.confidence,
+            "credits_used": f"${credits_used:.3f}",
+            "words_count": count_words(transcript),
+            "transcript_truncated": len(transcript.text) > max_transcript_length
+        },
+        
+        # AI анализ
+        "ai_analysis": {
+            "method_used": transcription_method,
+            "speakers_detected": transcript.speakers_count,
+            "chapters_found": len(chapters),
+            "highlights_found": len(highlights),
+            "entities_found": len(entities),
+            "sentiment_breakdown": {
+                "overall": overall_sentiment,
+                "positive_segments": pos_count,
+                "negative_segments": neg_count,
+                "neutral_segments": neu_count
+            },
+            "features_available": get_transcription_features(transcription_method)
+        }
+    }
+    
+    # Добавляем детальные результаты если есть (ограничено)
+    if chapters:
+        response_data["chapters"] = [
+            {
+                "headline": ch.headline,
+                "start_time": f"{ch.start/1000/60:.1f}min",
+                "end_time": f"{ch.end/1000/60:.1f}min",
+                "summary": ch.summary[:500] + ('...' if len(ch.summary) > 500 else '')
+            }
+            for ch in chapters[:8]  # Ограничиваем до 8 глав
+        ]
+    
+    if highlights:
+        response_data["key_highlights"] = [
+            {
+                "text": h.text[:300] + ('...' if len(h.text) > 300 else ''),
+                "rank": h.rank,
+                "start_time": f"{h.start/1000/60:.1f}min"
+            }
+            for h in highlights[:10]  # Ограничиваем до 10
+        ]
+    
+    if key_sentences:
+        response_data["key_sentences"] = [
+            {
+                "text": sentence.text,
+                "speaker": sentence.speaker,
+                "start_time": f"{sentence.start/1000/60:.1f}min" if sentence.start is not None else None
+            }
+            for sentence in key_sentences
+        ]
+    
+    if entities_by_type:
+        # Ограничиваем количество сущностей каждого типа
+        limited_entities = {}
+        for entity_type, entity_list in entities_by_type.items():
+            limited_entities[entity_type] = entity_list[:5]  # Ограничиваем до 5 в каждой категории
+        response_data["entities_by_type"] = limited_entities
+    
+    # Встроенное резюме от AssemblyAI (если доступно, ограничено)
+    builtin_summary = transcript.summary
+    if builtin_summary:
+        if len(builtin_summary) > 2000:
+            builtin_summary = builtin_summary[:2000] + "... [ОБРЕЗАНО]"
+        response_data["assemblyai_summary"] = builtin_summary
+    
+    # Информация о методе транскрипции
+    method_names = {
+        "auto_detection_summary": "Автообнаружение языка с резюме",
+        "auto_detection_chapters": "Автообнаружение языка с главами", 
+        "russian_limited_features": "Русский язык (приоритет)"
+    }
+    
+    response_data["method_info"] = {
+        "name": method_names.get(transcription_method, transcription_method),
+        "features": "Все AI функции" if "auto_detection" in transcription_method else "Ограниченный набор",
+        "language_detected": detected_language,
+        "fallback_used": transcription_method == "russian_limited_features"
+    }
+
+    if pipeline_info:
+        response_data["pipeline"] = pipeline_info
+    
+    # Сохраняем для поиска; сбой хранилища не должен ронять обработку
+    if transcript_store:
+        try:
+            transcript_id = transcript_store.save(transcript, response_data, filename, audio_hash)
+            response_data["transcript_id"] = transcript_id
+            response_data["transcript_pages"] = {
+                "url": f"/transcripts/{transcript_id}/text",
+                "total_chars": len(transcript.text),
+                "next_offset": max_transcript_length if len(transcript.text) > max_transcript_length else None
+            }
+        except sqlite3.Error as e:
+            logger.warning(f"⚠️ Не удалось сохранить транскрипт: {e}")
+    
+    if result_cache and audio_hash:
+        result_cache.put(result_cache.make_key(audio_hash), response_data)
+    
+    return response_data
+
+# === Общее состояние воркеров ===
+# При запуске в несколько процессов запрос может попасть в любой воркер. Задачи, пакеты,
+# их события и возобновляемые загрузки поэтому хранятся в общей SQLite рядом с сервисом:
+# статус задачи виден из любого воркера, часть загрузки можно прислать в любой из них.
+# Исполнение остаётся в памяти процесса, который принял работу.
+STATE_STORE_PATH = os.environ.get("STATE_STORE_PATH", os.path.join(tempfile.gettempdir(), "voicesum_state.sqlite3"))
+SHARED_EVENTS_POLL_SECONDS = 1.0
+
+class SharedStateStore(SQLiteStore):
+    """Задачи, события задач, пакеты и возобновляемые загрузки, общие для всех воркеров.
+    
+    worker - pid процесса, который выполняет задачу; 0 - задача сохранена при остановке
+    воркера и ждёт, пока её заберёт другой (см. checkpoint_job / adopt_checkpointed_jobs).
+    """
+    
+    SCHEMA = (
+        "CREATE TABLE IF NOT EXISTS jobs ("
+        "id TEXT PRIMARY KEY, status TEXT NOT NULL, worker INTEGER NOT NULL, "
+        "updated_at REAL NOT NULL, snapshot TEXT NOT NULL, resume TEXT)",
+        "CREATE INDEX IF NOT EXISTS jobs_status ON jobs (status)",
+        "CREATE TABLE IF NOT EXISTS job_events ("
+        "job_id TEXT NOT NULL, idx INTEGER NOT NULL, event TEXT NOT NULL, data TEXT NOT NULL, "
+        "PRIMARY KEY (job_id, idx))",
+        "CREATE TABLE IF NOT EXISTS batches ("
+        "id TEXT PRIMARY KEY, status TEXT NOT NULL, updated_at REAL NOT NULL, snapshot TEXT NOT NULL)",
+        "CREATE TABLE IF NOT EXISTS batch_files ("
+        "batch_id TEXT NOT NULL, idx INTEGER NOT NULL, snapshot TEXT NOT NULL, PRIMARY KEY (batch_id, idx))",
+        "CREATE TABLE IF NOT EXISTS upload_sessions ("
+        "id TEXT PRIMARY KEY, status TEXT NOT NULL, writers INTEGER NOT NULL, size INTEGER NOT NULL, "
+        "updated_at REAL NOT NULL, session TEXT NOT NULL)",
+        "CREATE TABLE IF NOT EXISTS upload_chunks ("
+        "upload_id TEXT NOT NULL, chunk INTEGER NOT NULL, PRIMARY KEY (upload_id, chunk))",
+        "CREATE TABLE IF NOT EXISTS worker_usage ("
+        "worker INTEGER NOT NULL, resource TEXT NOT NULL, amount INTEGER NOT NULL, PRIMARY KEY (worker, resource))",
+    )
+    
+    # --- Задачи ---
+    def save_job(self, snapshot, status=None, worker=None, resume=None):
+        with self._connect() as conn:
+            conn.execute(
+                "INSERT OR REPLACE INTO jobs VALUES (?, ?, ?, ?, ?, ?)",
+                (
+                    snapshot["id"], status or snapshot["status"], os.getpid() if worker is None else worker, time.time(),
+                    json.dumps(snapshot, ensure_ascii=False), json.dumps(resume, ensure_ascii=False) if resume else None,
+                )
+            )
+    
+    def load_job(self, job_id):
+        with self._connect() as conn:
+            row = conn.execute("SELECT snapshot FROM jobs WHERE id = ?", (job_id,)).fetchone()
+        return json.loads(row[0]) if row else None
+    
+    def delete_job(self, job_id):
+        with self._connect() as conn:
+            conn.execute("DELETE FROM jobs WHERE id = ?", (job_id,))
+            conn.execute("DELETE FROM job_events WHERE job_id = ?", (job_id,))
+    
+    def count_jobs(self):
+        """Число задач по статусам во всех воркерах; сохранённые при остановке считаются ожидающими"""
+        with self._connect() as conn:
+            rows = conn.execute("SELECT status, COUNT(*) FROM jobs GROUP BY status").fetchall()
+        counts = Counter()
+        for status, count in rows:
+            counts["queued" if status == "checkpointed" else status] += count
+        return counts
+    
+    def claim_checkpointed_jobs(self, limit=20):
+        """Забирает сохранённые задачи себе: список (snapshot, resume), каждая достаётся одному воркеру"""
+        with self._connect() as conn:
+            rows = conn.execute(
+                "SELECT id, snapshot, resume FROM jobs WHERE status = 'checkpointed' ORDER BY updated_at LIMIT ?", (limit,)
+            ).fetchall()
+            claimed = []
+            for job_id, snapshot, resume in rows:
+                updated = conn.execute(
+                    "UPDATE jobs SET status = 'queued', worker = ?, updated_at = ? WHERE id = ? AND status = 'checkpointed'",
+                    (os.getpid(), time.time(), job_id)
+                ).rowcount
+                if updated:
+                    claimed.append((json.loads(snapshot), json.loads(resume)))
+        return claimed
+    
+    def active_job_workers(self):
+        """(id задачи, pid воркера) для задач в очереди или в работе"""
+        with self._connect() as conn:
+            return conn.execute("SELECT id, worker FROM jobs WHERE status IN ('queued', 'processing') AND worker != 0").fetchall()
+    
+    def add_job_event(self, job_id, index, event, data):
+        with self._connect() as conn:
+            conn.execute(
+                "INSERT OR REPLACE INTO job_events VALUES (?, ?, ?, ?)",
+                (job_id, index, event, json.dumps(data, ensure_ascii=False))
+            )
+    
+    def job_events(self, job_id, start_index=0):
+        """Сохранённые события задачи начиная с start_index: [(index, event, data)]"""
+        with self._connect() as conn:
+            rows = conn.execute(
+                "SELECT idx, event, data FROM job_events WHERE job_id = ? AND idx >= ? ORDER BY idx", (job_id, start_index)
+            ).fetchall()
+        return [(index, event, json.loads(data)) for index, event, data in rows]
+    
+    def next_job_event_index(self, job_id):
+        with self._connect() as conn:
+            return conn.execute("SELECT COALESCE(MAX(idx) + 1, 0) FROM job_events WHERE job_id = ?", (job_id,)).fetchone()[0]
+    
+    # --- Пакеты ---
+    def save_batch(self, view, files=()):
+        """Сохраняет прогресс пакета и (с результатами) перечисленные файлы"""
+        with self._connect() as conn:
+            conn.execute(
+                "INSERT OR REPLACE INTO batches VALUES (?, ?, ?, ?)",
+                (view["batch_id"], view["status"], time.time(), json.dumps(view, ensure_ascii=False))
+            )
+            conn.executemany(
+                "INSERT OR REPLACE INTO batch_files VALUES (?, ?, ?)",
+                [(view["batch_id"], item["index"], json.dumps(item, ensure_ascii=False)) for item in files]
+            )
+    
+    def delete_batch(self, batch_id):
+        with self._connect() as conn:
+            conn.execute("DELETE FROM batches WHERE id = ?", (batch_id,))
+            conn.execute("DELETE FROM batch_files WHERE batch_id = ?", (batch_id,))
+    
+    def load_batch(self, batch_id):
+        with self._connect() as conn:
+            row = conn.execute("SELECT snapshot FROM batches WHERE id = ?", (batch_id,)).fetchone()
+        return json.loads(row[0]) if row else None
+    
+    def load_batch_files(self, batch_id, index=None):
+        """Файлы пакета с результатами: {индекс: файл}"""
+        query, params = "SELECT idx, snapshot FROM batch_files WHERE batch_id = ?", (batch_id,)
+        if index is not None:
+            query, params = query + " AND idx = ?", params + (index,)
+        with self._connect() as conn:
+            rows = conn.execute(query, params).fetchall()
+        return {idx: json.loads(snapshot) for idx, snapshot in rows}
+    
+    def count_batches(self):
+        with self._connect() as conn:
+            return dict(conn.execute("SELECT status, COUNT(*) FROM batches GROUP BY status").fetchall())
+    
+    def prune_finished(self, finished_before):
+        """Удаляет завершённые задачи и пакеты, обновлённые раньше finished_before"""
+        with self._connect() as conn:
+            job_ids = [row[0] for row in conn.execute(
+                "SELECT id FROM jobs WHERE status IN ('completed', 'failed') AND updated_at < ?", (finished_before,)
+            )]
+            conn.executemany("DELETE FROM job_events WHERE job_id = ?", [(job_id,) for job_id in job_ids])
+            conn.executemany("DELETE FROM jobs WHERE id = ?", [(job_id,) for job_id in job_ids])
+            batch_ids = [row[0] for row in conn.execute(
+                "SELECT id FROM batches WHERE status = 'completed' AND updated_at < ?", (finished_before,)
+            )]
+            conn.executemany("DELETE FROM batch_files WHERE batch_id = ?", [(batch_id,) for batch_id in batch_ids])
+            conn.executemany("DELETE FROM batches WHERE id = ?", [(batch_id,) for batch_id in batch_ids])
+    
+    # --- Возобновляемые загрузки ---
+    def add_upload_session(self, session):
+        with self._connect() as conn:
+            conn.execute(
+                "INSERT INTO upload_sessions VALUES (?, 'uploading', 0, ?, ?, ?)",
+                (session["id"], session["size"], time.time(), json.dumps(session, ensure_ascii=False))
+            )
+    
+    def get_upload_session(self, upload_id):
+        """(session, status, полученные части) или None"""
+        with self._connect() as conn:
+            row = conn.execute("SELECT session, status FROM upload_sessions WHERE id = ?", (upload_id,)).fetchone()
+            if row is None:
+                return None
+            chunks = [chunk for (chunk,) in conn.execute(
+                "SELECT chunk FROM upload_chunks WHERE upload_id = ? ORDER BY chunk", (upload_id,)
+            )]
+        return json.loads(row[0]), row[1], chunks
+    
+    def begin_upload_write(self, upload_id):
+        """Отмечает запись части; False, если загрузка уже завершается или удалена"""
+        with self._connect() as conn:
+            return conn.execute(
+                "UPDATE upload_sessions SET writers = writers + 1 WHERE id = ? AND status = 'uploading'", (upload_id,)
+            ).rowcount == 1
+    
+    def end_upload_write(self, upload_id, chunk=None):
+        """Запись части закончена; chunk - индекс части, если она принята"""
+        with self._connect() as conn:
+            conn.execute(
+                "UPDATE upload_sessions SET writers = writers - 1, updated_at = ? WHERE id = ?", (time.time(), upload_id)
+            )
+            if chunk is not None:
+                conn.execute("INSERT OR IGNORE INTO upload_chunks VALUES (?, ?)", (upload_id, chunk))
+    
+    def set_upload_status(self, upload_id, from_status, to_status):
+        """Переводит загрузку в новый статус, только если части сейчас не пишутся"""
+        with self._connect() as conn:
+            return conn.execute(
+                "UPDATE upload_sessions SET status = ?, updated_at = ? WHERE id = ? AND status = ? AND writers = 0",
+                (to_status, time.time(), upload_id, from_status)
+            ).rowcount == 1
+    
+    def delete_upload_session(self, upload_id, status=None, updated_before=None):
+        """Удаляет загрузку (с условием на статус, отсутствие записи частей и давность); возвращает её или None"""
+        query, params = "DELETE FROM upload_sessions WHERE id = ?", [upload_id]
+        if status is not None:
+            query += " AND status = ? AND writers = 0"
+            params.append(status)
+        if updated_before is not None:
+            query += " AND updated_at < ?"
+            params.append(updated_before)
+        with self._connect() as conn:
+            row = conn.execute("SELECT session FROM upload_sessions WHERE id = ?", (upload_id,)).fetchone()
+            if row is None or not conn.execute(query, params).rowcount:
+                return None
+            conn.execute("DELETE FROM upload_chunks WHERE upload_id = ?", (upload_id,))
+        return json.loads(row[0])
+    
+    def stale_upload_sessions(self, updated_before):
+        with self._connect() as conn:
+            return [row[0] for row in conn.execute(
+                "SELECT id FROM upload_sessions WHERE status = 'uploading' AND writers = 0 AND updated_at < ?", (updated_before,)
+            )]
+    
+    def upload_bytes(self):
+        """Место, занятое незавершёнными загрузками всех воркеров"""
+        with self._connect() as conn:
+            return conn.execute("SELECT COALESCE(SUM(size), 0) FROM upload_sessions").fetchone()[0]
+    
+    def count_upload_sessions(self):
+        with self._connect() as conn:
+            return conn.execute("SELECT COUNT(*) FROM upload_sessions").fetchone()[0]
+    
+    # --- Общие лимиты ---
+    @contextmanager
+    def worker_usage(self):
+        """Доли воркеров в общих лимитах (слоты, транскрипции, временный диск).
+        
+        Отдаёт (занятое остальными воркерами {ресурс: объём}, доли этого воркера {ресурс: объём});
+        изменённые доли сохраняются в той же транзакции, поэтому проверка лимита и захват
+        атомарны для всех процессов. Исключение внутри блока откатывает изменения.
+        """
+        pid = os.getpid()
+        with self._connect() as conn:
+            conn.execute("BEGIN IMMEDIATE")
+            others, own = Counter(), {}
+            for worker, resource, amount in conn.execute("SELECT worker, resource, amount FROM worker_usage"):
+                if worker == pid:
+                    own[resource] = amount
+                else:
+                    others[resource] += amount
+            before = dict(own)
+            yield others, own
+            conn.executemany(
+                "INSERT OR REPLACE INTO worker_usage VALUES (?, ?, ?)",
+                [(pid, resource, amount) for resource, amount in own.items() if amount and before.get(resource) != amount]
+            )
+            conn.executemany(
+                "DELETE FROM worker_usage WHERE worker = ? AND resource = ?",
+                [(pid, resource) for resource, amount in own.items() if not amount and resource in before]
+            )
+    
+    def usage_workers(self):
+        with self._connect() as conn:
+            return [row[0] for row in conn.execute("SELECT DISTINCT worker FROM worker_usage")]
+    
+    def clear_worker_usage(self, worker):
+        """Удаляет доли воркера (при его запуске, остановке или аварийном завершении)"""
+        with self._connect() as conn:
+            conn.execute("DELETE FROM worker_usage WHERE worker = ?", (worker,))
+
+state_store = SharedStateStore(STATE_STORE_PATH)
+
+# === Фоновая очередь задач ===
+JOB_WORKERS = int(os.environ.get("JOB_WORKERS", 4))
+JOB_RESULT_TTL = int(os.environ.get("JOB_RESULT_TTL", 3600))  # секунды хранения результата
+
+job_executor = ThreadPoolExecutor(max_workers=JOB_WORKERS, thread_name_prefix="voicesum-job")
+jobs = {}
+jobs_lock = threading.Lock()
+# События задач для SSE: job_id -> список (event, data); новые события будят подписчиков
+job_events = {}
+job_event_offsets = {}  # индекс первого события в памяти, если задача продолжена после другого воркера
+job_events_changed = threading.Condition(jobs_lock)
+SSE_KEEPALIVE_SECONDS = 15
+# Токены резюме идут только подписчикам своего воркера, в общее хранилище попадают этапы и итог
+LOCAL_ONLY_JOB_EVENTS = {"summary_delta"}
+# Входные данные задач процесса: по ним незавершённая задача сохраняется при остановке воркера
+job_inputs = {}
+checkpointed_jobs = set()
+
+def _prune_jobs():
+    """Удаляет завершённые задачи старше JOB_RESULT_TTL (вызывать под jobs_lock)"""
+    now = time.time()
+    expired = [
+        job_id for job_id, job in jobs.items()
+        if job["finished_at"] and now - job["finished_at"] > JOB_RESULT_TTL
+    ]
+    for job_id in expired:
+        del jobs[job_id]
+        job_events.pop(job_id, None)
+        job_event_offsets.pop(job_id, None)
+
+def _update_job(job_id, **fields):
+    with jobs_lock:
+        jobs[job_id].update(fields)
+        snapshot = dict(jobs[job_id])
+    # Сохранённую при остановке задачу уже ведёт другой воркер
+    if job_id not in checkpointed_jobs:
+        state_store.save_job(snapshot)
+
+def publish_job_event(job_id, event, data):
+    """Добавляет событие в журнал задачи, будит SSE-подписчиков и сохраняет его для других воркеров"""
+    with job_events_changed:
+        events = job_events.setdefault(job_id, [])
+        index = job_event_offsets.get(job_id, 0) + len(events)
+        events.append((event, data))
+        job_events_changed.notify_all()
+    if event not in LOCAL_ONLY_JOB_EVENTS and job_id not in checkpointed_jobs:
+        state_store.add_job_event(job_id, index, event, data)
+
+def iter_job_events(job_id, start_index=0):
+    """Генератор событий задачи начиная с start_index; завершается на completed/failed.
+    
+    Пока новых событий нет, отдаёт None раз в SSE_KEEPALIVE_SECONDS. События задачи
+    другого воркера читаются из общего хранилища.
+    """
+    with jobs_lock:
+        local = job_id in job_events
+        offset = job_event_offsets.get(job_id, 0)
+    if not local:
+        yield from _iter_shared_job_events(job_id, start_index)
+        return
+    
+    index = max(start_index, offset)
+    while True:
+        with job_events_changed:
+            if job_id not in job_events:
+                return  # задача удалена по TTL
+            if index - offset >= len(job_events[job_id]):
+                job_events_changed.wait(SSE_KEEPALIVE_SECONDS)
+            pending = job_events.get(job_id, [])[index - offset:]
+        
+        if not pending:
+            yield None
+            continue
+        for event, data in pending:
+            yield index, event, data
+            index += 1
+            if event in ("completed", "failed"):
+                return
+            if event == "checkpointed":
+                # Дальше задачу ведёт другой воркер
+                yield from _iter_shared_job_events(job_id, index)
+                return
+
+def _iter_shared_job_events(job_id, start_index):
+    """События задачи из общего хранилища (опросом раз в SHARED_EVENTS_POLL_SECONDS)"""
+    index = start_index
+    idle_since = time.time()
+    while True:
+        events = state_store.job_events(job_id, index)
+        if not events:
+            if state_store.load_job(job_id) is None:
+                return  # задача удалена по TTL
+            if time.time() - idle_since >= SSE_KEEPALIVE_SECONDS:
+                idle_since = time.time()
+                yield None
+            time.sleep(SHARED_EVENTS_POLL_SECONDS)
+            continue
+        
+        idle_since = time.time()
+        for index, event, data in events:
+            yield index, event, data
+            if event in ("completed", "failed"):
+                return
+        index += 1
+
+def _complete_job(job_id, result):
+    _update_job(job_id, status="completed", result=result, finished_at=time.time())
+    publish_job_event(job_id, "completed", result)
+    logger.info(f"✅ Задача {job_id} завершена")
+
+def _fail_job(job_id, error):
+    logger.error(f"❌ Задача {job_id} завершилась ошибкой: {error}")
+    message = f"Ошибка: {str(error)[:300]}"
+    _update_job(job_id, status="failed", error=message, finished_at=time.time())
+    publish_job_event(job_id, "failed", {"error": message})
+
+def run_job(job_id, input_path, file_size, audio_hash=None, hints=None, ticket=None, reserved_bytes=0):
+    """Выполняет задачу в фоновом потоке и сохраняет результат в хранилище задач"""
+    start_time = time.time()
+    _update_job(job_id, status="processing", started_at=start_time)
+    logger.info(f"⚙️ Задача {job_id} запущена")
+    
+    publish_job_event(job_id, "processing", {})
+    on_event = lambda event, data: publish_job_event(job_id, event, data)
+    
+    try:
+        if WEBHOOK_ENABLED:
+            result = submit_webhook_job(job_id, input_path, file_size, start_time, audio_hash, on_event, hints)
+        else:
+            result = process_audio_file(
+                input_path, file_size, start_time, audio_hash, on_event=on_event,
+                filename=get_job_snapshot(job_id)["filename"], hints=hints
+            )
+        # None - транскрипция продолжится по вебхуку, воркер свободен
+        if result is not None:
+            _complete_job(job_id, result)
+    except Exception as e:
+        _fail_job(job_id, e)
+    finally:
+        with jobs_lock:
+            job_inputs.pop(job_id, None)
+        if input_path and os.path.exists(input_path):
+            os.remove(input_path)
+        temp_disk.release(reserved_bytes)
+        if ticket is not None:
+            job_scheduler.release(ticket)
+
+def submit_job(input_path, file_size, filename, audio_hash=None, hints=None, tenant=("anonymous", 1.0), reserved_bytes=0, job_id=None):
+    """Регистрирует задачу и ставит её в справедливую очередь планировщика.
+    
+    Воркер получает задачу, когда у клиента tenant ((id, вес), см. resolve_tenant) и у процесса
+    есть свободный слот; reserved_bytes - резерв временного диска, который освободится с файлом.
+    При переполненной очереди бросает AdmissionRejected, файл остаётся у вызывающего.
+    job_id передаётся, когда продолжается задача, сохранённая другим воркером.
+    """
+    resumed = job_id is not None
+    job_id = job_id or uuid.uuid4().hex
+    job = {
+        "id": job_id,
+        "status": "queued",
+        "filename": filename,
+        "file_size": file_size,
+        "created_at": time.time(),
+        "started_at": None,
+        "finished_at": None,
+        "result": None,
+        "error": None,
+    }
+    first_event = state_store.next_job_event_index(job_id) if resumed else 0
+    with jobs_lock:
+        _prune_jobs()
+        jobs[job_id] = job
+        job_events[job_id] = []
+        job_event_offsets[job_id] = first_event
+        job_inputs[job_id] = {
+            "input_path": input_path, "file_size": file_size, "filename": filename,
+            "audio_hash": audio_hash, "hints": hints, "tenant": list(tenant),
+        }
+        snapshot = dict(job)
+    # Запись в общем хранилище появляется до того, как воркер может начать задачу
+    state_store.save_job(snapshot)
+    publish_job_event(job_id, "queued", {"job_id": job_id})
+    
+    def start(ticket):
+        job_executor.submit(run_job, job_id, input_path, file_size, audio_hash, hints, ticket, reserved_bytes)
+    
+    try:
+        job_scheduler.submit(*tenant, start, on_cancel=lambda ticket: checkpoint_job(job_id))
+    except AdmissionRejected:
+        with jobs_lock:
+            del jobs[job_id]
+            job_events.pop(job_id, None)
+            job_event_offsets.pop(job_id, None)
+            job_inputs.pop(job_id, None)
+        if not resumed:
+            state_store.delete_job(job_id)
+        raise
+    logger.info(f"📬 Задача {job_id} поставлена в очередь")
+    return snapshot
+
+def get_job_snapshot(job_id):
+    """Возвращает копию задачи (своей или другого воркера) или None"""
+    with jobs_lock:
+        job = jobs.get(job_id)
+        if job and job_id not in checkpointed_jobs:
+            return dict(job)
+    return state_store.load_job(job_id)
+
+def get_job_stats():
+    """Количество задач по статусам во всех воркерах для /health"""
+    stats = {"queued": 0, "processing": 0, "transcribing": 0, "completed": 0, "failed": 0}
+    stats.update(state_store.count_jobs())
+    stats["workers"] = JOB_WORKERS
+    return stats
+
+# === Планировщик: квоты клиентов, справедливая очередь и ограничение нагрузки ===
+# Любая обработка (синхронный /transcribe или фоновая задача) сначала получает слот.
+# Слоты раздаются по взвешенной справедливой очереди: у каждого клиента своя очередь
+# и виртуальное время, которое растёт на 1/вес за каждую запущенную задачу, поэтому
+# всплеск от одного клиента не задерживает остальных. Переполненная очередь и нехватка
+# временного диска сразу дают 429 с Retry-After, ещё до чтения тела запроса.
+MAX_RUNNING_JOBS = int(os.environ.get("MAX_RUNNING_JOBS", JOB_WORKERS))
+TENANT_MAX_CONCURRENT = int(os.environ.get("TENANT_MAX_CONCURRENT", 2))
+QUEUE_MAX_DEPTH = int(os.environ.get("QUEUE_MAX_DEPTH", 100))
+TENANT_MAX_QUEUED = int(os.environ.get("TENANT_MAX_QUEUED", 20))
+TEMP_DISK_MAX_BYTES = int(os.environ.get("TEMP_DISK_MAX_BYTES", 5 * 1024 * 1024 * 1024))  # 5 GB
+RETRY_AFTER_MAX_SECONDS = 600
+TENANT_HEADER = "X-API-Key"
+# Веса клиентов: "ключ_или_id=вес,..." (ключ API, X-Uploader-ID или IP), по умолчанию 1
+def parse_tenant_weights(value):
+    """TENANT_WEIGHTS="ключ=вес,...": веса должны быть положительными числами, остальные пропускаются"""
+    weights = {}
+    for name, _, weight in (item.partition("=") for item in value.split(",")):
+        name = name.strip()
+        if not name or not weight:
+            continue
+        try:
+            weights[name] = float(weight)
+        except ValueError:
+            weights[name] = 0.0
+        # Нулевой вес ломает виртуальное время планировщика, отрицательный отнимает очередь у остальных
+        if not (weights[name] > 0 and math.isfinite(weights[name])):
+            logger.warning(f"⚠️ TENANT_WEIGHTS: некорректный вес '{weight}' для '{name}', используется 1.0")
+            del weights[name]
+    return weights
+
+TENANT_WEIGHTS = parse_tenant_weights(os.environ.get("TENANT_WEIGHTS", ""))
+
+metrics.describe("voicesum_queue_depth", "gauge", "Задачи, ожидающие слота обработки")
+metrics.describe("voicesum_queue_wait_seconds", "histogram", "Ожидание слота обработки")
+metrics.describe("voicesum_admission_rejected_total", "counter", "Запросы, отклонённые с 429, по причине")
+metrics.describe("voicesum_temp_disk_reserved_bytes", "gauge", "Зарезервированное место во временной папке")
+
+class AdmissionRejected(Exception):
+    """Сервис перегружен (429) или останавливается (503): клиенту отвечаем с Retry-After"""
+    def __init__(self, message, reason, retry_after, status_code=429):
+        super().__init__(message)
+        self.reason = reason
+        self.retry_after = retry_after
+        self.status_code = status_code
+
+def resolve_tenant(api_key=None, uploader=None, remote_addr=None):
+    """(id клиента, вес): ключ API, иначе X-Uploader-ID, иначе IP"""
+    name = api_key or uploader or remote_addr or "anonymous"
+    weight = TENANT_WEIGHTS.get(name, 1.0)
+    # Сам ключ не храним и не показываем в статистике
+    tenant_id = f"key:{hashlib.sha256(api_key.encode()).hexdigest()[:12]}" if api_key else name[:64]
+    return tenant_id, weight
+
+def get_request_tenant():
+    return resolve_tenant(request.headers.get(TENANT_HEADER), request.headers.get(UPLOADER_HEADER), request.remote_addr)
+
+class FairJobScheduler:
+    """Взвешенная справедливая очередь с лимитами на клиента и на весь сервис.
+    
+    submit() ставит заявку в очередь клиента и вызывает on_grant(ticket), когда
+    для неё освобождается слот; release() освобождает слот или убирает заявку
+    из очереди. on_grant вызывается вне блокировки и не должен блокироваться.
+    После drain() новые заявки отклоняются, а ожидающие получают on_cancel(ticket).
+    
+    Очереди у каждого воркера свои, а занятые слоты (всего и по клиентам) хранятся
+    в state_store.worker_usage, поэтому max_running и tenant_max_concurrent действуют
+    на все воркеры сразу. Слоты, освобождённые другими воркерами, раздаёт poll().
+    """
+    
+    def __init__(self, max_running, tenant_max_concurrent, max_queued, tenant_max_queued):
+        self.max_running = max_running
+        self.tenant_max_concurrent = tenant_max_concurrent
+        self.max_queued = max_queued
+        self.tenant_max_queued = tenant_max_queued
+        self.lock = threading.Lock()
+        self.tenants = {}  # id -> {"queue", "running", "vtime", "weight"}
+        self.virtual_clock = 0.0
+        self.running = 0
+        self.queued = 0
+        self.avg_job_seconds = 60.0  # скользящее среднее для оценки Retry-After
+        self.others_running = 0  # слоты других воркеров при последней раздаче
+        self.draining = False
+        self.stats = Counter()
+    
+    def _retry_after(self):
+        waves = (self.queued + self.running + self.others_running) / max(self.max_running, 1)
+        return int(min(max(waves * self.avg_job_seconds, 1), RETRY_AFTER_MAX_SECONDS))
+    
+    def _reject(self, message, reason, retry_after=None, status_code=429):
+        self.stats[f"rejected_{reason}"] += 1
+        metrics.inc("voicesum_admission_rejected_total", reason=reason)
+        raise AdmissionRejected(message, reason, retry_after or self._retry_after(), status_code)
+    
+    def _check(self, tenant_id):
+        if self.draining:
+            # Остальные воркеры принимают работу, повтор через несколько секунд попадёт к ним
+            self._reject("Сервис перезапускается, повторите позже", "draining", 5, 503)
+        if self.queued >= self.max_queued:
+            self._reject("Сервис перегружен, повторите позже", "queue_full")
+        state = self.tenants.get(tenant_id)
+        if state and len(state["queue"]) >= self.tenant_max_queued:
+            self._reject("Слишком много задач в очереди от одного клиента", "tenant_queue_full")
+    
+    def check(self, tenant_id):
+        """Быстрая проверка перед приёмом файла: AdmissionRejected, если заявку не примем"""
+        with self.lock:
+            self._check(tenant_id)
+    
+    def submit(self, tenant_id, weight, on_grant, on_cancel=None):
+        with self.lock:
+            self._check(tenant_id)
+            state = self.tenants.get(tenant_id)
+            if state is None:
+                # Новый или вернувшийся клиент не получает "накопленного" приоритета
+                state = self.tenants[tenant_id] = {"queue": deque(), "running": 0, "vtime": self.virtual_clock}
+            state["weight"] = weight
+            ticket = {"tenant": tenant_id, "on_grant": on_grant, "on_cancel": on_cancel, "state": "queued", "enqueued_at": time.time()}
+            state["queue"].append(ticket)
+            self.queued += 1
+            self.stats["submitted"] += 1
+            granted = self._dispatch()
+        self._grant(granted)
+        return ticket
+    
+    def release(self, ticket):
+        with self.lock:
+            if ticket["state"] in ("cancelled", "done"):
+                return
+            state = self.tenants[ticket["tenant"]]
+            if ticket["state"] == "queued":
+                state["queue"].remove(ticket)
+                self.queued -= 1
+            elif ticket["state"] == "running":
+                state["running"] -= 1
+                self.running -= 1
+                self.avg_job_seconds += 0.2 * (time.time() - ticket["granted_at"] - self.avg_job_seconds)
+            ticket["state"] = "done"
+            if not state["queue"] and not state["running"]:
+                del self.tenants[ticket["tenant"]]
+            granted = self._dispatch()
+        self._grant(granted)
+    
+    def drain(self):
+        """Перестаёт принимать и запускать заявки; ожидающие получают on_cancel"""
+        with self.lock:
+            self.draining = True
+            cancelled = []
+            for tenant_id, state in list(self.tenants.items()):
+                while state["queue"]:
+                    ticket = state["queue"].popleft()
+                    ticket["state"] = "cancelled"
+                    cancelled.append(ticket)
+                if not state["running"]:
+                    del self.tenants[tenant_id]
+            self.queued = 0
+            metrics.set("voicesum_queue_depth", 0)
+        for ticket in cancelled:
+            if ticket["on_cancel"]:
+                ticket["on_cancel"](ticket)
+        return len(cancelled)
+    
+    def poll(self):
+        """Повторная раздача слотов, которые могли освободить другие воркеры"""
+        with self.lock:
+            if not self.queued:
+                return
+            granted = self._dispatch()
+        self._grant(granted)
+    
+    def _dispatch(self):
+        """Раздаёт свободные слоты и сохраняет занятые этим воркером в общем хранилище (под self.lock)"""
+        with state_store.worker_usage() as (others, own):
+            granted = self._dispatch_slots(others)
+            own["running"] = self.running
+            for resource in own:
+                if resource.startswith("tenant:") and resource[len("tenant:"):] not in self.tenants:
+                    own[resource] = 0
+            for tenant_id, state in self.tenants.items():
+                own[f"tenant:{tenant_id}"] = state["running"]
+            self.others_running = others["running"]
+        return granted
+    
+    def _dispatch_slots(self, others):
+        """Слоты клиентам с наименьшим виртуальным временем; others - занятое другими воркерами"""
+        granted = []
+        while self.running + others["running"] < self.max_running and not self.draining:
+            eligible = [
+                (state["vtime"], tenant_id) for tenant_id, state in self.tenants.items()
+                if state["queue"] and state["running"] + others[f"tenant:{tenant_id}"] < self.tenant_max_concurrent
+            ]
+            if not eligible:
+                break
+            vtime, tenant_id = min(eligible)
+            state = self.tenants[tenant_id]
+            ticket = state["queue"].popleft()
+            state["running"] += 1
+            state["vtime"] = vtime + 1 / state["weight"]
+            self.virtual_clock = vtime
+            self.running += 1
+            self.queued -= 1
+            ticket["state"] = "running"
+            ticket["granted_at"] = time.time()
+            metrics.observe("voicesum_queue_wait_seconds", ticket["granted_at"] - ticket["enqueued_at"])
+            granted.append(ticket)
+        metrics.set("voicesum_queue_depth", self.queued)
+        return granted
+    
+    def _grant(self, granted):
+        for ticket in granted:
+            ticket["on_grant"](ticket)
+    
+    def get_stats(self):
+        with self.lock:
+            return {
+                "running": self.running,
+                "other_workers_running": self.others_running,
+                "max_running": self.max_running,
+                "queued": self.queued,
+                "max_queued": self.max_queued,
+                "tenant_max_concurrent": self.tenant_max_concurrent,
+                "active_tenants": len(self.tenants),
+                "avg_job_seconds": round(self.avg_job_seconds, 1),
+                "draining": self.draining,
+                **self.stats,
+            }
+
+class TempDiskBudget:
+    """Резерв места во временной папке под принимаемые и ожидающие обработки файлы.
+    
+    Лимит общий для всех воркеров: резерв каждого процесса хранится в state_store.worker_usage,
+    shared_bytes() - место возобновляемых загрузок, которые ещё не принадлежат ни одному процессу.
+    """
+    
+    def __init__(self, max_bytes, shared_bytes=None):
+        self.max_bytes = max_bytes
+        self.shared_bytes = shared_bytes
+        self.reserved = 0
+        self.others_reserved = 0  # резерв других воркеров при последнем изменении
+        self.lock = threading.Lock()
+    
+    def _update(self, nbytes, check=False):
+        with self.lock, state_store.worker_usage() as (others, own):
+            used = self.reserved + others["temp_disk"] + (self.shared_bytes() if self.shared_bytes else 0)
+            self.others_reserved = others["temp_disk"]
+            if check and self.max_bytes and used + nbytes > self.max_bytes:
+                metrics.inc("voicesum_admission_rejected_total", reason="temp_disk")
+                raise AdmissionRejected("Недостаточно временного места, повторите позже", "temp_disk", job_scheduler._retry_after())
+            self.reserved += nbytes
+            own["temp_disk"] = self.reserved
+            metrics.set("voicesum_temp_disk_reserved_bytes", self.reserved)
+        return nbytes
+    
+    def reserve(self, nbytes):
+        """Резервирует nbytes или бросает AdmissionRejected; возвращает зарезервированный объём"""
+        return self._update(nbytes, check=True)
+    
+    def adopt(self, nbytes):
+        """Учитывает файл, который уже лежит на диске и переходит к процессу (без проверки лимита)"""
+        return self._update(nbytes)
+    
+    def release(self, nbytes):
+        if nbytes:
+            self._update(-nbytes)
+    
+    def get_stats(self):
+        shared = self.shared_bytes() if self.shared_bytes else 0
+        with self.lock:
+            return {
+                "reserved_bytes": self.reserved,
+                "other_workers_bytes": self.others_reserved,
+                "shared_bytes": shared,
+                "max_bytes": self.max_bytes,
+            }
+
+job_scheduler = FairJobScheduler(MAX_RUNNING_JOBS, TENANT_MAX_CONCURRENT, QUEUE_MAX_DEPTH, TENANT_MAX_QUEUED)
+temp_disk = TempDiskBudget(TEMP_DISK_MAX_BYTES, shared_bytes=lambda: state_store.upload_bytes())
+
+@contextmanager
+def scheduled_slot(tenant):
+    """Слот обработки для синхронного запроса: ждёт своей очереди в справедливой очереди"""
+    granted = threading.Event()
+    ticket = job_scheduler.submit(*tenant, lambda ticket: granted.set(), on_cancel=lambda ticket: granted.set())
+    try:
+        granted.wait()
+        if ticket["state"] == "cancelled":
+            raise AdmissionRejected("Сервис перезапускается, повторите позже", "draining", 5, 503)
+        yield
+    finally:
+        job_scheduler.release(ticket)
+
+def admission_rejected_response(error):
+    return jsonify({"error": str(error), "retry_after": error.retry_after}), error.status_code, {"Retry-After": str(error.retry_after)}
+
+# === Возобновляемая загрузка по частям ===
+# Браузер загружает большой файл частями фиксированного размера (параллельно и с повторами),
+# каждая часть пишется на своё место в файл в SPOOL_DIR. Оборванная загрузка продолжается
+# с недостающих частей, а не с нуля; finalize передаёт готовый файл в очередь задач.
+# Файл и состояние загрузки общие для воркеров, поэтому части может принять любой из них.
+RESUMABLE_UPLOAD_MAX_BYTES = int(os.environ.get("RESUMABLE_UPLOAD_MAX_BYTES", 2 * 1024 * 1024 * 1024))  # 2 GB
+RESUMABLE_CHUNK_SIZE = int(os.environ.get("RESUMABLE_CHUNK_SIZE", 8 * 1024 * 1024))
+RESUMABLE_CHUNK_MIN = 1024 * 1024
+RESUMABLE_CHUNK_MAX = 64 * 1024 * 1024
+RESUMABLE_UPLOAD_TTL = int(os.environ.get("RESUMABLE_UPLOAD_TTL", 6 * 3600))  # секунды без новых частей
+CHUNK_DIGEST_HEADER = "X-Chunk-SHA256"
+
+metrics.describe("voicesum_upload_chunks_total", "counter", "Части возобновляемых загрузок по исходу")
+
+def _prune_upload_sessions():
+    """Удаляет брошенные загрузки, в которые не писали дольше RESUMABLE_UPLOAD_TTL"""
+    updated_before = time.time() - RESUMABLE_UPLOAD_TTL
+    for upload_id in state_store.stale_upload_sessions(updated_before):
+        session = state_store.delete_upload_session(upload_id, "uploading", updated_before)
+        if session is None:
+            continue
+        if os.path.exists(session["path"]):
+            os.remove(session["path"])
+        logger.info(f"🧹 Брошенная загрузка {upload_id} удалена")
+
+def _upload_session_view(session, status, received):
+    """Состояние загрузки для клиента: какие части уже получены"""
+    return {
+        "upload_id": session["id"],
+        "filename": session["filename"],
+        "size": session["size"],
+        "chunk_size": session["chunk_size"],
+        "chunks_total": session["chunks_total"],
+        "received_chunks": received,
+        "status": status,
+        "upload_url": f"/uploads/{session['id']}",
+    }
+
+def create_upload_session(filename, size, chunk_size=None, hints=None, sha256=None, tenant=("anonymous", 1.0)):
+    """Создаёт загрузку и резервирует файл нужного размера в общей папке воркеров"""
+    if not filename:
+        raise ProcessingError("Не указано имя файла", 400)
+    if not isinstance(size, int) or size <= 0:
+        raise ProcessingError("Некорректный размер файла", 400)
+    if size > RESUMABLE_UPLOAD_MAX_BYTES:
+        raise ProcessingError("Файл слишком большой", 413)
+    chunk_size = max(RESUMABLE_CHUNK_MIN, min(int(chunk_size or RESUMABLE_CHUNK_SIZE), RESUMABLE_CHUNK_MAX))
+    
+    # Резерв нужен только на время создания: дальше место учитывается по записи загрузки
+    # (temp_disk.shared_bytes), а после finalize переходит к задаче
+    job_scheduler.check(tenant[0])
+    temp_disk.reserve(size)
+    path = make_upload_path("resumable", filename, SPOOL_DIR)
+    upload_id = uuid.uuid4().hex
+    session = {
+        "id": upload_id,
+        "filename": filename,
+        "size": size,
+        "chunk_size": chunk_size,
+        "chunks_total": (size + chunk_size - 1) // chunk_size,
+        "path": path,
+        "hints": hints,
+        "tenant": list(tenant),
+        "sha256": sha256.lower() if sha256 else None,
+        "created_at": time.time(),
+    }
+    try:
+        with open(path, "wb") as out:
+            out.truncate(size)
+        _prune_upload_sessions()
+        state_store.add_upload_session(session)
+    except Exception:
+        if os.path.exists(path):
+            os.remove(path)
+        raise
+    finally:
+        temp_disk.release(size)
+    
+    logger.info(f"📦 Загрузка {upload_id} по частям: {size / 1024 / 1024:.1f} MB, {session['chunks_total']} частей")
+    return _upload_session_view(session, "uploading", [])
+
+def get_upload_session(upload_id):
+    found = state_store.get_upload_session(upload_id)
+    return _upload_session_view(*found) if found else None
+
+def write_upload_chunk(upload_id, offset, stream, length, digest=None):
+    """Пишет часть на её место в файле; часть засчитывается после проверки длины и SHA-256"""
+    found = state_store.get_upload_session(upload_id)
+    if found is None:
+        raise ProcessingError("Загрузка не найдена", 404)
+    session, status, _ = found
+    if status != "uploading":
+        raise ProcessingError("Загрузка уже завершается", 409)
+    index, remainder = divmod(offset, session["chunk_size"])
+    if offset < 0 or remainder or index >= session["chunks_total"]:
+        raise ProcessingError("Некорректное смещение части", 400)
+    if length != min(session["chunk_size"], session["size"] - offset):
+        raise ProcessingError("Некорректный размер части", 400)
+    if not state_store.begin_upload_write(upload_id):
+        raise ProcessingError("Загрузка уже завершается", 409)
+    
+    stored = False
+    try:
+        hasher = hashlib.sha256()
+        written = 0
+        with open(session["path"], "r+b") as out:
+            out.seek(offset)
+            while written < length:
+                block = stream.read(min(UPLOAD_CHUNK_SIZE, length - written))
+                if not block:
+                    break
+                hasher.update(block)
+                out.write(block)
+                written += len(block)
+        
+        if written != length:
+            raise ProcessingError("Часть получена не полностью", 400)
+        if digest and hasher.hexdigest() != digest.strip().lower():
+            raise ProcessingError("Контрольная сумма части не совпадает", 422)
+        stored = True
+    finally:
+        metrics.inc("voicesum_upload_chunks_total", outcome="stored" if stored else "rejected")
+        state_store.end_upload_write(upload_id, index if stored else None)
+    
+    return get_upload_session(upload_id)
+
+def abort_upload_session(upload_id):
+    """Отменяет загрузку и удаляет файл; False, если загрузки нет или она уже завершается"""
+    session = state_store.delete_upload_session(upload_id, "uploading")
+    if session is None:
+        return False
+    if os.path.exists(session["path"]):
+        os.remove(session["path"])
+    return True
+
+def finalize_upload_session(upload_id):
+    """Проверяет, что все части на месте, считает хэш файла и ставит задачу в очередь"""
+    found = state_store.get_upload_session(upload_id)
+    if found is None:
+        raise ProcessingError("Загрузка не найдена", 404)
+    session, status, received = found
+    if status != "uploading":
+        raise ProcessingError("Части ещё загружаются", 409)
+    missing = session["chunks_total"] - len(received)
+    if missing:
+        raise ProcessingError(f"Не загружено частей: {missing}", 409)
+    job_scheduler.check(session["tenant"][0])
+    if not state_store.set_upload_status(upload_id, "uploading", "finalizing"):
+        raise ProcessingError("Части ещё загружаются", 409)
+    
+    try:
+        hasher = hashlib.sha256()
+        with open(session["path"], "rb") as audio:
+            for block in iter(lambda: audio.read(UPLOAD_CHUNK_SIZE), b""):
+                hasher.update(block)
+        audio_hash = hasher.hexdigest()
+        if session["sha256"] and audio_hash != session["sha256"]:
+            raise ProcessingError("Контрольная сумма файла не совпадает", 422)
+    except Exception:
+        # Файл уже не восстановить перезагрузкой отдельных частей - загрузку начинают заново
+        state_store.delete_upload_session(upload_id)
+        if os.path.exists(session["path"]):
+            os.remove(session["path"])
+        raise
+    
+    # Место переходит от записи загрузки к задаче этого воркера
+    reserved_bytes = temp_disk.adopt(session["size"])
+    try:
+        job = submit_job(
+            session["path"], session["size"], session["filename"], audio_hash, session["hints"],
+            session["tenant"], reserved_bytes=reserved_bytes
+        )
+    except AdmissionRejected:
+        # Очередь заполнилась за время подсчёта хэша - файл цел, finalize можно повторить
+        temp_disk.release(reserved_bytes)
+        state_store.set_upload_status(upload_id, "finalizing", "uploading")
+        raise
+    
+    state_store.delete_upload_session(upload_id)
+    logger.info(f"📥 Загрузка {upload_id} собрана: {session['size'] / 1024 / 1024:.1f} MB")
+    return job
+
+def get_upload_session_stats():
+    return {
+        "active": state_store.count_upload_sessions(),
+        "chunk_size": RESUMABLE_CHUNK_SIZE,
+        "max_file_size": RESUMABLE_UPLOAD_MAX_BYTES,
+    }
+
+# === Пакетная обработка: конвейер загрузка → транскрипция → резюме ===
+# Пакет (много файлов или zip-архив в одном запросе) проходит конвейер из трёх этапов,
+# у каждого свой пул потоков: файл после загрузки в AssemblyAI сразу уходит ждать
+# транскрипцию, а пул загрузки берёт следующий. Поэтому время пакета определяется самым
+# медленным этапом, а не суммой всех. В справедливой очереди пакет занимает один слот
+# и держит в конвейере не больше TENANT_MAX_CONCURRENT файлов - столько же, сколько
+# клиент может выполнять обычных задач, поэтому пакет не обходит квоту клиента.
+BATCH_MAX_FILES = int(os.environ.get("BATCH_MAX_FILES", 100))
+BATCH_UPLOAD_PARALLELISM = int(os.environ.get("BATCH_UPLOAD_PARALLELISM", 4))
+BATCH_TRANSCRIPTION_PARALLELISM = int(os.environ.get("BATCH_TRANSCRIPTION_PARALLELISM", 8))
+BATCH_SUMMARY_PARALLELISM = int(os.environ.get("BATCH_SUMMARY_PARALLELISM", 4))
+BATCH_ARCHIVE_EXTENSIONS = (".zip",)
+
+batches = {}
+batches_lock = threading.Lock()
+
+metrics.describe("voicesum_batch_files_total", "counter", "Файлы пакетной обработки по итогу")
+metrics.describe("voicesum_batch_stage_active", "gauge", "Файлы, занимающие этап конвейера пакетной обработки")
+
+class MultipartBatchParser(MultipartUploadParser):
+    """Разбор multipart-тела с несколькими файлами в поле field_name.
+    
+    Каждый файл пишется на диск по мере поступления со своим хэшем; finish() возвращает
+    список загрузок в формате MultipartUploadParser.finish() с общими полями формы.
+    """
+    
+    def __init__(self, boundary, prefix="batch", field_name="files", max_files=BATCH_MAX_FILES, reserved_bytes=0):
+        super().__init__(boundary, prefix, field_name, reserved_bytes)
+        self.max_files = max_files
+        self.uploads = []
+        self._out = None
+    
+    def _accepts_file(self):
+        return True
+    
+    def _open_file(self, filename):
+        self._close_file()
+        if len(self.uploads) >= self.max_files:
+            raise ProcessingError(f"Слишком много файлов в пакете (не больше {self.max_files})", 413)
+        upload = {"path": make_upload_path(self.prefix, filename), "size": 0, "hash": None, "filename": filename, "form": self.upload["form"]}
+        self.uploads.append(upload)
+        self.hasher = hashlib.sha256()
+        self._out = open(upload["path"], "wb")
+    
+    def _file_data(self, data):
+        self._reserve_disk(len(data))
+        self.hasher.update(data)
+        self.uploads[-1]["size"] += len(data)
+        self._out.write(data)
+        return b""
+    
+    def _close_file(self):
+        if self._out is not None:
+            self._out.close()
+            self._out = None
+            self.uploads[-1]["hash"] = self.hasher.hexdigest()
+    
+    def finish(self):
+        self._close_file()
+        if not self.uploads:
+            raise ProcessingError("Файлы не загружены", 400)
+        logger.info(f"📥 Пакет сохранён: {len(self.uploads)} файлов, {sum(u['size'] for u in self.uploads) / 1024 / 1024:.1f} MB")
+        return self.uploads
+    
+    def discard(self):
+        """Закрывает и удаляет все уже записанные файлы"""
+        if self._out is not None:
+            self._out.close()
+            self._out = None
+        for upload in self.uploads:
+            if os.path.exists(upload["path"]):
+                os.remove(upload["path"])
+
+@timed_stage("save")
+def receive_batch_upload(reserved_bytes=0):
+    """Потоково принимает файлы пакета (поле files, можно несколько) во временную папку.
+    
+    Возвращает загрузки и весь резерв temp_disk под них вместе с переданным reserved_bytes.
+    """
+    parser = MultipartBatchParser(get_multipart_boundary(request.headers.get("Content-Type")), reserved_bytes=reserved_bytes)
+    try:
+        while not parser.complete:
+            parser.feed(request.stream.read(UPLOAD_CHUNK_SIZE))
+        return parser.finish(), parser.reserved_bytes
+    except RequestEntityTooLarge:
+        parser.discard()
+        temp_disk.release(parser.reserved_bytes - reserved_bytes)
+        raise ProcessingError("Пакет слишком большой", 413)
+    except ValueError as e:
+        parser.discard()
+        temp_disk.release(parser.reserved_bytes - reserved_bytes)
+        raise ProcessingError(f"Некорректные данные формы: {e}", 400)
+    except Exception:
+        parser.discard()
+        temp_disk.release(parser.reserved_bytes - reserved_bytes)
+        raise
+
+def expand_batch_archives(uploads):
+    """Заменяет zip-архивы пакета их файлами.
+    
+    Распакованный объём резервируется в temp_disk (возвращается вторым значением),
+    архив удаляется сразу после распаковки. При ошибке удаляет уже распакованное.
+    """
+    files, reserved_bytes = [], 0
+    try:
+        for upload in uploads:
+            if not upload["filename"].lower().endswith(BATCH_ARCHIVE_EXTENSIONS):
+                files.append(upload)
+                continue
+            if not zipfile.is_zipfile(upload["path"]):
+                raise ProcessingError(f"Архив {upload['filename']} повреждён", 400)
+            with zipfile.ZipFile(upload["path"]) as archive:
+                members = [
+                    info for info in archive.infolist()
+                    if not info.is_dir() and not info.filename.startswith("__MACOSX/")
+                    and not os.path.basename(info.filename).startswith(".")
+                ]
+                for info in members:
+                    if len(files) >= BATCH_MAX_FILES:
+                        raise ProcessingError(f"Слишком много файлов в пакете (не больше {BATCH_MAX_FILES})", 413)
+                    reserved_bytes += temp_disk.reserve(info.file_size)
+                    filename = os.path.basename(info.filename)
+                    member = {"path": make_upload_path("batch", filename), "size": 0, "hash": None, "filename": filename, "form": upload["form"]}
+                    files.append(member)
+                    hasher = hashlib.sha256()
+                    with archive.open(info) as source, open(member["path"], "wb") as out:
+                        for block in iter(lambda: source.read(UPLOAD_CHUNK_SIZE), b""):
+                            hasher.update(block)
+                            out.write(block)
+                            member["size"] += len(block)
+                    member["hash"] = hasher.hexdigest()
+            os.remove(upload["path"])
+            logger.info(f"🗜️ Архив {upload['filename']} распакован: {len(members)} файлов")
+    except Exception:
+        temp_disk.release(reserved_bytes)
+        for item in files + uploads:
+            if os.path.exists(item["path"]):
+                os.remove(item["path"])
+        raise
+    if not files:
+        raise ProcessingError("В пакете нет файлов", 400)
+    return files, reserved_bytes
+
+class StagedPipeline:
+    """Конвейер этапов с собственным пулом потоков у каждого.
+    
+    handler этапа получает элемент и возвращает True, чтобы передать его дальше,
+    или False, если элемент уже готов (например, результат нашёлся в кэше).
+    В конце вызывается on_done(item, error) - error равен None при успехе.
+    """
+    
+    def __init__(self, stages):
+        self.stages = [name for name, _ in stages]
+        self.parallelism = dict(stages)
+        self.executors = {
+            name: ThreadPoolExecutor(max_workers=workers, thread_name_prefix=f"voicesum-batch-{name}")
+            for name, workers in stages
+        }
+        self.lock = threading.Lock()
+        self.active = Counter()
+        self.waiting = Counter()
+    
+    def submit(self, item, handlers, on_done):
+        self._schedule(0, item, handlers, on_done)
+    
+    def _schedule(self, index, item, handlers, on_done):
+        name = self.stages[index]
+        with self.lock:
+            self.waiting[name] += 1
+        self.executors[name].submit(self._run, index, item, handlers, on_done)
+    
+    def _run(self, index, item, handlers, on_done):
+        name = self.stages[index]
+        with self.lock:
+            self.waiting[name] -= 1
+            self.active[name] += 1
+            metrics.set("voicesum_batch_stage_active", self.active[name], stage=name)
+        try:
+            proceed = handlers[name](item)
+        except Exception as e:
+            on_done(item, e)
+            return
+        finally:
+            with self.lock:
+                self.active[name] -= 1
+                metrics.set("voicesum_batch_stage_active", self.active[name], stage=name)
+        if proceed and index + 1 < len(self.stages):
+            self._schedule(index + 1, item, handlers, on_done)
+        else:
+            on_done(item, None)
+    
+    def get_stats(self):
+        with self.lock:
+            return {
+                name: {"parallelism": self.parallelism[name], "active": self.active[name], "waiting": self.waiting[name]}
+                for name in self.stages
+            }
+
+batch_pipeline = StagedPipeline([
+    ("upload", BATCH_UPLOAD_PARALLELISM),
+    ("transcription", BATCH_TRANSCRIPTION_PARALLELISM),
+    ("summary", BATCH_SUMMARY_PARALLELISM),
+])
+
+def _batch_file_view(item, with_result=False):
+    view = {
+        "index": item["index"],
+        "filename": item["filename"],
+        "file_size": item["file_size"],
+        "status": item["status"],
+        "stage_seconds": {stage: round(seconds, 2) for stage, seconds in item["stage_seconds"].items()},
+        "error": item["error"],
+        "result_url": f"/batches/{item['batch_id']}/files/{item['index']}",
+    }
+    if with_result:
+        view["result"] = item["result"]
+    return view
+
+def _batch_view(batch, with_results=False):
+    """Прогресс пакета: файлы по статусам, суммарное время этапов и файлы"""
+    files = batch["files"]
+    finished_at = batch["finished_at"] or time.time()
+    stage_totals = Counter()
+    for item in files:
+        stage_totals.update(item["stage_seconds"])
+    return {
+        "batch_id": batch["id"],
+        "status": batch["status"],
+        "files_total": len(files),
+        "files_by_status": dict(Counter(item["status"] for item in files)),
+        "created_at": batch["created_at"],
+        "started_at": batch["started_at"],
+        "finished_at": batch["finished_at"],
+        "wall_seconds": round(finished_at - batch["started_at"], 2) if batch["started_at"] else 0,
+        # Сумма по файлам: при конвейерной обработке wall_seconds заметно меньше суммы этапов
+        "stage_seconds": {stage: round(stage_totals[stage], 2) for stage in batch_pipeline.stages},
+        "files": [_batch_file_view(item, with_results) for item in files],
+        "status_url": f"/batches/{batch['id']}",
+    }
+
+def _prune_batches():
+    """Удаляет завершённые пакеты старше JOB_RESULT_TTL (вызывать под batches_lock)"""
+    now = time.time()
+    expired = [
+        batch_id for batch_id, batch in batches.items()
+        if batch["finished_at"] and now - batch["finished_at"] > JOB_RESULT_TTL
+    ]
+    for batch_id in expired:
+        del batches[batch_id]
+
+def _persist_batch(batch_id, item=None):
+    """Сохраняет прогресс пакета (и готовый файл item с результатом) для других воркеров"""
+    with batches_lock:
+        batch = batches.get(batch_id)
+        if batch is None:
+            return
+        view = _batch_view(batch)
+        files = [_batch_file_view(item, with_result=True)] if item is not None else []
+    state_store.save_batch(view, files)
+
+def _set_batch_file_stage(item, status):
+    with batches_lock:
+        item["status"] = status
+    item["stage_started_at"] = time.time()
+    _persist_batch(item["batch_id"])
+
+def _finish_batch_stage(item, stage):
+    seconds = time.time() - item["stage_started_at"]
+    with batches_lock:
+        item["stage_seconds"][stage] = seconds
+
+def _batch_upload(item):
+    """Этап 1: кэш, признаки входа, перекодирование и загрузка в AssemblyAI"""
+    _set_batch_file_stage(item, "uploading")
+    work = item["work"]
+    cached = get_cached_result(work["audio_hash"], work["start_time"])
+    if cached is not None:
+        work["result"] = cached
+        _finish_batch_stage(item, "upload")
+        return False
+    
+    features = describe_input(work["input_path"], item["file_size"], work["hints"]) if strategy_scheduler else None
+    if AUDIO_NORMALIZATION_ENABLED:
+        work["audio_path"] = normalize_audio(work["input_path"], work["pipeline_info"])
+    work["features"] = features
+    work["strategies"] = plan_strategies(work["audio_path"], features, work["pipeline_info"])
+    # Длинные записи загружаются посегментно на этапе транскрипции
+    work["duration"] = get_chunked_duration(work["audio_path"])
+    if not work["duration"]:
+        work["audio_url"] = upload_audio(work["audio_path"])
+    _finish_batch_stage(item, "upload")
+    return True
+
+def _batch_transcribe(item):
+    """Этап 2: ожидание транскрипции; результат сразу переводится в CompactTranscript"""
+    _set_batch_file_stage(item, "transcribing")
+    work = item["work"]
+    if work["duration"]:
+        transcript, method = transcribe_chunked(work["audio_path"], work["duration"], work["strategies"], work["pipeline_info"])
+    else:
+        transcript, method = transcribe_uploaded(work["audio_url"], work["strategies"], work["features"])
+    work["transcript"] = CompactTranscript.from_transcript(transcript)
+    work["method"] = method
+    _finish_batch_stage(item, "transcription")
+    return True
+
+def _batch_summarize(item):
+    """Этап 3: резюме LLM, анализ и сохранение результата"""
+    _set_batch_file_stage(item, "summarizing")
+    work = item["work"]
+    work["result"] = build_result(
+        work["transcript"], work["method"], item["file_size"], work["start_time"], work["pipeline_info"],
+        work["audio_hash"], filename=item["filename"]
+    )
+    _finish_batch_stage(item, "summary")
+    return True
+
+BATCH_STAGE_HANDLERS = {"upload": _batch_upload, "transcription": _batch_transcribe, "summary": _batch_summarize}
+
+def _discard_batch_file(item):
+    """Удаляет временные файлы элемента пакета и освобождает его резерв temp_disk"""
+    work = item.pop("work")
+    for path in {work["input_path"], work["audio_path"]}:
+        if os.path.exists(path):
+            os.remove(path)
+    temp_disk.release(item["file_size"])
+    return work
+
+def _batch_file_done(item, error):
+    """Итог файла: результат или ошибка, удаление временных файлов; последний файл завершает пакет"""
+    work = _discard_batch_file(item)
+    change_jobs_in_flight(-1)
+    
+    if error is None:
+        logger.info(f"✅ Пакет {item['batch_id']}: файл {item['filename']} готов")
+    else:
+        logger.error(f"❌ Пакет {item['batch_id']}: файл {item['filename']} завершился ошибкой: {error}")
+    metrics.inc("voicesum_batch_files_total", status="failed" if error else "completed")
+    
+    with batches_lock:
+        batch = batches[item["batch_id"]]
+        batch["in_flight"] -= 1
+        if item["status"] in ("completed", "failed"):
+            return  # файл уже помечен прерванным при остановке воркера
+        item["status"] = "failed" if error else "completed"
+        item["result"] = work["result"] if error is None else None
+        item["error"] = f"Ошибка: {str(error)[:300]}" if error else None
+        batch["remaining"] -= 1
+        finished = batch["remaining"] == 0
+        if finished:
+            batch["status"] = "completed"
+            batch["finished_at"] = time.time()
+    _persist_batch(item["batch_id"], item)
+    if finished:
+        job_scheduler.release(batch["ticket"])
+        logger.info(f"🏁 Пакет {batch['id']} завершён за {batch['finished_at'] - batch['started_at']:.1f}с")
+    else:
+        _feed_batch_pipeline(batch["id"])
+
+def interrupt_batch(batch_id):
+    """Помечает незавершённые файлы пакета прерванными (остановка воркера); результаты готовых сохраняются"""
+    with batches_lock:
+        batch = batches.get(batch_id)
+        if batch is None or batch["finished_at"]:
+            return
+        interrupted = [item for item in batch["files"] if item["status"] not in ("completed", "failed")]
+        for item in interrupted:
+            item["status"] = "failed"
+            item["error"] = "Обработка прервана остановкой сервиса, отправьте файл повторно"
+        batch["remaining"] = 0
+        batch["status"] = "completed"
+        batch["finished_at"] = time.time()
+        batch["started_at"] = batch["started_at"] or batch["finished_at"]
+        # Файлы в конвейере уберёт _batch_file_done, не отправленные - здесь
+        pending = list(batch["pending"])
+        batch["pending"].clear()
+    for item in pending:
+        _discard_batch_file(item)
+    for item in interrupted:
+        _persist_batch(batch_id, item)
+    if batch["ticket"] is not None:
+        job_scheduler.release(batch["ticket"])
+    logger.warning(f"⚠️ Пакет {batch_id}: прервано файлов - {len(interrupted)}")
+
+def _start_batch(batch_id, ticket):
+    """Слот выдан: файлы пакета уходят в конвейер по мере освобождения квоты клиента"""
+    with batches_lock:
+        batch = batches[batch_id]
+        batch["ticket"] = ticket
+        batch["status"] = "processing"
+        batch["started_at"] = time.time()
+    _persist_batch(batch_id)
+    logger.info(f"⚙️ Пакет {batch_id} запущен: {len(batch['files'])} файлов")
+    _feed_batch_pipeline(batch_id)
+
+def _feed_batch_pipeline(batch_id):
+    """Отправляет в конвейер следующие файлы пакета, пока в работе меньше TENANT_MAX_CONCURRENT"""
+    with batches_lock:
+        batch = batches[batch_id]
+        items = []
+        while batch["pending"] and batch["in_flight"] < job_scheduler.tenant_max_concurrent:
+            items.append(batch["pending"].popleft())
+            batch["in_flight"] += 1
+    for item in items:
+        item["work"]["start_time"] = time.time()
+        change_jobs_in_flight(1)
+        batch_pipeline.submit(item, BATCH_STAGE_HANDLERS, _batch_file_done)
+
+def submit_batch(uploads, hints=None, tenant=("anonymous", 1.0)):
+    """Регистрирует пакет и ставит его в справедливую очередь одной заявкой.
+    
+    Файлы пакета и их резерв temp_disk (по размеру файла) с этого момента принадлежат
+    пакету. При переполненной очереди бросает AdmissionRejected, файлы остаются у вызывающего.
+    """
+    batch_id = uuid.uuid4().hex
+    files = [
+        {
+            "batch_id": batch_id,
+            "index": index,
+            "filename": upload["filename"],
+            "file_size": upload["size"],
+            "status": "queued",
+            "stage_seconds": {},
+            "result": None,
+            "error": None,
+            "work": {
+                "input_path": upload["path"],
+                "audio_path": upload["path"],
+                "audio_hash": upload["hash"],
+                "hints": hints,
+                "pipeline_info": {},
+                "result": None,
+            },
+        }
+        for index, upload in enumerate(uploads)
+    ]
+    batch = {
+        "id": batch_id,
+        "status": "queued",
+        "files": files,
+        "remaining": len(files),
+        "pending": deque(files),  # файлы, ещё не отправленные в конвейер
+        "in_flight": 0,
+        "ticket": None,
+        "created_at": time.time(),
+        "started_at": None,
+        "finished_at": None,
+    }
+    with batches_lock:
+        _prune_batches()
+        batches[batch_id] = batch
+    _persist_batch(batch_id)
+    
+    try:
+        job_scheduler.submit(*tenant, lambda ticket: _start_batch(batch_id, ticket), on_cancel=lambda ticket: interrupt_batch(batch_id))
+    except AdmissionRejected:
+        with batches_lock:
+            del batches[batch_id]
+        state_store.delete_batch(batch_id)
+        raise
+    logger.info(f"📬 Пакет {batch_id} из {len(files)} файлов поставлен в очередь")
+    return get_batch_snapshot(batch_id)
+
+def get_batch_snapshot(batch_id, with_results=False):
+    """Прогресс пакета (своего или другого воркера) или None"""
+    with batches_lock:
+        batch = batches.get(batch_id)
+        if batch:
+            return _batch_view(batch, with_results)
+    view = state_store.load_batch(batch_id)
+    if view and with_results:
+        results = state_store.load_batch_files(batch_id)
+        for item in view["files"]:
+            item["result"] = results.get(item["index"], {}).get("result")
+    return view
+
+def get_batch_file(batch_id, index):
+    """Файл пакета с результатом или None"""
+    with batches_lock:
+        batch = batches.get(batch_id)
+        if batch is not None:
+            if not 0 <= index < len(batch["files"]):
+                return None
+            return _batch_file_view(batch["files"][index], with_result=True)
+    item = state_store.load_batch_files(batch_id, index).get(index)
+    if item is None:
+        view = state_store.load_batch(batch_id)
+        if view is None or not 0 <= index < len(view["files"]):
+            return None
+        item = {**view["files"][index], "result": None}
+    return item
+
+def get_batch_stats():
+    return {"by_status": state_store.count_batches(), "stages": batch_pipeline.get_stats()}
+
+# === Завершение транскрипции по вебхуку AssemblyAI ===
+# С WEBHOOK_BASE_URL задача только загружает файл и отправляет транскрипцию с вебхуком,
+# после чего воркер свободен; резюме и анализ выполняются по вызову /webhooks/assemblyai.
+WEBHOOK_BASE_URL = os.environ.get("WEBHOOK_BASE_URL", "").rstrip("/")  # публичный адрес сервиса
+WEBHOOK_ENABLED = bool(WEBHOOK_BASE_URL)
+WEBHOOK_SECRET = os.environ.get("WEBHOOK_SECRET", "")
+WEBHOOK_AUTH_HEADER = "X-Voicesum-Webhook-Secret"
+WEBHOOK_SWEEP_SECONDS = int(os.environ.get("WEBHOOK_SWEEP_SECONDS", 300))
+JOB_STORE_PATH = os.environ.get("JOB_STORE_PATH", os.path.join(tempfile.gettempdir(), "voicesum_jobs.sqlite3"))
+
+metrics.describe("voicesum_webhook_pending", "gauge", "Транскрипции, ожидающие вебхука")
+metrics.describe("voicesum_webhook_events_total", "counter", "Вебхуки AssemblyAI по исходу")
+
+class PendingTranscriptStore(SQLiteStore):
+    """Транскрипции, ожидающие вебхука, в SQLite.
+    
+    Ключ - ID транскрипта AssemblyAI, запись - всё, что нужно для завершения задачи,
+    поэтому ожидающие задачи переживают перезапуск процесса.
+    """
+    
+    SCHEMA = (
+        "CREATE TABLE IF NOT EXISTS pending_transcripts ("
+        "transcript_id TEXT PRIMARY KEY, job_id TEXT NOT NULL, "
+        "submitted_at REAL NOT NULL, record TEXT NOT NULL)",
+    )
+    
+    def add(self, transcript_id, record):
+        with self._connect() as conn:
+            conn.execute(
+                "INSERT OR REPLACE INTO pending_transcripts VALUES (?, ?, ?, ?)",
+                (transcript_id, record["job_id"], time.time(), json.dumps(record, ensure_ascii=False))
+            )
+    
+    def claim(self, transcript_id):
+        """Забирает запись ровно один раз (повторные вебхуки получают None)"""
+        with self._connect() as conn:
+            row = conn.execute(
+                "SELECT record FROM pending_transcripts WHERE transcript_id = ?", (transcript_id,)
+            ).fetchone()
+            if row is None:
+                return None
+            deleted = conn.execute(
+                "DELETE FROM pending_transcripts WHERE transcript_id = ?", (transcript_id,)
+            ).rowcount
+        return json.loads(row[0]) if deleted else None
+    
+    def list(self, submitted_before=None):
+        """Пары (transcript_id, запись), отправленные раньше submitted_before"""
+        query = "SELECT transcript_id, record FROM pending_transcripts"
+        params = ()
+        if submitted_before is not None:
+            query += " WHERE submitted_at < ?"
+            params = (submitted_before,)
+        with self._connect() as conn:
+            rows = conn.execute(query + " ORDER BY submitted_at", params).fetchall()
+        return [(transcript_id, json.loads(record)) for transcript_id, record in rows]
+    
+    def count(self):
+        with self._connect() as conn:
+            return conn.execute("SELECT COUNT(*) FROM pending_transcripts").fetchone()[0]
+
+pending_transcripts = PendingTranscriptStore(JOB_STORE_PATH) if WEBHOOK_ENABLED else None
+
+def submit_webhook_job(job_id, input_path, file_size, start_time, audio_hash, on_event, hints=None):
+    """Загружает файл и отправляет первую стратегию с вебхуком.
+    
+    Возвращает None, если задача ждёт вебхука, или готовый результат - из кэша
+    или для длинной записи, которая транскрибируется по сегментам прямо в воркере.
+    """
+    if CHUNKED_TRANSCRIPTION_ENABLED:
+        duration = get_audio_duration(input_path)
+        if duration and duration >= CHUNK_MIN_DURATION:
+            return process_audio_file(input_path, file_size, start_time, audio_hash, on_event, get_job_snapshot(job_id)["filename"], hints)
+    
+    cached = get_cached_result(audio_hash, start_time)
+    if cached is not None:
+        return cached
+    
+    pipeline_info = {}
+    features = describe_input(input_path, file_size, hints) if strategy_scheduler else None
+    audio_path = input_path
+    try:
+        if AUDIO_NORMALIZATION_ENABLED:
+            audio_path = normalize_audio(input_path, pipeline_info)
+        
+        strategies = plan_strategies(audio_path, features, pipeline_info)
+        
+        audio_url = upload_audio(audio_path)
+        on_event("upload_done", {"bytes": os.path.getsize(audio_path)})
+    finally:
+        if audio_path != input_path and os.path.exists(audio_path):
+            os.remove(audio_path)
+    
+    job = get_job_snapshot(job_id)
+    with jobs_lock:
+        tenant = job_inputs.get(job_id, {}).get("tenant", ["anonymous", 1.0])
+    record = {
+        "job_id": job_id,
+        "tenant": tenant,
+        "filename": job["filename"],
+        "file_size": file_size,
+        "created_at": job["created_at"],
+        "start_time": start_time,
+        "audio_hash": audio_hash,
+        "audio_url": audio_url,
+        "strategies": [strategy["method"] for strategy in strategies],
+        "strategy_index": 0,
+        "features": features,
+        "pipeline": pipeline_info,
+        "errors": [],
+    }
+    # Статус меняем до отправки: вебхук может прийти раньше, чем мы отсюда вернёмся
+    _update_job(job_id, status="transcribing")
+    on_event("transcribing", {})
+    submit_next_strategy(record)
+    return None
+
+def submit_next_strategy(record):
+    """Отправляет стратегию record["strategy_index"], при ошибке отправки - следующие"""
+    webhook_url = f"{WEBHOOK_BASE_URL}/webhooks/assemblyai"
+    while record["strategy_index"] < len(record["strategies"]):
+        strategy = STRATEGIES_BY_METHOD[record["strategies"][record["strategy_index"]]]
+        try:
+            logger.info(strategy["start_message"])
+            config = strategy["config"]().set_webhook(
+                webhook_url,
+                WEBHOOK_AUTH_HEADER if WEBHOOK_SECRET else None,
+                WEBHOOK_SECRET or None
+            )
+            transcript = aai.Transcriber(client=assemblyai_client, config=config).submit(record["audio_url"])
+            record["submitted_at"] = time.time()
+            pending_transcripts.add(transcript.id, record)
+            logger.info(f"📨 Транскрипция {transcript.id} отправлена, ждём вебхук (задача {record['job_id']})")
+            return
+        except Exception as e:
+            logger.warning(f"⚠️ Стратегия '{strategy['title']}' не сработала: {e}")
+            record["errors"].append(f"{strategy['title']}({e})")
+            record["strategy_index"] += 1
+    
+    logger.error(f"❌ Все методы не сработали: {', '.join(record['errors'])}")
+    raise RuntimeError("Не удалось транскрибировать файл всеми доступными методами")
+
+def _restore_job(record):
+    """Возвращает задачу в память, если процесс перезапускался, пока она ждала вебхука"""
+    job_id = record["job_id"]
+    first_event = state_store.next_job_event_index(job_id)
+    with jobs_lock:
+        if job_id in jobs:
+            return
+        jobs[job_id] = {
+            "id": job_id,
+            "status": "transcribing",
+            "filename": record["filename"],
+            "file_size": record["file_size"],
+            "created_at": record["created_at"],
+            "started_at": record["start_time"],
+            "finished_at": None,
+            "result": None,
+            "error": None,
+        }
+        job_events[job_id] = []
+        job_event_offsets[job_id] = first_event
+    publish_job_event(job_id, "transcribing", {})
+
+def complete_webhook_transcript(transcript_id, record, ticket=None):
+    """Завершает задачу по вебхуку: следующая стратегия при неудаче, иначе резюме и анализ.
+    
+    Выполняется в слоте планировщика (ticket), как и любая другая обработка.
+    """
+    job_id = record["job_id"]
+    _restore_job(record)
+    on_event = lambda event, data: publish_job_event(job_id, event, data)
+    strategy = STRATEGIES_BY_METHOD[record["strategies"][record["strategy_index"]]]
+    
+    try:
+        try:
+            transcript = fetch_transcript(transcript_id)
+            check_strategy_result(strategy, transcript)
+            transcript = CompactTranscript.from_transcript(transcript)
+        except Exception as e:
+            record_strategy_outcome(strategy, time.time() - record["submitted_at"], "failure", record.get("features"))
+            logger.warning(f"⚠️ Стратегия '{strategy['title']}' не сработала: {e}")
+            record["errors"].append(f"{strategy['title']}({e})")
+            record["strategy_index"] += 1
+            submit_next_strategy(record)
+            return
+        
+        record_strategy_outcome(strategy, time.time() - record["submitted_at"], "success", record.get("features"))
+        logger.info(strategy["success_message"])
+        on_event("strategy_chosen", {"method": strategy["method"]})
+        _update_job(job_id, status="processing")
+        
+        change_jobs_in_flight(1)
+        try:
+            result = build_result(
+                transcript, strategy["method"], record["file_size"], record["start_time"],
+                record["pipeline"], record["audio_hash"], on_event, record["filename"]
+            )
+        finally:
+            change_jobs_in_flight(-1)
+        _complete_job(job_id, result)
+    except Exception as e:
+        _fail_job(job_id, e)
+    finally:
+        if ticket is not None:
+            job_scheduler.release(ticket)
+
+def dispatch_webhook_completion(transcript_id):
+    """Ставит завершение транскрипции в справедливую очередь клиента задачи.
+    
+    Возвращает "accepted", "ignored" (ID неизвестен или уже обработан) или "deferred":
+    очередь переполнена либо воркер останавливается, запись возвращается в ожидающие
+    и её позже подберёт sweep_pending_transcripts (этого или другого воркера).
+    """
+    record = pending_transcripts.claim(transcript_id)
+    if record is None:
+        return "ignored"
+    
+    def start(ticket):
+        job_executor.submit(complete_webhook_transcript, transcript_id, record, ticket)
+    
+    # Записи, сохранённые до появления поля tenant, идут в общую очередь
+    tenant = record.get("tenant") or ("anonymous", 1.0)
+    try:
+        job_scheduler.submit(*tenant, start, on_cancel=lambda ticket: pending_transcripts.add(transcript_id, record))
+    except AdmissionRejected as e:
+        logger.warning(f"⏳ Завершение транскрипции {transcript_id} отложено: {e}")
+        pending_transcripts.add(transcript_id, record)
+        return "deferred"
+    return "accepted"
+
+def sweep_pending_transcripts():
+    """Подбирает завершённые транскрипции, вебхук которых потерялся или пришёл раньше записи"""
+    while True:
+        time.sleep(WEBHOOK_SWEEP_SECONDS)
+        for transcript_id, _ in pending_transcripts.list(submitted_before=time.time() - WEBHOOK_SWEEP_SECONDS):
+            try:
+                status = fetch_transcript(transcript_id).status
+            except Exception as e:
+                logger.warning(f"⚠️ Не удалось проверить транскрипцию {transcript_id}: {e}")
+                continue
+            if status in (aai.TranscriptStatus.completed, aai.TranscriptStatus.error):
+                logger.info(f"🧹 Транскрипция {transcript_id} завершена без вебхука")
+                dispatch_webhook_completion(transcript_id)
+
+if WEBHOOK_ENABLED:
+    logger.info(f"🪝 Вебхуки AssemblyAI: {WEBHOOK_BASE_URL}/webhooks/assemblyai")
+
+# === Экспорт транскриптов: SRT, WebVTT, JSON Lines, текст ===
+# Документ собирается генератором по репликам из хранилища (страницами) и отдаётся
+# частями (chunked), при Accept-Encoding: gzip - сжатым потоком. Целиком в памяти
+# он не бывает, поэтому многочасовая запись начинает скачиваться сразу.
+EXPORT_FORMATS = {
+    "srt": "application/x-subrip; charset=utf-8",
+    "vtt": "text/vtt; charset=utf-8",
+    "jsonl": "application/x-ndjson; charset=utf-8",
+    "txt": "text/plain; charset=utf-8",
+}
+EXPORT_CUE_MAX_MS = 6000  # субтитр не дольше 6 секунд
+EXPORT_CUE_MAX_CHARS = 84  # и не длиннее двух строк по 42 символа
+EXPORT_CHUNK_BYTES = 64 * 1024  # размер части ответа до сжатия
+
+metrics.describe("voicesum_exports_total", "counter", "Экспорты транскриптов по формату")
+
+def _format_timestamp(ms, separator):
+    """00:01:02,345 для SRT (separator=",") или 00:01:02.345 для WebVTT"""
+    seconds, ms = divmod(max(ms, 0), 1000)
+    minutes, seconds = divmod(seconds, 60)
+    hours, minutes = divmod(minutes, 60)
+    return f"{hours:02d}:{minutes:02d}:{seconds:02d}{separator}{ms:03d}"
+
+def _utterance_cues(start, end, text, words):
+    """Субтитры реплики (start, end, text): по словам до EXPORT_CUE_MAX_MS / EXPORT_CUE_MAX_CHARS
+    с разрывом на конце предложения; без слов - реплика целиком"""
+    if not words:
+        if start is not None:
+            yield start, end, text.strip()
+        return
+    starts, ends, offsets = words
+    first = 0
+    for index in range(1, len(starts) + 1):
+        if index < len(starts):
+            sentence_end = text[offsets[index - 1]:offsets[index]].rstrip()[-1:] in (".", "!", "?", "…")
+            word_end = offsets[index + 1] if index + 1 < len(offsets) else len(text)
+            fits = ends[index] - starts[first] <= EXPORT_CUE_MAX_MS and word_end - offsets[first] <= EXPORT_CUE_MAX_CHARS
+            if fits and not sentence_end:
+                continue
+        cue_text = text[offsets[first]:offsets[index] if index < len(starts) else len(text)].strip()
+        if cue_text:
+            yield starts[first], ends[index - 1], cue_text
+        first = index
+
+def _utterance_word_list(text, words):
+    """[[начало, конец, слово], ...] для JSON Lines"""
+    starts, ends, offsets = words
+    return [
+        [starts[index], ends[index], text[offsets[index]:offsets[index + 1] if index + 1 < len(offsets) else len(text)].strip()]
+        for index in range(len(starts))
+    ]
+
+def iter_transcript_export(transcript_id, export_format, include_words=False):
+    """Строки документа в формате export_format по репликам сохранённого транскрипта"""
+    if export_format == "vtt":
+        yield "WEBVTT\n\n"
+    cue_number = 0
+    for start, end, speaker, text, words in transcript_store.iter_timeline(transcript_id):
+        if export_format == "jsonl":
+            line = {"start": start, "end": end, "speaker": speaker, "text": text}
+            if include_words and words:
+                line["words"] = _utterance_word_list(text, words)
+            yield json.dumps(line, ensure_ascii=False) + "\n"
+        elif export_format == "txt":
+            prefix = f"[{_format_timestamp(start, '.')[:8]}] " if start is not None else ""
+            yield f"{prefix}{speaker + ': ' if speaker else ''}{text}\n"
+        else:
+            for cue_start, cue_end, cue_text in _utterance_cues(start, end, text, words):
+                cue_number += 1
+                if export_format == "srt":
+                    label = f"[{speaker}] " if speaker else ""
+                    yield f"{cue_number}\n{_format_timestamp(cue_start, ',')} --> {_format_timestamp(cue_end, ',')}\n{label}{cue_text}\n\n"
+                else:
+                    label = f"<v {speaker}>" if speaker else ""
+                    yield f"{_format_timestamp(cue_start, '.')} --> {_format_timestamp(cue_end, '.')}\n{label}{cue_text}\n\n"
+
+def encode_export_stream(lines, compress=False):
+    """Склеивает строки в части по EXPORT_CHUNK_BYTES; с compress - поток gzip.
+    
+    Каждая сжатая часть сбрасывается (Z_SYNC_FLUSH), чтобы клиент мог разжимать её сразу.
+    """
+    compressor = zlib.compressobj(6, zlib.DEFLATED, 31) if compress else None
+    buffer, buffered = [], 0
+    for line in lines:
+        buffer.append(line)
+        buffered += len(line)
+        if buffered < EXPORT_CHUNK_BYTES:
+            continue
+        chunk = "".join(buffer).encode("utf-8")
+        buffer, buffered = [], 0
+        yield compressor.compress(chunk) + compressor.flush(zlib.Z_SYNC_FLUSH) if compressor else chunk
+    chunk = "".join(buffer).encode("utf-8")
+    yield compressor.compress(chunk) + compressor.flush() if compressor else chunk
+
+def export_transcript_response(transcript_id, export_format):
+    """Потоковый ответ с экспортом транскрипта (?words=1 - слова в JSON Lines)"""
+    if not transcript_store:
+        return jsonify({"error": "Хранилище транскриптов отключено"}), 404
+    if export_format not in EXPORT_FORMATS:
+        return jsonify({"error": f"Формат не поддерживается, доступны: {', '.join(EXPORT_FORMATS)}"}), 404
+    if not transcript_store.exists(transcript_id):
+        return jsonify({"error": "Транскрипт не найден"}), 404
+    
+    compress = request.accept_encodings["gzip"] > 0
+    metrics.inc("voicesum_exports_total", format=export_format)
+    lines = iter_transcript_export(transcript_id, export_format, request.args.get("words") == "1")
+    headers = {
+        "Content-Disposition": f'attachment; filename="transcript_{transcript_id}.{export_format}"',
+        "Vary": "Accept-Encoding",
+        "X-Accel-Buffering": "no",
+    }
+    if compress:
+        headers["Content-Encoding"] = "gzip"
+    return Response(
+        encode_export_stream(lines, compress),
+        content_type=EXPORT_FORMATS[export_format],
+        headers=headers
+    )
+
+# === Жизненный цикл воркера: запуск и плавная остановка ===
+# Под gunicorn приложение загружается в мастере (--preload), а init_worker() вызывается
+# в каждом воркере после fork (см. gunicorn.conf.py); без gunicorn - сразу при импорте.
+# Остановка: begin_shutdown() перестаёт принимать работу и сохраняет ожидающие задачи
+# в общем хранилище (их забирают другие воркеры), shutdown_worker() ждёт выполняющиеся
+# до SHUTDOWN_DRAIN_SECONDS, сохраняет оставшиеся и только потом удаляет свою папку.
+SHUTDOWN_DRAIN_SECONDS = int(os.environ.get("SHUTDOWN_DRAIN_SECONDS", 120))
+WORKER_MAINTENANCE_SECONDS = int(os.environ.get("WORKER_MAINTENANCE_SECONDS", 10))
+METRICS_DIR = os.path.join(TEMP_ROOT, "metrics")
+# Эти датчики считаются по общему хранилищу, суммировать их по воркерам нельзя
+SHARED_GAUGES = ("voicesum_jobs", "voicesum_webhook_pending")
+WORKER_INIT_DEFERRED = os.environ.get("VOICESUM_WORKER_INIT", "import") == "post_fork"
+
+shutdown_state = {"started_at": None, "deadline": None}
+worker_stop = threading.Event()
+
+def _process_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    return True
+
+def init_worker_temp_dir():
+    """Своя временная папка процесса; папки и метрики завершившихся процессов удаляются"""
+    global TEMP_DIR
+    os.makedirs(SPOOL_DIR, exist_ok=True)
+    os.makedirs(METRICS_DIR, exist_ok=True)
+    for name in os.listdir(TEMP_ROOT):
+        pid = name[len("worker_"):]
+        if name.startswith("worker_") and pid.isdigit() and not _process_alive(int(pid)):
+            shutil.rmtree(os.path.join(TEMP_ROOT, name), ignore_errors=True)
+    for name in os.listdir(METRICS_DIR):
+        pid = name.split(".")[0]
+        if pid.isdigit() and not _process_alive(int(pid)):
+            os.remove(os.path.join(METRICS_DIR, name))
+    
+    TEMP_DIR = os.path.join(TEMP_ROOT, f"worker_{os.getpid()}")
+    os.makedirs(TEMP_DIR, exist_ok=True)
+    logger.info(f"📁 Используется временная папка: {TEMP_DIR}")
+
+def flush_worker_metrics():
+    """Записывает метрики процесса в METRICS_DIR, откуда их собирает /metrics любого воркера"""
+    path = os.path.join(METRICS_DIR, f"{os.getpid()}.json")
+    tmp_path = f"{path}.tmp"
+    try:
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump(metrics.snapshot(exclude=SHARED_GAUGES), f)
+        os.replace(tmp_path, path)
+    except OSError as e:
+        logger.warning(f"⚠️ Не удалось сохранить метрики воркера: {e}")
+
+def collect_worker_metrics():
+    """Метрики остальных воркеров; у завершившихся учитываются только счётчики и гистограммы"""
+    snapshots = []
+    for name in os.listdir(METRICS_DIR) if os.path.isdir(METRICS_DIR) else []:
+        pid = name.split(".")[0]
+        if not name.endswith(".json") or not pid.isdigit() or int(pid) == os.getpid():
+            continue
+        try:
+            with open(os.path.join(METRICS_DIR, name), encoding="utf-8") as f:
+                snapshot = json.load(f)
+        except (OSError, ValueError):
+            continue
+        if not _process_alive(int(pid)):
+            snapshot["values"] = [
+                value for value in snapshot["values"]
+                if metrics.descriptions.get(value[0], ("untyped",))[0] != "gauge"
+            ]
+        snapshots.append(snapshot)
+    return snapshots
+
+def checkpoint_job(job_id):
+    """Сохраняет незавершённую задачу процесса в общем хранилище, чтобы её выполнил другой воркер.
+    
+    Входной файл переносится в SPOOL_DIR жёсткой ссылкой (копией на другом разделе),
+    поэтому поток, который ещё работает с ним, не мешает.
+    """
+    with jobs_lock:
+        work = job_inputs.pop(job_id, None)
+        job = jobs.get(job_id)
+        snapshot = dict(job) if job else None
+    if work is None or snapshot is None or snapshot["finished_at"]:
+        return False
+    
+    spool_path = os.path.join(SPOOL_DIR, os.path.basename(work["input_path"]))
+    try:
+        try:
+            os.link(work["input_path"], spool_path)
+        except OSError:
+            shutil.copyfile(work["input_path"], spool_path)
+    except OSError as e:
+        _fail_job(job_id, f"задача прервана остановкой сервиса ({e})")
+        return False
+    
+    publish_job_event(job_id, "checkpointed", {})
+    checkpointed_jobs.add(job_id)
+    snapshot.update(status="queued", started_at=None)
+    state_store.save_job(snapshot, status="checkpointed", worker=0, resume={**work, "input_path": spool_path})
+    logger.info(f"💾 Задача {job_id} сохранена для другого воркера")
+    return True
+
+def adopt_checkpointed_jobs():
+    """Ставит в свою очередь задачи, сохранённые остановленными воркерами"""
+    if job_scheduler.draining:
+        return
+    for snapshot, resume in state_store.claim_checkpointed_jobs():
+        job_id = snapshot["id"]
+        if not os.path.exists(resume["input_path"]):
+            state_store.save_job({**snapshot, "status": "failed", "error": "Файл задачи потерян при перезапуске", "finished_at": time.time()})
+            continue
+        reserved_bytes = temp_disk.adopt(resume["file_size"])
+        try:
+            submit_job(
+                resume["input_path"], resume["file_size"], resume["filename"], resume["audio_hash"],
+                resume["hints"], resume["tenant"], reserved_bytes, job_id=job_id
+            )
+        except AdmissionRejected:
+            temp_disk.release(reserved_bytes)
+            state_store.save_job(snapshot, status="checkpointed", worker=0, resume=resume)
+            return
+        logger.info(f"♻️ Задача {job_id} продолжена после остановки другого воркера")
+
+def fail_orphaned_jobs():
+    """Задачи аварийно завершившихся воркеров (без плавной остановки) помечаются ошибкой"""
+    for job_id, worker in state_store.active_job_workers():
+        if worker == os.getpid() or _process_alive(worker):
+            continue
+        snapshot = state_store.load_job(job_id)
+        if snapshot:
+            logger.warning(f"⚠️ Задача {job_id} потеряна: воркер {worker} завершился аварийно")
+            state_store.save_job({
+                **snapshot, "status": "failed", "finished_at": time.time(),
+                "error": "Ошибка: воркер завершился аварийно, отправьте файл повторно",
+            })
+
+def release_dead_worker_usage():
+    """Доли завершившихся воркеров в общих лимитах освобождаются"""
+    for worker in state_store.usage_workers():
+        if worker != os.getpid() and not _process_alive(worker):
+            state_store.clear_worker_usage(worker)
+
+def poll_job_scheduler():
+    """Забирает слоты, которые освободили другие воркеры, для своих ожидающих задач"""
+    while not worker_stop.wait(SHARED_SLOT_POLL_SECONDS):
+        try:
+            job_scheduler.poll()
+        except Exception as e:
+            logger.warning(f"⚠️ Ошибка раздачи слотов: {e}")
+
+def worker_maintenance():
+    """Фоновое обслуживание воркера: метрики, брошенные задачи и загрузки, очистка по TTL"""
+    while not worker_stop.wait(WORKER_MAINTENANCE_SECONDS):
+        try:
+            flush_worker_metrics()
+            adopt_checkpointed_jobs()
+            fail_orphaned_jobs()
+            release_dead_worker_usage()
+            _prune_upload_sessions()
+            state_store.prune_finished(time.time() - JOB_RESULT_TTL)
+        except Exception as e:
+            logger.warning(f"⚠️ Ошибка обслуживания воркера: {e}")
+
+def init_worker():
+    """Запуск воркера: своя временная папка, фоновые потоки и задачи, ожидающие в общем хранилище"""
+    init_worker_temp_dir()
+    random.seed()  # после fork у всех воркеров одинаковое состояние генератора
+    if threading.current_thread() is threading.main_thread():
+        signal.signal(signal.SIGTERM, signal_handler)
+        signal.signal(signal.SIGINT, signal_handler)
+    
+    # Задачи, ждущие вебхука, видны всем воркерам через общее хранилище, а вебхук
+    # забирает из pending_transcripts тот воркер, к которому он пришёл
+    if WEBHOOK_ENABLED:
+        threading.Thread(target=sweep_pending_transcripts, name="voicesum-webhook-sweeper", daemon=True).start()
+    
+    # Доли с тем же pid остались от прошлого процесса (pid переиспользуется)
+    state_store.clear_worker_usage(os.getpid())
+    release_dead_worker_usage()
+    adopt_checkpointed_jobs()
+    threading.Thread(target=worker_maintenance, name="voicesum-maintenance", daemon=True).start()
+    threading.Thread(target=poll_job_scheduler, name="voicesum-scheduler-poll", daemon=True).start()
+    logger.info(f"👷 Воркер {os.getpid()} готов")
+
+def begin_shutdown(drain_seconds=SHUTDOWN_DRAIN_SECONDS):
+    """Перестаёт принимать работу (503 с Retry-After); ожидающие задачи сразу уходят другим воркерам"""
+    if shutdown_state["started_at"]:
+        return
+    shutdown_state["started_at"] = time.time()
+    shutdown_state["deadline"] = shutdown_state["started_at"] + drain_seconds
+    cancelled = job_scheduler.drain()
+    logger.info(f"🛑 Воркер {os.getpid()} останавливается: новые задачи не принимаются, ожидающих передано - {cancelled}")
+
+def shutdown_worker():
+    """Дожидается выполняющихся задач до дедлайна, сохраняет оставшиеся и удаляет свою временную папку"""
+    begin_shutdown()
+    while (job_scheduler.get_stats()["running"] or jobs_in_flight) and time.time() < shutdown_state["deadline"]:
+        time.sleep(0.5)
+    
+    with jobs_lock:
+        unfinished = [job_id for job_id, job in jobs.items() if job["status"] in ("queued", "processing")]
+    checkpointed = sum(1 for job_id in unfinished if checkpoint_job(job_id))
+    with batches_lock:
+        unfinished_batches = [batch_id for batch_id, batch in batches.items() if not batch["finished_at"]]
+    for batch_id in unfinished_batches:
+        interrupt_batch(batch_id)
+    
+    worker_stop.set()
+    flush_worker_metrics()
+    state_store.clear_worker_usage(os.getpid())
+    # Файлы сохранённых задач уже в SPOOL_DIR, своя папка больше никому не нужна
+    shutil.rmtree(TEMP_DIR, ignore_errors=True)
+    logger.info(
+        f"👋 Воркер {os.getpid()} остановлен за {time.time() - shutdown_state['started_at']:.1f}с, "
+        f"сохранено задач: {checkpointed}, прервано пакетов: {len(unfinished_batches)}"
+    )
+
+def get_worker_stats():
+    return {
+        "pid": os.getpid(),
+        "temp_dir": TEMP_DIR,
+        "draining": bool(shutdown_state["started_at"]),
+        "shutdown_drain_seconds": SHUTDOWN_DRAIN_SECONDS,
+    }
+
+if not WORKER_INIT_DEFERRED:
+    init_worker()
+
+# === Маршруты ===
+
+@app.route("/")
+def index():
+    return render_template("index.html")
+
+@app.route("/health")
+def health():
     return jsonify({
         "status": "ok",
         "service": "AssemblyAI Hybrid Approach (Fixed)",
@@ -454,6 +5020,11 @@ def health():
             "2. Auto-detection with summary", 
             "3. Auto-detection with chapters"
         ],
+        "transcription_mode": TRANSCRIPTION_MODE,
+        "adaptive_strategies": "enabled" if strategy_scheduler else "disabled",
+        "language_detection": LANGUAGE_DETECTOR if LANGUAGE_DETECTION_ENABLED else "disabled",
+        "audio_normalization": AUDIO_NORMALIZATION_FORMAT if AUDIO_NORMALIZATION_ENABLED else "disabled",
+        "chunked_transcription": f">= {CHUNK_MIN_DURATION}s" if CHUNKED_TRANSCRIPTION_ENABLED else "disabled",
         "fixes_applied": [
             "✅ Убран конфликт auto_chapters + summarization",
             "✅ Приоритет русскому языку",
@@ -464,173 +5035,389 @@ def health():
             "max_file_size": "500MB",
             "recommended_size": "50MB",
             "max_duration": "unlimited"
-        }
+        },
+        "uploads": get_upload_stats(),
+        "jobs": get_job_stats(),
+        "scheduler": {**job_scheduler.get_stats(), "temp_disk": temp_disk.get_stats()},
+        "resumable_uploads": get_upload_session_stats(),
+        "batches": get_batch_stats(),
+        "worker": get_worker_stats(),
+        "result_cache": result_cache.get_stats() if result_cache else {"enabled": False},
+        "http_pools": get_http_pool_stats(),
+        "webhooks": {"enabled": True, "pending": pending_transcripts.count()} if WEBHOOK_ENABLED else {"enabled": False},
+        "transcript_store": {"enabled": True, "transcripts": transcript_store.count()} if transcript_store else {"enabled": False}
     })
 
+@app.route("/metrics")
+def metrics_endpoint():
+    """Метрики в текстовом формате Prometheus"""
+    for status, count in get_job_stats().items():
+        if status != "workers":
+            metrics.set("voicesum_jobs", count, status=status)
+    
+    for upstream, pool_stats in get_http_pool_stats().items():
+        metrics.set("voicesum_upstream_connections", pool_stats["connections"] - pool_stats["idle_connections"], upstream=upstream, state="active")
+        metrics.set("voicesum_upstream_connections", pool_stats["idle_connections"], upstream=upstream, state="idle")
+    
+    if WEBHOOK_ENABLED:
+        metrics.set("voicesum_webhook_pending", pending_transcripts.count())
+    
+    stats = get_upload_stats()
+    metrics.set("voicesum_upload_bytes_total", stats["bytes_uploaded_total"])
+    metrics.set("voicesum_uploads_total", stats["uploads_total"])
+    
+    if result_cache:
+        cache_stats = result_cache.get_stats()
+        for event in ("hits", "misses", "stores", "evictions"):
+            metrics.set("voicesum_result_cache_events_total", cache_stats[event], event=event)
+    
+    return Response(metrics.render(collect_worker_metrics()), mimetype="text/plain; version=0.0.4")
+
 @app.route("/transcribe", methods=["POST"])
 def transcribe():
     start_time = time.time()
     input_path = None
+    reserved_bytes = 0
     
     try:
-        if 'audio' not in request.files:
-            return jsonify({"error": "Файл не загружен"}), 400
-
-        file = request.files['audio']
-        if file.filename == '':
-            return jsonify({"error": "Файл не выбран"}), 400
-
-        timestamp = int(time.time() * 1000)
-        input_path = os.path.join(TEMP_DIR, f"hybrid_{timestamp}.{file.filename.split('.')[-1]}")
-        
-        # Сохранение файла
-        file.save(input_path)
-        file_size = os.path.getsize(input_path)
-        logger.info(f"📥 Файл сохранён: {file_size / 1024 / 1024:.1f} MB")
-        
-        # Примерная оценка длительности
-        estimated_duration = file_size / 1024 / 1024  # грубая оценка в минутах
-        logger.info(f"📊 Примерная длительность: ~{estimated_duration:.1f} минут")
-        
-        # Улучшенная гибридная транскрипция с множественным fallback
-        transcript, transcription_method = transcribe_with_fallback(input_path)
-        
-        if not transcript.text:
-            return jsonify({"error": "Не удалось получить транскрипцию"}), 400
-        
-        logger.info(f"✅ Транскрипция завершена методом: {transcription_method}")
-        
-        # Получаем точную длительность из результата AssemblyAI
-        audio_duration_ms = getattr(transcript, 'audio_duration', None)
-        actual_duration = audio_duration_ms / 1000 / 60 if audio_duration_ms else estimated_duration
-        detected_language = getattr(transcript, 'language_code', 'unknown')
-        
-        # Создаем умное резюме с обработкой ошибок
-        try:
-            logger.info("🧠 Генерирую умное резюме...")
-            summary = summarizer.create_smart_summary(transcript, transcription_method)
-        except Exception as e:
-            logger.warning(f"⚠️ Ошибка генерации умного резюме: {e}")
-            summary = summarizer._create_basic_summary(transcript, transcription_method)
-        
-        # Анализируем результаты в зависимости от метода
-        sentiment_analysis = getattr(transcript, 'sentiment_analysis_results', None) or []
-        overall_sentiment, pos_count, neg_count, neu_count = analyze_sentiment_overall(sentiment_analysis)
-        
-        entities = getattr(transcript, 'entities', None) or []
-        entities_by_type = format_entities_by_type(entities)
-        
-        chapters = getattr(transcript, 'chapters', None) or []
-        highlights = getattr(transcript, 'auto_highlights', None)
-        
-        # Подсчет использованных кредитов
-        credits_used = actual_duration / 60 * 0.37  # примерно $0.37 за час
-        
-        total_time = time.time() - start_time
-        logger.info(f"✅ Полная обработка завершена за {total_time:.1f}с")
-
-        # Формируем оптимизированный ответ (ограничиваем размер)
-        transcript_text = transcript.text
-        
-        # Ограничиваем размер транскрипта для JSON ответа
-        max_transcript_length = 50000  # 50KB текста
-        if len(transcript_text) > max_transcript_length:
-            transcript_text = transcript_text[:max_transcript_length] + "\n\n... [ТРАНСКРИПТ ОБРЕЗАН ДЛЯ ОПТИМИЗАЦИИ] ..."
-            logger.info(f"📝 Транскрипт обрезан с {len(transcript.text)} до {len(transcript_text)} символов")
-        
-        response_data = {
-            "transcript": transcript_text,
-            "summary": summary,
-            "service_used": "AssemblyAI Hybrid Approach (Fixed)",
-            "transcription_method": transcription_method,
-            "detected_language": detected_language,
-            
-            # Статистика
-            "statistics": {
-                "processing_time": f"{total_time:.1f}s",
-                "audio_duration": f"{actual_duration:.1f}min", 
-                "file_size": f"{file_size / 1024 / 1024:.1f}MB",
-                "confidence": getattr(transcript, 'confidence', 0),
-                "credits_used": f"${credits_used:.3f}",
-                "words_count": len(transcript.text.split()) if transcript.text else 0,
-                "transcript_truncated": len(transcript.text) > max_transcript_length
-            },
-            
-            # AI анализ
-            "ai_analysis": {
-                "method_used": transcription_method,
-                "speakers_detected": len(set([utterance.speaker for utterance in getattr(transcript, 'utterances', []) if utterance.speaker])),
-                "chapters_found": len(chapters),
-                "highlights_found": len(highlights.results) if highlights and hasattr(highlights, 'results') else 0,
-                "entities_found": len(entities),
-                "sentiment_breakdown": {
-                    "overall": overall_sentiment,
-                    "positive_segments": pos_count,
-                    "negative_segments": neg_count,
-                    "neutral_segments": neu_count
-                },
-                "features_available": get_transcription_features(transcription_method)
-            }
-        }
-        
-        # Добавляем детальные результаты если есть (ограничено)
-        if chapters:
-            response_data["chapters"] = [
-                {
-                    "headline": getattr(ch, 'headline', ''),
-                    "start_time": f"{getattr(ch, 'start', 0)/1000/60:.1f}min",
-                    "end_time": f"{getattr(ch, 'end', 0)/1000/60:.1f}min",
-                    "summary": getattr(ch, 'summary', '')[:500] + ('...' if len(getattr(ch, 'summary', '')) > 500 else '')
-                }
-                for ch in chapters[:8]  # Ограничиваем до 8 глав
-            ]
-        
-        if highlights and hasattr(highlights, 'results'):
-            response_data["key_highlights"] = [
-                {
-                    "text": getattr(h, 'text', '')[:300] + ('...' if len(getattr(h, 'text', '')) > 300 else ''),
-                    "rank": getattr(h, 'rank', 0),
-                    "start_time": f"{getattr(h, 'start', 0)/1000/60:.1f}min"
-                }
-                for h in highlights.results[:10]  # Ограничиваем до 10
-            ]
+        # Перегрузку отсекаем до приёма файла
+        tenant = get_request_tenant()
+        job_scheduler.check(tenant[0])
+        reserved_bytes = temp_disk.reserve(request.content_length or 0)
         
-        if entities_by_type:
-            # Ограничиваем количество сущностей каждого типа
-            limited_entities = {}
-            for entity_type, entity_list in entities_by_type.items():
-                limited_entities[entity_type] = entity_list[:5]  # Ограничиваем до 5 в каждой категории
-            response_data["entities_by_type"] = limited_entities
+        # Потоковое сохранение файла (без Content-Length место резервируется по ходу записи)
+        upload = receive_upload(reserved_bytes=reserved_bytes)
+        input_path = upload["path"]
+        reserved_bytes = upload["reserved_bytes"]
         
-        # Встроенное резюме от AssemblyAI (если доступно, ограничено)
-        builtin_summary = getattr(transcript, 'summary', None)
-        if builtin_summary:
-            if len(builtin_summary) > 2000:
-                builtin_summary = builtin_summary[:2000] + "... [ОБРЕЗАНО]"
-            response_data["assemblyai_summary"] = builtin_summary
-        
-        # Информация о методе транскрипции
-        method_names = {
-            "auto_detection_summary": "Автообнаружение языка с резюме",
-            "auto_detection_chapters": "Автообнаружение языка с главами", 
-            "russian_limited_features": "Русский язык (приоритет)"
-        }
-        
-        response_data["method_info"] = {
-            "name": method_names.get(transcription_method, transcription_method),
-            "features": "Все AI функции" if "auto_detection" in transcription_method else "Ограниченный набор",
-            "language_detected": detected_language,
-            "fallback_used": transcription_method == "russian_limited_features"
-        }
+        with scheduled_slot(tenant):
+            response_data = process_audio_file(
+                input_path, upload["size"], start_time, upload["hash"], filename=upload["filename"],
+                hints=get_client_hints(upload["form"], request.headers.get(UPLOADER_HEADER) or request.remote_addr)
+            )
 
-        return jsonify(response_data), 200, {'Content-Type': 'application/json; charset=utf-8'}
+        with metrics.time("voicesum_stage_seconds", stage="serialize"):
+            response = jsonify(response_data)
+        return response, 200, {'Content-Type': 'application/json; charset=utf-8'}
         
+    except AdmissionRejected as e:
+        return admission_rejected_response(e)
+    except ProcessingError as e:
+        return jsonify({"error": str(e)}), e.status_code
     except Exception as e:
         logger.error(f"❌ Ошибка обработки: {e}")
         return jsonify({"error": f"Ошибка: {str(e)[:300]}"}), 500
     finally:
         if input_path and os.path.exists(input_path):
             os.remove(input_path)
+        temp_disk.release(reserved_bytes)
+
+@app.route("/jobs", methods=["POST"])
+def create_job():
+    """Принимает файл и сразу возвращает ID задачи, обработка идёт в фоне"""
+    tenant = get_request_tenant()
+    reserved_bytes = 0
+    upload = None
+    try:
+        # Перегрузку отсекаем до приёма файла; резерв места переходит к задаче
+        job_scheduler.check(tenant[0])
+        reserved_bytes = temp_disk.reserve(request.content_length or 0)
+        upload = receive_upload(prefix="job", reserved_bytes=reserved_bytes)
+        reserved_bytes = upload["reserved_bytes"]
+        hints = get_client_hints(upload["form"], request.headers.get(UPLOADER_HEADER) or request.remote_addr)
+        job = submit_job(upload["path"], upload["size"], upload["filename"], upload["hash"], hints, tenant, reserved_bytes)
+    except Exception as e:
+        temp_disk.release(reserved_bytes)
+        if upload and os.path.exists(upload["path"]):
+            os.remove(upload["path"])
+        if isinstance(e, AdmissionRejected):
+            return admission_rejected_response(e)
+        if isinstance(e, ProcessingError):
+            return jsonify({"error": str(e)}), e.status_code
+        logger.error(f"❌ Ошибка сохранения файла: {e}")
+        return jsonify({"error": f"Ошибка: {str(e)[:300]}"}), 500
+    
+    return jsonify({
+        "job_id": job["id"],
+        "status": job["status"],
+        "status_url": f"/jobs/{job['id']}"
+    }), 202
+
+@app.route("/jobs/<job_id>", methods=["GET"])
+def get_job(job_id):
+    """Статус задачи и результат, когда он готов"""
+    job = get_job_snapshot(job_id)
+    if job is None:
+        return jsonify({"error": "Задача не найдена"}), 404
+    with metrics.time("voicesum_stage_seconds", stage="serialize"):
+        response = jsonify(job)
+    return response, 200, {'Content-Type': 'application/json; charset=utf-8'}
+
+@app.route("/jobs/<job_id>/events", methods=["GET"])
+def stream_job_events(job_id):
+    """Server-Sent Events: этапы обработки и токены резюме по мере появления"""
+    if get_job_snapshot(job_id) is None:
+        return jsonify({"error": "Задача не найдена"}), 404
+    
+    # Переподключение EventSource продолжает с последнего полученного события
+    last_event_id = request.headers.get("Last-Event-ID", "")
+    start_index = int(last_event_id) + 1 if last_event_id.isdigit() else 0
+    
+    def generate():
+        for item in iter_job_events(job_id, start_index):
+            if item is None:
+                yield ": keepalive\n\n"
+                continue
+            index, event, data = item
+            payload = json.dumps(data, ensure_ascii=False)
+            yield f"id: {index}\nevent: {event}\ndata: {payload}\n\n"
+    
+    return Response(
+        stream_with_context(generate()),
+        mimetype="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+    )
+
+@app.route("/uploads", methods=["POST"])
+def create_upload():
+    """Начало возобновляемой загрузки: {filename, size, chunk_size?, sha256?, language?}"""
+    payload = request.get_json(silent=True) or {}
+    hints = get_client_hints(payload, request.headers.get(UPLOADER_HEADER) or request.remote_addr)
+    try:
+        session = create_upload_session(
+            payload.get("filename"), payload.get("size"), payload.get("chunk_size"), hints, payload.get("sha256"),
+            get_request_tenant()
+        )
+    except AdmissionRejected as e:
+        return admission_rejected_response(e)
+    except ProcessingError as e:
+        return jsonify({"error": str(e)}), e.status_code
+    return jsonify(session), 201
+
+@app.route("/uploads/<upload_id>", methods=["GET"])
+def get_upload(upload_id):
+    """Полученные части - клиент догружает остальные после обрыва"""
+    session = get_upload_session(upload_id)
+    if session is None:
+        return jsonify({"error": "Загрузка не найдена"}), 404
+    return jsonify(session)
+
+@app.route("/uploads/<upload_id>", methods=["PUT"])
+def put_upload_chunk(upload_id):
+    """Часть файла: тело - байты части, ?offset= - её начало в файле"""
+    offset = request.args.get("offset", type=int)
+    if offset is None:
+        return jsonify({"error": "Не указано смещение части"}), 400
+    if request.content_length is None:
+        return jsonify({"error": "Не указан размер части"}), 411
+    try:
+        session = write_upload_chunk(
+            upload_id, offset, request.stream, request.content_length, request.headers.get(CHUNK_DIGEST_HEADER)
+        )
+    except ProcessingError as e:
+        return jsonify({"error": str(e)}), e.status_code
+    return jsonify(session)
+
+@app.route("/uploads/<upload_id>", methods=["DELETE"])
+def delete_upload(upload_id):
+    if not abort_upload_session(upload_id):
+        return jsonify({"error": "Загрузка не найдена"}), 404
+    return "", 204
+
+@app.route("/uploads/<upload_id>/finalize", methods=["POST"])
+def finalize_upload(upload_id):
+    """Собирает загрузку и ставит задачу в очередь - ответ как у POST /jobs"""
+    try:
+        job = finalize_upload_session(upload_id)
+    except AdmissionRejected as e:
+        return admission_rejected_response(e)
+    except ProcessingError as e:
+        return jsonify({"error": str(e)}), e.status_code
+    except Exception as e:
+        logger.error(f"❌ Ошибка сборки загрузки: {e}")
+        return jsonify({"error": f"Ошибка: {str(e)[:300]}"}), 500
+    
+    return jsonify({
+        "job_id": job["id"],
+        "status": job["status"],
+        "status_url": f"/jobs/{job['id']}"
+    }), 202
+
+@app.route("/batches", methods=["POST"])
+def create_batch():
+    """Пакет файлов (поле files, можно несколько, zip-архивы распаковываются) - обработка в фоне"""
+    tenant = get_request_tenant()
+    reserved_bytes = 0
+    files = []
+    try:
+        # Перегрузку отсекаем до приёма файлов; резерв места переходит к файлам пакета
+        job_scheduler.check(tenant[0])
+        reserved_bytes = temp_disk.reserve(request.content_length or 0)
+        uploads, reserved_bytes = receive_batch_upload(reserved_bytes)
+        files, extracted_bytes = expand_batch_archives(uploads)
+        reserved_bytes += extracted_bytes
+        files_bytes = sum(upload["size"] for upload in files)
+        if files_bytes > reserved_bytes:
+            reserved_bytes += temp_disk.reserve(files_bytes - reserved_bytes)
+        hints = get_client_hints(files[0]["form"], request.headers.get(UPLOADER_HEADER) or request.remote_addr)
+        batch = submit_batch(files, hints, tenant)
+        # Архивы и служебная часть запроса уже не занимают место
+        temp_disk.release(reserved_bytes - files_bytes)
+    except Exception as e:
+        temp_disk.release(reserved_bytes)
+        for upload in files:
+            if os.path.exists(upload["path"]):
+                os.remove(upload["path"])
+        if isinstance(e, AdmissionRejected):
+            return admission_rejected_response(e)
+        if isinstance(e, ProcessingError):
+            return jsonify({"error": str(e)}), e.status_code
+        logger.error(f"❌ Ошибка приёма пакета: {e}")
+        return jsonify({"error": f"Ошибка: {str(e)[:300]}"}), 500
+    
+    return jsonify(batch), 202
+
+@app.route("/batches/<batch_id>", methods=["GET"])
+def get_batch(batch_id):
+    """Прогресс пакета; ?results=1 - с результатами готовых файлов"""
+    batch = get_batch_snapshot(batch_id, request.args.get("results") == "1")
+    if batch is None:
+        return jsonify({"error": "Пакет не найден"}), 404
+    with metrics.time("voicesum_stage_seconds", stage="serialize"):
+        response = jsonify(batch)
+    return response, 200, {'Content-Type': 'application/json; charset=utf-8'}
+
+@app.route("/batches/<batch_id>/files/<int:index>", methods=["GET"])
+def get_batch_file_result(batch_id, index):
+    """Статус и результат одного файла пакета"""
+    item = get_batch_file(batch_id, index)
+    if item is None:
+        return jsonify({"error": "Файл пакета не найден"}), 404
+    with metrics.time("voicesum_stage_seconds", stage="serialize"):
+        response = jsonify(item)
+    return response, 200, {'Content-Type': 'application/json; charset=utf-8'}
+
+@app.route("/strategies/stats", methods=["GET"])
+def strategy_stats():
+    """Статистика адаптивного выбора стратегий: решения и исходы по признакам входа"""
+    if not strategy_scheduler:
+        return jsonify({"enabled": False})
+    limit = request.args.get("limit", STRATEGY_STATS_DEFAULT_LIMIT, type=int)
+    return jsonify(strategy_scheduler.get_stats(min(max(limit, 1), STRATEGY_STATS_MAX_LIMIT)))
+
+@app.route("/search", methods=["GET"])
+def search():
+    """Полнотекстовый поиск по прошлым транскриптам (q) или поиск по сущностям (entity, type)"""
+    if not transcript_store:
+        return jsonify({"error": "Хранилище транскриптов отключено"}), 404
+    
+    limit = min(max(request.args.get("limit", SEARCH_DEFAULT_LIMIT, type=int), 1), SEARCH_MAX_LIMIT)
+    query = request.args.get("q", "").strip()
+    entity = request.args.get("entity", "").strip()
+    if not query and not entity:
+        return jsonify({"error": "Укажите q или entity"}), 400
+    
+    search_start = time.time()
+    if query:
+        results = transcript_store.search_text(query, limit)
+    else:
+        results = transcript_store.search_entities(entity, request.args.get("type"), limit)
+    return jsonify({
+        "query": query or entity,
+        "results": results,
+        "search_time": f"{(time.time() - search_start) * 1000:.1f}ms"
+    })
+
+@app.route("/transcripts/<transcript_id>", methods=["GET"])
+def get_transcript(transcript_id):
+    """Сохранённый транскрипт: текст, реплики с таймкодами, сущности, главы и резюме"""
+    record = transcript_store.get(transcript_id) if transcript_store else None
+    if record is None:
+        return jsonify({"error": "Транскрипт не найден"}), 404
+    record["text_url"] = f"/transcripts/{transcript_id}/text"
+    return jsonify(record)
+
+@app.route("/transcripts/<transcript_id>/text", methods=["GET"])
+def get_transcript_text(transcript_id):
+    """Полный транскрипт по частям: ?offset=&limit= (символы) или ?start_ms=&end_ms= (реплики по времени)"""
+    if not transcript_store:
+        return jsonify({"error": "Хранилище транскриптов отключено"}), 404
+    
+    if any(key in request.args for key in ("start_ms", "end_ms", "cursor")):
+        if not transcript_store.exists(transcript_id):
+            return jsonify({"error": "Транскрипт не найден"}), 404
+        start_ms = max(request.args.get("start_ms", 0, type=int), 0)
+        end_ms = request.args.get("end_ms", type=int)
+        limit = min(max(request.args.get("limit", TRANSCRIPT_PAGE_MAX_UTTERANCES, type=int), 1), TRANSCRIPT_PAGE_MAX_UTTERANCES)
+        # Курсор "start_ms:id" продолжает выборку с той же реплики, без пропусков и повторов
+        after = None
+        cursor = request.args.get("cursor", "")
+        if cursor:
+            try:
+                after = tuple(int(part) for part in cursor.split(":"))
+            except ValueError:
+                after = ()
+            if len(after) != 2:
+                return jsonify({"error": "Некорректный курсор"}), 400
+        utterances, next_cursor = transcript_store.get_utterances(transcript_id, start_ms, end_ms, limit, after)
+        return jsonify({
+            "transcript_id": transcript_id,
+            "fields": UTTERANCE_FIELDS,
+            "utterances": utterances,
+            "next_cursor": f"{next_cursor[0]}:{next_cursor[1]}" if next_cursor else None
+        })
+    
+    offset = max(request.args.get("offset", 0, type=int), 0)
+    limit = min(max(request.args.get("limit", TRANSCRIPT_PAGE_MAX_CHARS, type=int), 1), TRANSCRIPT_PAGE_MAX_CHARS)
+    page = transcript_store.get_text(transcript_id, offset, limit)
+    if page is None:
+        return jsonify({"error": "Транскрипт не найден"}), 404
+    text, total_chars = page
+    return jsonify({
+        "transcript_id": transcript_id,
+        "offset": offset,
+        "total_chars": total_chars,
+        "text": text,
+        "next_offset": offset + len(text) if offset + len(text) < total_chars else None
+    })
+
+@app.route("/transcripts/<transcript_id>/export.<export_format>", methods=["GET"])
+def export_transcript(transcript_id, export_format):
+    """Транскрипт в SRT, WebVTT, JSON Lines или тексте - потоком, без сборки в памяти"""
+    return export_transcript_response(transcript_id, export_format)
+
+@app.route("/jobs/<job_id>/export.<export_format>", methods=["GET"])
+def export_job_transcript(job_id, export_format):
+    """Экспорт транскрипта завершённой задачи (см. export_transcript)"""
+    job = get_job_snapshot(job_id)
+    if job is None:
+        return jsonify({"error": "Задача не найдена"}), 404
+    if job["status"] != "completed":
+        return jsonify({"error": "Задача ещё не завершена", "status": job["status"]}), 409
+    transcript_id = job["result"].get("transcript_id")
+    if not transcript_id:
+        return jsonify({"error": "Транскрипт задачи не сохранён"}), 404
+    return export_transcript_response(transcript_id, export_format)
+
+@app.route("/webhooks/assemblyai", methods=["POST"])
+def assemblyai_webhook():
+    """Уведомление AssemblyAI о завершении транскрипции"""
+    if not WEBHOOK_ENABLED:
+        return jsonify({"error": "Вебхуки отключены"}), 404
+    
+    if WEBHOOK_SECRET and not hmac.compare_digest(request.headers.get(WEBHOOK_AUTH_HEADER, ""), WEBHOOK_SECRET):
+        metrics.inc("voicesum_webhook_events_total", outcome="rejected")
+        return jsonify({"error": "Неверная подпись вебхука"}), 401
+    
+    payload = request.get_json(silent=True) or {}
+    transcript_id = payload.get("transcript_id")
+    if not transcript_id:
+        return jsonify({"error": "Нет transcript_id"}), 400
+    
+    # Неизвестный ID тоже подтверждаем, иначе AssemblyAI будет повторять вебхук
+    outcome = dispatch_webhook_completion(transcript_id)
+    metrics.inc("voicesum_webhook_events_total", outcome=outcome)
+    return jsonify({"status": outcome})
 
 if __name__ == "__main__":
     port = int(os.environ.get("PORT", 5000))
@@ -0,0 +1,521 @@
+"""ASGI-вариант конвейера /transcribe на asyncio.
+
+Сохранение файла, загрузка и опрос AssemblyAI и запросы резюме к OpenRouter
+выполняются асинхронно: ожидающая задача не занимает поток, поэтому один процесс
+держит много долгих обработок одновременно. Остальные маршруты (страница,
+задачи, вебхуки, метрики) обслуживает Flask-приложение через WSGI-мост.
+
+Запуск: uvicorn asgi:application --host 0.0.0.0 --port $PORT
+"""
+import asyncio
+import json
+import os
+import threading
+import time
+import weakref
+from contextlib import asynccontextmanager
+
+import assemblyai as aai
+import httpx
+from a2wsgi import WSGIMiddleware
+from openai import AsyncOpenAI
+
+from app import (
+    app, logger, metrics, ProcessingError, MultipartUploadParser, get_multipart_boundary,
+    discard_partial_upload, UPLOAD_CHUNK_SIZE, get_cached_result, assemble_result, CompactTranscript, extract_key_sentences,
+    change_jobs_in_flight, record_upload, assemblyai_client, AUDIO_NORMALIZATION_ENABLED,
+    normalize_audio, strategy_scheduler, describe_input, plan_strategies, get_chunked_duration, transcribe_chunked, get_client_hints,
+    UPLOADER_HEADER, TENANT_HEADER, resolve_tenant, job_scheduler, temp_disk, AdmissionRejected, TRANSCRIPTION_MODE, check_strategy_result, record_strategy_outcome, AdvancedSummarizer,
+    OPENROUTER_API_KEY, OPENROUTER_BASE_URL, SUMMARY_MODEL, SUMMARY_TIMEOUT_SECONDS,
+    SUMMARY_CHUNK_CHARS, SUMMARY_MAP_PARALLELISM, MAP_SYSTEM_PROMPT, COMBINE_SYSTEM_PROMPT,
+    HTTP_POOL_MAX_CONNECTIONS, HTTP_POOL_MAX_KEEPALIVE, HTTP_KEEPALIVE_EXPIRY,
+    HTTP_MAX_RETRIES, RETRYABLE_STATUS_CODES, ResilientTransport, UpstreamUnavailableError, get_circuit_breaker, http_transports,
+    upstream_transcriptions, SHARED_SLOT_POLL_SECONDS, begin_shutdown, shutdown_worker,
+)
+
+HTTP_LIMITS = httpx.Limits(
+    max_connections=HTTP_POOL_MAX_CONNECTIONS,
+    max_keepalive_connections=HTTP_POOL_MAX_KEEPALIVE,
+    keepalive_expiry=HTTP_KEEPALIVE_EXPIRY,
+)
+
+# === Асинхронные HTTP-клиенты: повторы и предохранитель ===
+class AsyncResilientTransport(httpx.AsyncHTTPTransport):
+    """Асинхронный ResilientTransport: те же повторы 429/5xx, задержки и счётчики.
+    
+    Предохранитель общий с синхронным клиентом того же upstream, поэтому сбои,
+    замеченные Flask-маршрутами и asyncio-конвейером, суммируются.
+    """
+    
+    _count = ResilientTransport._count
+    _backoff_delay = ResilientTransport._backoff_delay
+    _track_connections = ResilientTransport._track_connections
+    get_stats = ResilientTransport.get_stats
+    
+    def __init__(self, upstream, breaker, **kwargs):
+        super().__init__(**kwargs)
+        self.upstream = upstream
+        self.breaker = breaker
+        self.stats_lock = threading.Lock()
+        self.stats = {"requests": 0, "retries": 0, "failures": 0, "rejected": 0, "connections_opened": 0}
+        self._seen_connections = weakref.WeakSet()
+    
+    async def handle_async_request(self, request):
+        if not self.breaker.allow_request():
+            self._count("rejected", "rejected")
+            raise UpstreamUnavailableError(f"{self.upstream} временно недоступен (предохранитель)", request=request)
+        
+        replayable = isinstance(request.stream, httpx.ByteStream)
+        attempt = 0
+        while True:
+            self._count("requests")
+            try:
+                response = await super().handle_async_request(request)
+            except httpx.TransportError:
+                if replayable and attempt < HTTP_MAX_RETRIES:
+                    self._count("retries", "retry")
+                    await asyncio.sleep(self._backoff_delay(attempt))
+                    attempt += 1
+                    continue
+                self._count("failures", "error")
+                self.breaker.record_failure()
+                raise
+            
+            self._track_connections()
+            if response.status_code not in RETRYABLE_STATUS_CODES:
+                self.breaker.record_success()
+                metrics.inc("voicesum_upstream_requests_total", upstream=self.upstream, outcome="ok")
+                return response
+            
+            if replayable and attempt < HTTP_MAX_RETRIES:
+                delay = self._backoff_delay(attempt, response)
+                await response.aclose()
+                self._count("retries", "retry")
+                logger.warning(f"🔁 {self.upstream}: HTTP {response.status_code}, повтор через {delay:.1f}с")
+                await asyncio.sleep(delay)
+                attempt += 1
+                continue
+            
+            self._count("failures", "error")
+            self.breaker.record_failure()
+            return response
+
+def create_pooled_async_http_client(upstream, **client_kwargs):
+    """Асинхронный httpx-клиент для upstream; статистика пула - в /health под '<upstream>_async'"""
+    transport = AsyncResilientTransport(upstream, get_circuit_breaker(upstream), limits=HTTP_LIMITS)
+    http_transports[f"{upstream}_async"] = transport
+    return httpx.AsyncClient(transport=transport, **client_kwargs)
+
+@asynccontextmanager
+async def upstream_transcription_slot_async():
+    """Асинхронный upstream_transcription_slot: тот же общий для воркеров лимит, ждём без занятого потока"""
+    # Счётчик слотов - в общем хранилище SQLite, поэтому обращения к нему - в пуле потоков
+    while not await asyncio.to_thread(upstream_transcriptions.acquire, False):
+        await asyncio.sleep(SHARED_SLOT_POLL_SECONDS)
+    try:
+        yield
+    finally:
+        await asyncio.to_thread(upstream_transcriptions.release)
+
+# === Асинхронный клиент AssemblyAI ===
+class AsyncAssemblyAI:
+    """Загрузка, отправка и опрос транскрипций через httpx.AsyncClient.
+    
+    Запросы и ответы те же, что у SDK; результат оборачивается в aai.Transcript,
+    поэтому дальше работают обычные проверки и анализ.
+    """
+    
+    def __init__(self):
+        self.http_client = create_pooled_async_http_client(
+            "assemblyai",
+            base_url=aai.settings.base_url,
+            headers=assemblyai_client.http_client.headers,
+            timeout=aai.settings.http_timeout,
+        )
+    
+    async def upload_file(self, file_path):
+        """Загружает файл потоком, читая его блоками в отдельном потоке"""
+        async def read_chunks():
+            audio_file = await asyncio.to_thread(open, file_path, "rb")
+            try:
+                while chunk := await asyncio.to_thread(audio_file.read, UPLOAD_CHUNK_SIZE):
+                    yield chunk
+            finally:
+                audio_file.close()
+        
+        response = await self.http_client.post(aai.api.ENDPOINT_UPLOAD, content=read_chunks())
+        if response.status_code != httpx.codes.OK:
+            raise aai.types.TranscriptError(f"Failed to upload audio file: {response.text[:300]}")
+        return response.json()["upload_url"]
+    
+    async def submit(self, audio_url, config):
+        transcript_request = aai.types.TranscriptRequest(audio_url=audio_url, **config.raw.dict(exclude_none=True))
+        response = await self.http_client.post(
+            aai.api.ENDPOINT_TRANSCRIPT,
+            json=transcript_request.dict(exclude_none=True, by_alias=True),
+        )
+        if response.status_code != httpx.codes.OK:
+            raise aai.types.TranscriptError(f"failed to transcribe url {audio_url}: {response.text[:300]}")
+        return aai.types.TranscriptResponse.parse_obj(response.json())
+    
+    async def get(self, transcript_id):
+        response = await self.http_client.get(f"{aai.api.ENDPOINT_TRANSCRIPT}/{transcript_id}")
+        if response.status_code != httpx.codes.OK:
+            raise aai.types.TranscriptError(f"failed to retrieve transcript {transcript_id}: {response.text[:300]}")
+        return aai.types.TranscriptResponse.parse_obj(response.json())
+    
+    async def transcribe(self, audio_url, config):
+        """Отправляет транскрипцию и ждёт завершения, не блокируя цикл событий"""
+        async with upstream_transcription_slot_async():
+            response = await self.submit(audio_url, config)
+            while response.status not in (aai.TranscriptStatus.completed, aai.TranscriptStatus.error):
+                await asyncio.sleep(aai.settings.polling_interval)
+                response = await self.get(response.id)
+        return aai.Transcript.from_response(client=assemblyai_client, response=response)
+
+async_assemblyai = AsyncAssemblyAI()
+
+# === Асинхронное умное резюме ===
+class AsyncSummarizer(AdvancedSummarizer):
+    """Те же промпты и разбиение транскрипта, что у AdvancedSummarizer, но запросы через AsyncOpenAI"""
+    
+    def __init__(self, openrouter_key):
+        super().__init__(None)
+        # Повторы делает общий транспорт, поэтому встроенные повторы SDK отключены
+        self.client = AsyncOpenAI(
+            base_url=OPENROUTER_BASE_URL,
+            api_key=openrouter_key,
+            http_client=create_pooled_async_http_client(
+                "openrouter", timeout=httpx.Timeout(SUMMARY_TIMEOUT_SECONDS, connect=10)
+            ),
+            max_retries=0
+        ) if openrouter_key else None
+    
+    async def create_smart_summary(self, transcript_result, transcription_method, usage=None, ranked=None):
+        if not self.client:
+            return self._create_basic_summary(transcript_result, transcription_method, ranked)
+        
+        if usage is None:
+            usage = {}
+        
+        try:
+            with metrics.time("voicesum_stage_seconds", stage="summary_smart"):
+                partial_summaries = None
+                key_sentences = self._extractive_input(transcript_result, ranked, usage)
+                if key_sentences is None and len(transcript_result.text) > SUMMARY_CHUNK_CHARS:
+                    partial_summaries = await self._map_reduce_transcript(transcript_result, usage)
+                system_prompt, context = self._build_summary_request(
+                    transcript_result, transcription_method, partial_summaries, key_sentences
+                )
+                return await self._complete("reduce", system_prompt, context, 1200, usage)
+        except Exception as e:
+            logger.error(f"❌ Ошибка умного резюме: {e}")
+            return self._create_basic_summary(transcript_result, transcription_method, ranked)
+    
+    async def _complete(self, stage, system_prompt, user_content, max_tokens, usage):
+        call_start = time.time()
+        response = await self.client.chat.completions.create(
+            model=SUMMARY_MODEL,
+            messages=[
+                {"role": "system", "content": system_prompt},
+                {"role": "user", "content": user_content}
+            ],
+            max_tokens=max_tokens,
+            temperature=0.3,
+            timeout=SUMMARY_TIMEOUT_SECONDS
+        )
+        self._record_usage(usage, stage, getattr(response, 'usage', None), time.time() - call_start)
+        return response.choices[0].message.content.strip()
+    
+    async def _map_reduce_transcript(self, transcript_result, usage):
+        chunks = self._split_transcript(transcript_result)
+        logger.info(f"🧠 Длинный транскрипт: {len(chunks)} фрагментов, параллельно {SUMMARY_MAP_PARALLELISM}")
+        semaphore = asyncio.Semaphore(SUMMARY_MAP_PARALLELISM)
+        
+        async def complete_limited(stage, system_prompt, user_content, max_tokens):
+            async with semaphore:
+                return await self._complete(stage, system_prompt, user_content, max_tokens, usage)
+        
+        partials = await asyncio.gather(*(
+            complete_limited("map", MAP_SYSTEM_PROMPT.format(index=index, total=len(chunks)), chunk, 600)
+            for index, chunk in enumerate(chunks, 1)
+        ))
+        
+        groups = self._group_partials(partials)
+        while groups:
+            partials = await asyncio.gather(*(
+                complete_limited("combine", COMBINE_SYSTEM_PROMPT, "\n\n---\n\n".join(group), 800)
+                for group in groups
+            ))
+            groups = self._group_partials(partials)
+        
+        usage["chunks"] = len(chunks)
+        return self._join_partials(partials)
+
+async_summarizer = AsyncSummarizer(OPENROUTER_API_KEY)
+
+# === Асинхронный конвейер ===
+async def run_strategy_async(strategy, audio_url, features=None):
+    """Выполняет одну стратегию и проверяет качество результата"""
+    started = time.time()
+    outcome = "failure"
+    try:
+        transcript = await async_assemblyai.transcribe(audio_url, strategy["config"]())
+        check_strategy_result(strategy, transcript)
+        outcome = "success"
+        return transcript
+    except asyncio.CancelledError:
+        outcome = "cancelled"
+        raise
+    finally:
+        # Запись в SQLite статистики стратегий - в пуле потоков, не в цикле событий
+        await asyncio.to_thread(record_strategy_outcome, strategy, time.time() - started, outcome, features)
+
+async def transcribe_async(audio_url, strategies, features=None):
+    """Стратегии по очереди или наперегонки (TRANSCRIPTION_MODE), победитель по приоритету"""
+    errors = []
+    if TRANSCRIPTION_MODE == "race":
+        logger.info(f"🏁 Запускаю {len(strategies)} стратегии параллельно...")
+        tasks = [asyncio.create_task(run_strategy_async(strategy, audio_url, features)) for strategy in strategies]
+    else:
+        tasks = None
+    
+    try:
+        for index, strategy in enumerate(strategies):
+            try:
+                if tasks is None:
+                    logger.info(strategy["start_message"])
+                    transcript = await run_strategy_async(strategy, audio_url, features)
+                else:
+                    transcript = await tasks[index]
+                logger.info(strategy["success_message"])
+                return transcript, strategy["method"]
+            except Exception as e:
+                logger.warning(f"⚠️ Стратегия '{strategy['title']}' не сработала: {e}")
+                errors.append(f"{strategy['title']}({e})")
+    finally:
+        # Проигравшие стратегии больше не опрашиваем; их исключения забираем, иначе
+        # asyncio пишет в лог "Task exception was never retrieved"
+        for task in tasks or []:
+            task.cancel()
+        if tasks:
+            await asyncio.gather(*tasks, return_exceptions=True)
+    
+    logger.error(f"❌ Все методы не сработали: {', '.join(errors)}")
+    raise RuntimeError("Не удалось транскрибировать файл всеми доступными методами")
+
+async def process_audio_file_async(input_path, file_size, start_time, audio_hash=None, filename=None, hints=None):
+    """Асинхронный аналог process_audio_file: те же этапы, кэш и формат ответа"""
+    change_jobs_in_flight(1)
+    try:
+        with metrics.time("voicesum_stage_seconds", stage="total"):
+            return await _process_audio_file_async(input_path, file_size, start_time, audio_hash, filename, hints)
+    finally:
+        change_jobs_in_flight(-1)
+
+async def _process_audio_file_async(input_path, file_size, start_time, audio_hash, filename, hints):
+    cached = await asyncio.to_thread(get_cached_result, audio_hash, start_time)
+    if cached is not None:
+        return cached
+    
+    pipeline_info = {}
+    features = None
+    if strategy_scheduler:
+        features = await asyncio.to_thread(describe_input, input_path, file_size, hints)
+    audio_path = input_path
+    try:
+        # ffmpeg, статистика стратегий и определение языка - короткие этапы, им хватает пула потоков
+        if AUDIO_NORMALIZATION_ENABLED:
+            audio_path = await asyncio.to_thread(normalize_audio, input_path, pipeline_info)
+        
+        strategies = await asyncio.to_thread(plan_strategies, audio_path, features, pipeline_info)
+        duration = await asyncio.to_thread(get_chunked_duration, audio_path)
+        
+        with metrics.time("voicesum_stage_seconds", stage="transcription"):
+            if duration:
+                # Длинные записи режутся на сегменты тем же кодом, что и под WSGI (ffmpeg и
+                # параллельные сегменты - в потоках), поэтому результат не зависит от сервера
+                transcript, transcription_method = await asyncio.to_thread(
+                    transcribe_chunked, audio_path, duration, strategies, pipeline_info
+                )
+            else:
+                with metrics.time("voicesum_stage_seconds", stage="upload"):
+                    audio_url = await async_assemblyai.upload_file(audio_path)
+                record_upload(os.path.getsize(audio_path))
+                transcript, transcription_method = await transcribe_async(audio_url, strategies, features)
+            transcript = CompactTranscript.from_transcript(transcript)
+    finally:
+        if audio_path != input_path and os.path.exists(audio_path):
+            os.remove(audio_path)
+    
+    if not transcript.text:
+        raise ProcessingError("Не удалось получить транскрипцию", 400)
+    logger.info(f"✅ Транскрипция завершена методом: {transcription_method}")
+    
+    ranked, key_sentences = await asyncio.to_thread(extract_key_sentences, transcript)
+    summary_usage = {}
+    summary = await async_summarizer.create_smart_summary(transcript, transcription_method, summary_usage, ranked)
+    if summary_usage:
+        pipeline_info["summary"] = summary_usage
+    
+    return await asyncio.to_thread(
+        assemble_result, transcript, transcription_method, summary, file_size, start_time, pipeline_info,
+        audio_hash, filename, key_sentences
+    )
+
+async def receive_upload_async(scope, receive, prefix="async", field_name="audio", reserved_bytes=0):
+    """Асинхронный receive_upload: тело читается из ASGI, а разбор multipart, хэш,
+    резерв temp_disk и запись на диск выполняются в пуле потоков блоками UPLOAD_CHUNK_SIZE,
+    поэтому загрузка любого размера не задерживает цикл событий"""
+    headers = dict(scope["headers"])
+    boundary = get_multipart_boundary(headers.get(b"content-type", b"").decode("latin-1"))
+    max_length = app.config.get("MAX_CONTENT_LENGTH")
+    parser = MultipartUploadParser(boundary, prefix, field_name, reserved_bytes)
+    out = None
+    pending = bytearray()
+    received = 0
+    
+    def feed_and_write(data):
+        nonlocal out
+        file_data = parser.feed(data)
+        if out is None and parser.upload["path"]:
+            out = open(parser.upload["path"], "wb")
+        if file_data:
+            out.write(file_data)
+    
+    try:
+        while not parser.complete:
+            message = await receive()
+            if message["type"] == "http.disconnect":
+                raise ProcessingError("Загрузка прервана", 400)
+            body = message.get("body", b"")
+            more_body = message.get("more_body", False)
+            received += len(body)
+            if max_length and received > max_length:
+                raise ProcessingError("Файл слишком большой", 413)
+            
+            # Копим сообщения до крупного блока, чтобы не уходить в поток на каждое
+            pending += body
+            if len(pending) >= UPLOAD_CHUNK_SIZE or not more_body:
+                data = bytes(pending)
+                pending.clear()
+                if data:
+                    await asyncio.to_thread(feed_and_write, data)
+                if not more_body and not parser.complete:
+                    await asyncio.to_thread(feed_and_write, b"")
+    except ValueError as e:
+        discard_partial_upload(out, parser.upload["path"])
+        temp_disk.release(parser.reserved_bytes - reserved_bytes)
+        raise ProcessingError(f"Некорректные данные формы: {e}", 400)
+    except BaseException:
+        discard_partial_upload(out, parser.upload["path"])
+        temp_disk.release(parser.reserved_bytes - reserved_bytes)
+        raise
+    
+    if out is not None:
+        await asyncio.to_thread(out.close)
+    upload = parser.finish()
+    upload["reserved_bytes"] = parser.reserved_bytes
+    return upload
+
+# === ASGI-приложение ===
+async def send_json(send, status, payload, headers=()):
+    body = json.dumps(payload).encode("utf-8")
+    await send({
+        "type": "http.response.start",
+        "status": status,
+        "headers": [
+            (b"content-type", b"application/json; charset=utf-8"),
+            (b"content-length", str(len(body)).encode()),
+            *headers,
+        ],
+    })
+    await send({"type": "http.response.body", "body": body})
+
+async def wait_for_slot(tenant):
+    """Заявка в справедливую очередь планировщика; слот ждём без занятого потока"""
+    loop = asyncio.get_running_loop()
+    granted = asyncio.Event()
+    wake = lambda ticket: loop.call_soon_threadsafe(granted.set)
+    # Слоты учитываются в общем хранилище SQLite, поэтому планировщик вызываем из пула потоков
+    ticket = await asyncio.to_thread(job_scheduler.submit, *tenant, wake, on_cancel=wake)
+    try:
+        await granted.wait()
+    except BaseException:
+        await asyncio.to_thread(job_scheduler.release, ticket)
+        raise
+    if ticket["state"] == "cancelled":
+        raise AdmissionRejected("Сервис перезапускается, повторите позже", "draining", 5, 503)
+    return ticket
+
+async def transcribe(scope, receive, send):
+    start_time = time.time()
+    input_path = None
+    reserved_bytes = 0
+    ticket = None
+    
+    try:
+        headers = dict(scope["headers"])
+        remote_addr = (scope.get("client") or ("",))[0]
+        uploader = headers.get(UPLOADER_HEADER.lower().encode(), b"").decode("latin-1")
+        api_key = headers.get(TENANT_HEADER.lower().encode(), b"").decode("latin-1")
+        tenant = resolve_tenant(api_key, uploader, remote_addr)
+        
+        # Перегрузку отсекаем до приёма файла
+        job_scheduler.check(tenant[0])
+        reserved_bytes = await asyncio.to_thread(temp_disk.reserve, int(headers.get(b"content-length", 0)))
+        
+        with metrics.time("voicesum_stage_seconds", stage="save"):
+            upload = await receive_upload_async(scope, receive, reserved_bytes=reserved_bytes)
+        input_path = upload["path"]
+        reserved_bytes = upload["reserved_bytes"]
+        
+        ticket = await wait_for_slot(tenant)
+        response_data = await process_audio_file_async(
+            input_path, upload["size"], start_time, upload["hash"], upload["filename"],
+            get_client_hints(upload["form"], uploader or remote_addr)
+        )
+        await send_json(send, 200, response_data)
+    
+    except AdmissionRejected as e:
+        await send_json(
+            send, e.status_code, {"error": str(e), "retry_after": e.retry_after},
+            [(b"retry-after", str(e.retry_after).encode())]
+        )
+    except ProcessingError as e:
+        await send_json(send, e.status_code, {"error": str(e)})
+    except Exception as e:
+        logger.error(f"❌ Ошибка обработки: {e}")
+        await send_json(send, 500, {"error": f"Ошибка: {str(e)[:300]}"})
+    finally:
+        if ticket is not None:
+            await asyncio.to_thread(job_scheduler.release, ticket)
+        await asyncio.to_thread(temp_disk.release, reserved_bytes)
+        if input_path and os.path.exists(input_path):
+            os.remove(input_path)
+
+async def lifespan(receive, send):
+    while True:
+        message = await receive()
+        if message["type"] == "lifespan.startup":
+            logger.info("✅ ASGI-вариант конвейера запущен")
+            await send({"type": "lifespan.startup.complete"})
+        elif message["type"] == "lifespan.shutdown":
+            # Новые задачи получают 503, текущие дорабатывают до SHUTDOWN_DRAIN_SECONDS
+            await asyncio.to_thread(begin_shutdown)
+            await asyncio.to_thread(shutdown_worker)
+            await async_assemblyai.http_client.aclose()
+            if async_summarizer.client:
+                await async_summarizer.client.close()
+            await send({"type": "lifespan.shutdown.complete"})
+            return
+
+wsgi_application = WSGIMiddleware(app)
+
+async def application(scope, receive, send):
+    if scope["type"] == "lifespan":
+        await lifespan(receive, send)
+    elif scope["type"] == "http" and scope["path"] == "/transcribe" and scope["method"] == "POST":
+        await transcribe(scope, receive, send)
+    else:
+        await wsgi_application(scope, receive, send)
@@ -0,0 +1,310 @@
+"""Локальные заглушки AssemblyAI и OpenRouter для нагрузочных прогонов.
+
+Имитируют загрузку файла, создание и опрос транскрипции (и вызов вебхука),
+а также chat completions - обычные и потоковые. Задержки и доля ошибок
+настраиваются, поэтому можно проверить fallback-стратегии, повторы и таймауты
+без платных API. Отдельный запуск:
+
+    python benchmarks/fake_backends.py --assemblyai-port 8765 --openrouter-port 8766
+"""
+import argparse
+import json
+import random
+import threading
+import time
+import urllib.request
+import uuid
+from collections import Counter
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+WAV_BYTES_PER_SECOND = 32000  # 16 кГц, моно, 16 бит
+WORDS_PER_SECOND = 2.5
+WORDS_PER_UTTERANCE = 40
+VOCABULARY = (
+    "мы обсудили план запуска проекта бюджет команда сроки клиент договор релиз "
+    "вопрос решение задача встреча результат отчёт данные продажи рынок продукт "
+    "следующий этап нужно согласовать презентацию проверить риски подготовить"
+).split()
+
+def add_backend_arguments(parser):
+    """Параметры заглушек: задержки и доли ошибок"""
+    group = parser.add_argument_group("заглушки API")
+    group.add_argument("--upload-seconds-per-mb", type=float, default=0.02, help="задержка загрузки на мегабайт")
+    group.add_argument("--transcript-latency", type=float, default=1.0, help="базовое время транскрипции, с")
+    group.add_argument("--transcript-realtime-factor", type=float, default=0.005,
+                       help="доля длительности записи, добавляемая ко времени транскрипции")
+    group.add_argument("--russian-fail-rate", type=float, default=0.3,
+                       help="доля ошибок для language_code=ru (проверка fallback)")
+    group.add_argument("--transcript-fail-rate", type=float, default=0.0, help="доля ошибок любой транскрипции")
+    group.add_argument("--http-error-rate", type=float, default=0.0, help="доля ответов 503 (проверка повторов)")
+    group.add_argument("--llm-latency", type=float, default=0.5, help="время ответа LLM, с")
+    group.add_argument("--llm-fail-rate", type=float, default=0.0, help="доля ошибок LLM")
+    return parser
+
+class FakeState:
+    """Общее состояние заглушек и счётчики для отчёта"""
+
+    def __init__(self, options):
+        self.options = options
+        self.lock = threading.Lock()
+        self.uploads = {}  # upload_id -> размер в байтах
+        self.transcripts = {}  # transcript_id -> описание транскрипции
+        self.counters = Counter()
+
+    def count(self, name, amount=1):
+        with self.lock:
+            self.counters[name] += amount
+
+    def get_counters(self):
+        with self.lock:
+            return dict(self.counters)
+
+class FakeHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, format, *args):
+        pass
+
+    @property
+    def state(self):
+        return self.server.state
+
+    def read_body(self):
+        length = int(self.headers.get("Content-Length") or 0)
+        if length:
+            return self.rfile.read(length)
+        if self.headers.get("Transfer-Encoding", "").lower() != "chunked":
+            return b""
+
+        body = bytearray()
+        while True:
+            size = int(self.rfile.readline().split(b";")[0].strip(), 16)
+            if not size:
+                self.rfile.readline()
+                return bytes(body)
+            body += self.rfile.read(size)
+            self.rfile.readline()
+
+    def send_json(self, status, payload):
+        body = json.dumps(payload, ensure_ascii=False).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def inject_http_error(self):
+        """Случайный 503 до обработки запроса (тело уже прочитано)"""
+        if random.random() < self.state.options.http_error_rate:
+            self.state.count("injected_http_errors")
+            self.send_json(503, {"error": "Service temporarily unavailable"})
+            return True
+        return False
+
+class AssemblyAIHandler(FakeHandler):
+    """POST /v2/upload, POST /v2/transcript, GET /v2/transcript/<id>"""
+
+    def do_POST(self):
+        body = self.read_body()
+        if self.inject_http_error():
+            return
+
+        options = self.state.options
+        if self.path == "/v2/upload":
+            time.sleep(len(body) / 1024 / 1024 * options.upload_seconds_per_mb)
+            upload_id = uuid.uuid4().hex
+            with self.state.lock:
+                self.state.uploads[upload_id] = len(body)
+            self.state.count("uploads")
+            self.state.count("upload_bytes", len(body))
+            return self.send_json(200, {"upload_url": f"https://fake-assemblyai.local/upload/{upload_id}"})
+
+        if self.path == "/v2/transcript":
+            request = json.loads(body)
+            upload_id = request["audio_url"].rsplit("/", 1)[-1]
+            with self.state.lock:
+                size = self.state.uploads.get(upload_id, WAV_BYTES_PER_SECOND * 60)
+
+            duration = size / WAV_BYTES_PER_SECOND
+            language = request.get("language_code")
+            fail_rate = options.russian_fail_rate if language == "ru" else 0.0
+            failed = random.random() < max(fail_rate, options.transcript_fail_rate)
+            transcript = {
+                "request": request,
+                "duration": duration,
+                "ready_at": time.time() + options.transcript_latency + duration * options.transcript_realtime_factor,
+                "failed": failed,
+                "response": None,
+            }
+            transcript_id = uuid.uuid4().hex
+            with self.state.lock:
+                self.state.transcripts[transcript_id] = transcript
+            self.state.count(f"transcripts_{language or 'auto'}")
+            if failed:
+                self.state.count("injected_transcript_errors")
+
+            if request.get("webhook_url"):
+                delay = transcript["ready_at"] - time.time()
+                threading.Timer(delay, self._send_webhook, (transcript_id, request, failed)).start()
+            return self.send_json(200, {"id": transcript_id, "status": "queued", "audio_url": request["audio_url"]})
+
+        self.send_json(404, {"error": "Not found"})
+
+    def do_GET(self):
+        if self.inject_http_error():
+            return
+        if not self.path.startswith("/v2/transcript/"):
+            return self.send_json(404, {"error": "Not found"})
+
+        transcript_id = self.path.rsplit("/", 1)[-1]
+        with self.state.lock:
+            transcript = self.state.transcripts.get(transcript_id)
+        if transcript is None:
+            return self.send_json(404, {"error": "Transcript not found"})
+
+        self.state.count("polls")
+        if time.time() < transcript["ready_at"]:
+            return self.send_json(200, {"id": transcript_id, "status": "processing", "audio_url": transcript["request"]["audio_url"]})
+        if transcript["response"] is None:
+            transcript["response"] = build_transcript_response(transcript_id, transcript)
+        self.send_json(200, transcript["response"])
+
+    def _send_webhook(self, transcript_id, request, failed):
+        headers = {"Content-Type": "application/json"}
+        if request.get("webhook_auth_header_name"):
+            headers[request["webhook_auth_header_name"]] = request["webhook_auth_header_value"]
+        payload = json.dumps({"transcript_id": transcript_id, "status": "error" if failed else "completed"}).encode()
+        try:
+            urllib.request.urlopen(urllib.request.Request(request["webhook_url"], data=payload, headers=headers), timeout=10).read()
+            self.state.count("webhooks_sent")
+        except Exception:
+            self.state.count("webhooks_failed")
+
+def build_transcript_response(transcript_id, transcript):
+    """Синтетический результат: слова, реплики двух спикеров, сущности, резюме и главы"""
+    request = transcript["request"]
+    base = {"id": transcript_id, "audio_url": request["audio_url"], "language_code": request.get("language_code") or "ru"}
+    if transcript["failed"]:
+        return {**base, "status": "error", "error": "Injected transcription failure"}
+
+    generator = random.Random(transcript_id)
+    word_count = max(int(transcript["duration"] * WORDS_PER_SECOND), 5)
+    step_ms = int(1000 / WORDS_PER_SECOND)
+    words = []
+    for index in range(word_count):
+        speaker = "AB"[index // WORDS_PER_UTTERANCE % 2]
+        words.append({
+            "text": generator.choice(VOCABULARY), "start": index * step_ms, "end": index * step_ms + step_ms - 50,
+            "confidence": 0.9, "speaker": speaker,
+        })
+
+    utterances = []
+    for start in range(0, word_count, WORDS_PER_UTTERANCE):
+        group = words[start:start + WORDS_PER_UTTERANCE]
+        utterances.append({
+            "text": " ".join(word["text"] for word in group), "start": group[0]["start"], "end": group[-1]["end"],
+            "confidence": 0.9, "speaker": group[0]["speaker"], "words": group,
+        })
+
+    duration_ms = words[-1]["end"]
+    response = {
+        **base,
+        "status": "completed",
+        "text": " ".join(word["text"] for word in words),
+        "words": words,
+        "utterances": utterances,
+        "audio_duration": int(transcript["duration"]),
+        "confidence": 0.9,
+        "entities": [
+            {"entity_type": "person_name", "text": "Иван Петров", "start": 0, "end": 800},
+            {"entity_type": "location", "text": "Москва", "start": 1000, "end": 1400},
+        ],
+    }
+    if request.get("summarization"):
+        response["summary"] = "- Обсуждение плана запуска\n- Согласование бюджета"
+    if request.get("auto_chapters"):
+        response["chapters"] = [
+            {"summary": "Обсуждение", "headline": "План запуска", "gist": "План", "start": 0, "end": duration_ms},
+        ]
+    return response
+
+class OpenRouterHandler(FakeHandler):
+    """POST /v1/chat/completions (с stream и без)"""
+
+    def do_POST(self):
+        body = self.read_body()
+        if self.inject_http_error():
+            return
+        if not self.path.endswith("/chat/completions"):
+            return self.send_json(404, {"error": "Not found"})
+
+        options = self.state.options
+        request = json.loads(body)
+        self.state.count("llm_calls")
+        time.sleep(options.llm_latency)
+        if random.random() < options.llm_fail_rate:
+            self.state.count("injected_llm_errors")
+            return self.send_json(500, {"error": {"message": "Injected LLM failure"}})
+
+        prompt_tokens = sum(len(message["content"]) for message in request["messages"]) // 4
+        content = "📋 КРАТКОЕ РЕЗЮМЕ\n" + " ".join(random.choices(VOCABULARY, k=min(request.get("max_tokens", 200), 200)))
+        usage = {"prompt_tokens": prompt_tokens, "completion_tokens": len(content) // 4, "total_tokens": prompt_tokens + len(content) // 4}
+        completion = {"id": f"gen-{uuid.uuid4().hex}", "created": int(time.time()), "model": request["model"]}
+
+        if not request.get("stream"):
+            return self.send_json(200, {
+                **completion,
+                "object": "chat.completion",
+                "choices": [{"index": 0, "message": {"role": "assistant", "content": content}, "finish_reason": "stop"}],
+                "usage": usage,
+            })
+
+        self.send_response(200)
+        self.send_header("Content-Type", "text/event-stream")
+        self.send_header("Connection", "close")
+        self.end_headers()
+        self.close_connection = True
+        pieces = [content[i:i + 40] for i in range(0, len(content), 40)]
+        for index, piece in enumerate(pieces):
+            last = index == len(pieces) - 1
+            chunk = {
+                **completion,
+                "object": "chat.completion.chunk",
+                "choices": [{"index": 0, "delta": {"content": piece}, "finish_reason": "stop" if last else None}],
+            }
+            if last:
+                chunk["usage"] = usage
+            self.wfile.write(f"data: {json.dumps(chunk, ensure_ascii=False)}\n\n".encode("utf-8"))
+            self.wfile.flush()
+        self.wfile.write(b"data: [DONE]\n\n")
+
+def start_fake_backends(options, host="127.0.0.1"):
+    """Поднимает обе заглушки в фоновых потоках; возвращает (state, assemblyai_url, openrouter_url, servers)"""
+    state = FakeState(options)
+    servers = []
+    for handler, port in ((AssemblyAIHandler, options.assemblyai_port), (OpenRouterHandler, options.openrouter_port)):
+        server = ThreadingHTTPServer((host, port), handler)
+        server.daemon_threads = True
+        server.state = state
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        servers.append(server)
+
+    assemblyai_url = f"http://{host}:{servers[0].server_port}"
+    openrouter_url = f"http://{host}:{servers[1].server_port}/v1"
+    return state, assemblyai_url, openrouter_url, servers
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Заглушки AssemblyAI и OpenRouter")
+    parser.add_argument("--assemblyai-port", type=int, default=8765)
+    parser.add_argument("--openrouter-port", type=int, default=8766)
+    args = add_backend_arguments(parser).parse_args()
+
+    state, assemblyai_url, openrouter_url, _ = start_fake_backends(args)
+    print(f"ASSEMBLYAI_BASE_URL={assemblyai_url}")
+    print(f"OPENROUTER_BASE_URL={openrouter_url}")
+    try:
+        while True:
+            time.sleep(10)
+            print(json.dumps(state.get_counters(), ensure_ascii=False))
+    except KeyboardInterrupt:
+        pass
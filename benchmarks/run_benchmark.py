@@ -0,0 +1,330 @@
+"""Нагрузочный прогон сервиса на локальных заглушках AssemblyAI и OpenRouter.
+
+Поднимает заглушки, запускает приложение отдельным процессом (по умолчанию -
+командой web из Procfile), прогоняет синтетические WAV-файлы разных размеров
+с заданной конкурентностью и печатает пропускную способность, p50/p95/p99,
+пиковый RSS сервера и долю неудач по стратегиям транскрипции.
+
+    python benchmarks/run_benchmark.py --requests 40 --concurrency 8 --sizes 1,5,20
+    python benchmarks/run_benchmark.py --json current.json --baseline baseline.json
+
+С --baseline прогон завершается с кодом 1, если p95 или пропускная способность
+хуже сохранённого результата больше чем на --max-regression.
+"""
+import argparse
+import json
+import os
+import re
+import shlex
+import shutil
+import signal
+import struct
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from collections import Counter, defaultdict
+from concurrent.futures import ThreadPoolExecutor
+
+import httpx
+
+from fake_backends import WAV_BYTES_PER_SECOND, add_backend_arguments, start_fake_backends
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+METRIC_LINE = re.compile(r'^(\w+)\{([^}]*)\} (\S+)$')
+METRIC_LABEL = re.compile(r'(\w+)="([^"]*)"')
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Нагрузочный прогон на заглушках API")
+    parser.add_argument("--requests", type=int, default=40, help="всего запросов")
+    parser.add_argument("--concurrency", type=int, default=8, help="одновременных запросов")
+    parser.add_argument("--sizes", default="1,5,20", help="размеры синтетических WAV, MB через запятую")
+    parser.add_argument("--endpoint", choices=["transcribe", "jobs"], default="transcribe",
+                        help="синхронный /transcribe или фоновые /jobs с опросом")
+    parser.add_argument("--server", choices=["procfile", "asgi", "flask"], default="procfile",
+                        help="как запускать приложение")
+    parser.add_argument("--server-cmd", help="своя команда запуска, {port} заменяется на порт")
+    parser.add_argument("--port", type=int, default=8780)
+    parser.add_argument("--env", action="append", default=[], metavar="KEY=VALUE",
+                        help="дополнительные переменные окружения приложения")
+    parser.add_argument("--assemblyai-port", type=int, default=0)
+    parser.add_argument("--openrouter-port", type=int, default=0)
+    parser.add_argument("--json", help="сохранить результат в файл")
+    parser.add_argument("--baseline", help="сравнить с сохранённым результатом")
+    parser.add_argument("--max-regression", type=float, default=0.2, help="допустимое ухудшение относительно baseline")
+    return add_backend_arguments(parser).parse_args()
+
+def write_wav(path, size_mb):
+    """WAV 16 кГц моно с тихим шумом нужного размера (пишется блоками)"""
+    data_size = int(size_mb * 1024 * 1024) // 2 * 2
+    header = b"RIFF" + struct.pack("<I", 36 + data_size) + b"WAVE"
+    header += b"fmt " + struct.pack("<IHHIIHH", 16, 1, 1, WAV_BYTES_PER_SECOND // 2, WAV_BYTES_PER_SECOND, 2, 16)
+    header += b"data" + struct.pack("<I", data_size)
+    block = bytes(byte & 0x07 for byte in os.urandom(1024 * 1024))
+    with open(path, "wb") as wav:
+        wav.write(header)
+        written = 0
+        while written < data_size:
+            piece = block[:min(len(block), data_size - written)]
+            wav.write(piece)
+            written += len(piece)
+
+def server_command(args):
+    if args.server_cmd:
+        return shlex.split(args.server_cmd.format(port=args.port))
+    if args.server == "asgi":
+        return [sys.executable, "-m", "uvicorn", "asgi:application", "--host", "127.0.0.1", "--port", str(args.port)]
+    if args.server == "flask":
+        return [sys.executable, "app.py"]
+
+    # Команда web из Procfile - так же, как приложение запускается в продакшене
+    with open(os.path.join(REPO_DIR, "Procfile")) as procfile:
+        web = next(line.split(":", 1)[1] for line in procfile if line.startswith("web:"))
+    command = [part.replace("$PORT", str(args.port)).replace("0.0.0.0", "127.0.0.1") for part in shlex.split(web)]
+    if command[0] in ("gunicorn", "uvicorn"):
+        command = [sys.executable, "-m"] + command
+    return command
+
+def start_app(args, assemblyai_url, openrouter_url, work_dir):
+    env = dict(os.environ)
+    env.update({
+        "PORT": str(args.port),
+        "ASSEMBLYAI_API_KEY": "benchmark",
+        "ASSEMBLYAI_BASE_URL": assemblyai_url,
+        "OPENROUTER_API_KEY": "benchmark",
+        "OPENROUTER_BASE_URL": openrouter_url,
+        # Одинаковые файлы не должны попадать в кэш, а прогон - оставлять следов
+        "RESULT_CACHE_ENABLED": "0",
+        "TRANSCRIPT_STORE_PATH": os.path.join(work_dir, "transcripts.sqlite3"),
+        "JOB_STORE_PATH": os.path.join(work_dir, "jobs.sqlite3"),
+        "STRATEGY_STATS_PATH": os.path.join(work_dir, "strategies.sqlite3"),
+        "STATE_STORE_PATH": os.path.join(work_dir, "state.sqlite3"),
+        "TEMP_ROOT": os.path.join(work_dir, "tmp"),
+    })
+    for item in args.env:
+        key, _, value = item.partition("=")
+        env[key] = value
+
+    log = open(os.path.join(work_dir, "server.log"), "w")
+    process = subprocess.Popen(server_command(args), cwd=REPO_DIR, env=env, stdout=log, stderr=subprocess.STDOUT)
+    base_url = f"http://127.0.0.1:{args.port}"
+    deadline = time.time() + 60
+    while time.time() < deadline:
+        if process.poll() is not None:
+            raise RuntimeError(f"Сервер завершился с кодом {process.returncode}, журнал: {log.name}")
+        try:
+            if httpx.get(f"{base_url}/health", timeout=2).status_code == 200:
+                return process, base_url
+        except httpx.HTTPError:
+            pass
+        time.sleep(0.3)
+    process.kill()
+    raise RuntimeError(f"Сервер не ответил на /health за 60с, журнал: {log.name}")
+
+def stop_app(process):
+    process.send_signal(signal.SIGTERM)
+    try:
+        process.wait(timeout=15)
+    except subprocess.TimeoutExpired:
+        process.kill()
+        process.wait()
+
+def process_tree_rss(pid):
+    """Суммарный RSS процесса и его потомков в байтах (Linux, /proc)"""
+    children = defaultdict(list)
+    for entry in os.listdir("/proc"):
+        if not entry.isdigit():
+            continue
+        try:
+            with open(f"/proc/{entry}/stat") as stat:
+                parent = int(stat.read().rsplit(")", 1)[1].split()[1])
+            children[parent].append(int(entry))
+        except (OSError, IndexError, ValueError):
+            continue
+
+    total, pending = 0, [pid]
+    while pending:
+        current = pending.pop()
+        pending.extend(children.get(current, []))
+        try:
+            with open(f"/proc/{current}/status") as status:
+                for line in status:
+                    if line.startswith("VmRSS:"):
+                        total += int(line.split()[1]) * 1024
+        except OSError:
+            continue
+    return total
+
+class RSSSampler(threading.Thread):
+    """Пиковый RSS сервера по замерам раз в interval секунд"""
+
+    def __init__(self, pid, interval=0.2):
+        super().__init__(daemon=True)
+        self.pid = pid
+        self.interval = interval
+        self.peak = 0
+        self.stopped = threading.Event()
+
+    def run(self):
+        if not os.path.isdir("/proc"):
+            return
+        while not self.stopped.is_set():
+            self.peak = max(self.peak, process_tree_rss(self.pid))
+            self.stopped.wait(self.interval)
+
+def scrape_strategy_attempts(base_url):
+    """Счётчики voicesum_strategy_attempts_total из /metrics: {(strategy, outcome): n}"""
+    attempts = Counter()
+    for line in httpx.get(f"{base_url}/metrics", timeout=10).text.splitlines():
+        match = METRIC_LINE.match(line)
+        if match and match.group(1) == "voicesum_strategy_attempts_total":
+            labels = dict(METRIC_LABEL.findall(match.group(2)))
+            attempts[(labels["strategy"], labels["outcome"])] += float(match.group(3))
+    return attempts
+
+def send_request(client, base_url, endpoint, path):
+    """Один запрос; возвращает (секунды, успех, метод транскрипции или текст ошибки)"""
+    started = time.time()
+    try:
+        with open(path, "rb") as audio:
+            response = client.post(f"{base_url}/{endpoint}", files={"audio": (os.path.basename(path), audio, "audio/wav")})
+        data = response.json()
+        if endpoint == "jobs" and response.status_code == 202:
+            status_url = f"{base_url}{data['status_url']}"
+            while data.get("status") not in ("completed", "failed"):
+                time.sleep(0.2)
+                data = client.get(status_url).json()
+            if data["status"] == "failed":
+                return time.time() - started, False, data.get("error")
+            data = data["result"]
+        elif response.status_code != 200:
+            return time.time() - started, False, data.get("error", f"HTTP {response.status_code}")
+        return time.time() - started, True, data.get("transcription_method")
+    except (httpx.HTTPError, ValueError) as e:
+        return time.time() - started, False, str(e)
+
+def percentile(values, fraction):
+    """Перцентиль по ближайшему рангу"""
+    if not values:
+        return None
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, max(0, int(round(fraction * len(ordered) + 0.5)) - 1))]
+
+def latency_summary(latencies):
+    return {
+        "p50_ms": round(percentile(latencies, 0.50) * 1000) if latencies else None,
+        "p95_ms": round(percentile(latencies, 0.95) * 1000) if latencies else None,
+        "p99_ms": round(percentile(latencies, 0.99) * 1000) if latencies else None,
+    }
+
+def run(args):
+    sizes = [float(size) for size in args.sizes.split(",")]
+    work_dir = tempfile.mkdtemp(prefix="voicesum_benchmark_")
+    files = []
+    for size in sizes:
+        path = os.path.join(work_dir, f"sample_{size:g}mb.wav")
+        write_wav(path, size)
+        files.append((f"{size:g}MB", path))
+
+    state, assemblyai_url, openrouter_url, servers = start_fake_backends(args)
+    process, base_url = start_app(args, assemblyai_url, openrouter_url, work_dir)
+    try:
+        attempts_before = scrape_strategy_attempts(base_url)
+        sampler = RSSSampler(process.pid)
+        sampler.start()
+
+        print(f"🚀 {args.requests} запросов к /{args.endpoint}, конкурентность {args.concurrency}, размеры {args.sizes} MB")
+        started = time.time()
+        with httpx.Client(timeout=1800) as client, ThreadPoolExecutor(max_workers=args.concurrency) as executor:
+            futures = [
+                (files[index % len(files)][0], executor.submit(send_request, client, base_url, args.endpoint, files[index % len(files)][1]))
+                for index in range(args.requests)
+            ]
+            outcomes = [(label, *future.result()) for label, future in futures]
+        wall_time = time.time() - started
+
+        sampler.stopped.set()
+        sampler.join()
+        attempts_after = scrape_strategy_attempts(base_url)
+    finally:
+        stop_app(process)
+        for server in servers:
+            server.shutdown()
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+    succeeded = [latency for _, latency, ok, _ in outcomes if ok]
+    result = {
+        "requests": args.requests,
+        "concurrency": args.concurrency,
+        "endpoint": args.endpoint,
+        "succeeded": len(succeeded),
+        "failed": len(outcomes) - len(succeeded),
+        "wall_time_s": round(wall_time, 2),
+        "throughput_rps": round(len(succeeded) / wall_time, 3),
+        **latency_summary(succeeded),
+        "peak_rss_mb": round(sampler.peak / 1024 / 1024, 1) if sampler.peak else None,
+        "by_size": {},
+        "methods": dict(Counter(detail for _, _, ok, detail in outcomes if ok)),
+        "errors": dict(Counter(detail for _, _, ok, detail in outcomes if not ok)),
+        "strategies": {},
+        "backends": state.get_counters(),
+    }
+    for label, _ in files:
+        latencies = [latency for size, latency, ok, _ in outcomes if ok and size == label]
+        result["by_size"][label] = {"succeeded": len(latencies), **latency_summary(latencies)}
+
+    for strategy in sorted({strategy for strategy, _ in attempts_after}):
+        counts = {
+            outcome: int(attempts_after[(strategy, outcome)] - attempts_before[(strategy, outcome)])
+            for outcome in ("success", "failure", "cancelled")
+        }
+        total = sum(counts.values())
+        counts["failure_rate"] = round(counts["failure"] / total, 3) if total else 0.0
+        result["strategies"][strategy] = counts
+    return result
+
+def print_report(result):
+    print(f"\n✅ Успешно {result['succeeded']}/{result['requests']} за {result['wall_time_s']}с "
+          f"({result['throughput_rps']} запросов/с), пиковый RSS: {result['peak_rss_mb']} MB")
+    print(f"{'размер':>10} {'готово':>7} {'p50, мс':>9} {'p95, мс':>9} {'p99, мс':>9}")
+    rows = list(result["by_size"].items()) + [("всего", result)]
+    for label, row in rows:
+        print(f"{label:>10} {row['succeeded']:>7} {row['p50_ms'] or '-':>9} {row['p95_ms'] or '-':>9} {row['p99_ms'] or '-':>9}")
+
+    print("\nСтратегии (попытки по исходу):")
+    for strategy, counts in result["strategies"].items():
+        print(f"  {strategy}: успех {counts['success']}, неудача {counts['failure']}, "
+              f"отменено {counts['cancelled']}, доля неудач {counts['failure_rate']:.0%}")
+    print(f"Выбранные методы: {result['methods']}")
+    if result["errors"]:
+        print(f"❌ Ошибки: {result['errors']}")
+    print(f"Заглушки: {result['backends']}")
+
+def compare_with_baseline(result, baseline, max_regression):
+    """Список регрессий относительно baseline (пустой - всё в порядке)"""
+    regressions = []
+    if baseline.get("p95_ms") and result.get("p95_ms") and result["p95_ms"] > baseline["p95_ms"] * (1 + max_regression):
+        regressions.append(f"p95 {baseline['p95_ms']} -> {result['p95_ms']} мс")
+    if baseline.get("throughput_rps") and result["throughput_rps"] < baseline["throughput_rps"] * (1 - max_regression):
+        regressions.append(f"пропускная способность {baseline['throughput_rps']} -> {result['throughput_rps']} запросов/с")
+    if result["failed"] > baseline.get("failed", 0):
+        regressions.append(f"ошибок {baseline.get('failed', 0)} -> {result['failed']}")
+    return regressions
+
+if __name__ == "__main__":
+    args = parse_args()
+    result = run(args)
+    print_report(result)
+
+    if args.json:
+        with open(args.json, "w") as output:
+            json.dump(result, output, ensure_ascii=False, indent=2)
+
+    if args.baseline:
+        with open(args.baseline) as baseline_file:
+            regressions = compare_with_baseline(result, json.load(baseline_file), args.max_regression)
+        if regressions:
+            print(f"\n❌ Регрессия относительно {args.baseline}: {'; '.join(regressions)}")
+            sys.exit(1)
+        print(f"\n✅ Без регрессий относительно {args.baseline}")
@@ -0,0 +1,47 @@
+"""Настройки gunicorn для запуска в несколько процессов.
+
+Приложение загружается один раз в мастере (preload_app), каждый воркер после fork
+получает свою временную папку и фоновые потоки (app.init_worker). По SIGTERM воркер
+перестаёт принимать задачи, дорабатывает текущие до SHUTDOWN_DRAIN_SECONDS и сохраняет
+оставшиеся в общем хранилище, откуда их забирают другие воркеры.
+
+Лимиты MAX_RUNNING_JOBS, TENANT_MAX_CONCURRENT, UPSTREAM_MAX_TRANSCRIPTIONS и
+TEMP_DISK_MAX_BYTES общие для всех воркеров: занятые слоты и резерв диска каждого
+процесса хранятся в STATE_STORE_PATH, поэтому при росте WEB_CONCURRENCY их не нужно
+делить. Очереди (QUEUE_MAX_DEPTH, TENANT_MAX_QUEUED) у каждого воркера свои.
+"""
+import multiprocessing
+import os
+import signal
+
+# Потоки и временная папка создаются в воркерах, а не в мастере
+os.environ.setdefault("VOICESUM_WORKER_INIT", "post_fork")
+
+bind = f"0.0.0.0:{os.environ.get('PORT', 8000)}"
+preload_app = True
+workers = int(os.environ.get("WEB_CONCURRENCY", multiprocessing.cpu_count()))
+worker_class = "gthread"
+threads = int(os.environ.get("GUNICORN_THREADS", 8))
+timeout = 1800
+# Мастер ждёт воркер дольше, чем тот дорабатывает задачи
+graceful_timeout = int(os.environ.get("SHUTDOWN_DRAIN_SECONDS", 120)) + 30
+
+def post_fork(server, worker):
+    import app
+    app.init_worker()
+
+def post_worker_init(worker):
+    """SIGTERM сразу переводит воркер в режим остановки, не дожидаясь конца цикла gthread"""
+    import app
+    handle_exit = worker.handle_exit
+
+    def drain_and_exit(sig, frame):
+        app.begin_shutdown()
+        handle_exit(sig, frame)
+
+    # gunicorn уже зарегистрировал свой обработчик, поэтому заменяем его в signal
+    signal.signal(signal.SIGTERM, drain_and_exit)
+
+def worker_exit(server, worker):
+    import app
+    app.shutdown_worker()